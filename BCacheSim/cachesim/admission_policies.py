@@ -4,17 +4,15 @@ from collections import defaultdict
 from collections import deque
 # import methodtools
 import random
+import time
 
 try:
     import lightgbm as lgb
 except ModuleNotFoundError:
     print("Unable to import lightgbm")
 
-from sklearn.pipeline import make_pipeline
-from sklearn.preprocessing import StandardScaler
-from sklearn.svm import SVC
-
 from sklearn.model_selection import train_test_split
+from sklearn.svm import SVC
 
 import numpy as np
 import spookyhash
@@ -24,10 +22,15 @@ from .utils import LOG_REQ
 from .utils import ods
 from . import utils
 from .ep_helpers import AccessPlus
+from .ep_helpers import batch_column, batch_features, batch_subset
 from ..episodic_analysis.episodes import service_time
 
 
 class AP(object):
+    # Decisions depend only on the key and its metadata, and evaluating a key
+    # has no side effects: composite APs may skip keys they already decided.
+    stateless = False
+
     def __init__(self):
         self.features = ''
 
@@ -55,6 +58,8 @@ class AP(object):
 
 
 class AcceptAll(AP):
+    stateless = True
+
     def accept(self, k, ts, metadata=None):
         return True
 
@@ -112,6 +117,132 @@ https://github.com/Thesys-lab/sosp23-s3fifo/blob/79fde46c03180b95b1091249a6f1402
 """
 
 
+def _platt_sigmoid(dec, pos, neg, max_iter=100):
+    """
+    Platt's sigmoid, P(positive) = 1 / (1 + exp(A * dec + B)), fitted as in
+    libsvm's sigmoid_train, with pos and neg examples at each decision value.
+    """
+    prior1, prior0 = pos.sum(), neg.sum()
+    hi, lo = (prior1 + 1.0) / (prior1 + 2.0), 1.0 / (prior0 + 2.0)
+    # Same (weighted) points and targets as libsvm: pos at hi, neg at lo.
+    f = np.concatenate([dec, dec])
+    t = np.concatenate([np.full(len(dec), hi), np.full(len(dec), lo)])
+    w = np.concatenate([pos, neg]).astype(np.float64)
+
+    def loss(a, b):
+        z = f * a + b
+        return np.sum(w * (t * z + np.logaddexp(0, -z)))
+
+    a, b = 0.0, np.log((prior0 + 1.0) / (prior1 + 1.0))
+    fval = loss(a, b)
+    for _ in range(max_iter):
+        z = f * a + b
+        p = 1 / (1 + np.exp(np.clip(z, -500, 500)))  # P(positive)
+        d1 = w * (t - p)
+        d2 = w * p * (1 - p)
+        h11, h22, h21 = np.sum(f * f * d2) + 1e-12, np.sum(d2) + 1e-12, np.sum(f * d2)
+        g1, g2 = np.sum(f * d1), np.sum(d1)
+        if abs(g1) < 1e-5 and abs(g2) < 1e-5:
+            break
+        det = h11 * h22 - h21 * h21
+        da, db = -(h22 * g1 - h21 * g2) / det, -(-h21 * g1 + h11 * g2) / det
+        gd = g1 * da + g2 * db
+        step = 1.0
+        while step >= 1e-10:
+            new_f = loss(a + step * da, b + step * db)
+            if new_f < fval + 1e-4 * step * gd:
+                a, b, fval = a + step * da, b + step * db, new_f
+                break
+            step /= 2
+        else:
+            break
+    return a, b
+
+
+class FlashieldTable(object):
+    """
+    The Flashield SVC (standardized feature, RBF kernel, Platt-scaled
+    probabilities) on its single small-integer feature (n_access), fitted
+    from label counts per value and tabulated, so inference is an index.
+
+    Examples with the same value and label only differ in weight, so the
+    SVC is fitted on the distinct (value, label) pairs with their counts as
+    sample weights: the same problem as on the full sample, with the scaler
+    and kernel width fixed to the full sample's. Platt's sigmoid is fitted
+    to cross-validated decision values as libsvm does, with the examples
+    dealt out to the folds in order instead of shuffled. Values beyond the
+    seen range are passed to the SVC.
+    """
+    def __init__(self, feature_list, label_list):
+        x = np.asarray(feature_list, dtype=np.int64)
+        y = np.asarray(label_list, dtype=bool)
+        counts = np.bincount(x)
+        positives = np.bincount(x, weights=y)
+        seen = np.flatnonzero(counts)
+        pos, neg = positives[seen], counts[seen] - positives[seen]
+        # As StandardScaler on the full sample.
+        self.mean, self.scale = x.mean(), x.std() or 1.0
+        xs = np.concatenate([seen, seen])
+        ys = np.concatenate([np.ones(len(seen), dtype=bool), np.zeros(len(seen), dtype=bool)])
+        ws = np.concatenate([pos, neg])
+        # gamma='scale' is 1 / variance, which is 1 once standardized.
+        xs, ys, ws = self._scaled(xs[ws > 0]), ys[ws > 0], ws[ws > 0]
+        self.svc = SVC(gamma=1.0).fit(xs, ys, sample_weight=ws)
+        self.table = self._decision(np.arange(len(counts)))
+        self.sigmoid = _platt_sigmoid(*self._cross_validated(xs, ys, ws))
+
+    @staticmethod
+    def _cross_validated(xs, ys, ws, nr_fold=5):
+        """
+        Decision values from libsvm's 5-fold cross validation: each pair's
+        examples are dealt out over the folds in turn (libsvm shuffles them),
+        and decided by an SVC on the other folds. Returns the values with
+        their positive and negative example counts.
+        """
+        ws = ws.astype(np.int64)
+        held = np.zeros((nr_fold, len(ws)), dtype=np.int64)
+        start = np.concatenate([[0], np.cumsum(ws)[:-1]])
+        for k in range(nr_fold):
+            # Examples start, start + 1, ... of each pair go to folds in turn.
+            held[k] = (ws - (k - start) % nr_fold + nr_fold - 1) // nr_fold
+        dec, pos, neg = [], [], []
+        for k in range(nr_fold):
+            test, train = held[k] > 0, ws - held[k]
+            labels = np.unique(ys[train > 0])
+            if len(labels) == 2:
+                svc = SVC(gamma=1.0).fit(xs[train > 0], ys[train > 0], sample_weight=train[train > 0])
+                dec.append(svc.decision_function(xs[test]))
+            else:
+                # As libsvm: +1 / -1 if only one class is left, else 0.
+                dec.append(np.full(test.sum(), (1.0 if labels[0] else -1.0) if len(labels) else 0.0))
+            pos.append(np.where(ys[test], held[k][test], 0))
+            neg.append(np.where(ys[test], 0, held[k][test]))
+        return np.concatenate(dec), np.concatenate(pos), np.concatenate(neg)
+
+    def _scaled(self, x):
+        return ((x - self.mean) / self.scale).reshape(-1, 1)
+
+    def _decision(self, x):
+        return self.svc.decision_function(self._scaled(x))
+
+    def _lookup(self, X):
+        """SVC decision values."""
+        x = np.asarray(X, dtype=np.int64).ravel()
+        dec = self.table[np.clip(x, 0, len(self.table) - 1)]
+        outside = (x < 0) | (x >= len(self.table))
+        if outside.any():
+            dec[outside] = self._decision(x[outside])
+        return dec
+
+    def predict(self, X):
+        return self._lookup(X) > 0
+
+    def predict_proba(self, X):
+        a, b = self.sigmoid
+        p = 1 / (1 + np.exp(a * self._lookup(X) + b))
+        return np.column_stack([1 - p, p])
+
+
 class FlashieldModel(object):
     def __init__(self, threshold, probability=False):
         self.features = {}
@@ -137,21 +268,16 @@ class FlashieldModel(object):
             self.labels = defaultdict(int)
             return None
         print(f"Training Flashield with {len(self.features)} examples")
-        feature_list, label_list = [], []
-        for obj_id, n_access in self.features.items():
-            feature_list.append([n_access])
-            label_list.append(self.labels[obj_id] > self.threshold)
-        # TODO: Replace this with uniform sampling
-        if len(feature_list) > 1000000:
-            feature_list = feature_list[:1000000]
-            label_list = label_list[:1000000]
-        clf = make_pipeline(StandardScaler(), SVC(probability=self.probability))
-        clf.fit(np.reshape(feature_list, (-1, 1)), label_list)
+        feature_list = list(self.features.values())
+        label_list = [self.labels[obj_id] > self.threshold for obj_id in self.features]
+        clf = FlashieldTable(feature_list, label_list)
         print("Flashield training completed")
         return clf
 
 
 class FlashieldAP(AP):
+    stateless = True
+
     def __init__(self, *args, threshold=None, **kwargs):
         assert threshold is not None
         super().__init__(*args, **kwargs)
@@ -189,7 +315,7 @@ class FlashieldAP(AP):
                 self.start_ts = ts
 
     def batchAccept(self, batch, ts, metadata=None, check_only=False):
-        feats = [metadata['ramcache_hits'][key] for key in batch]
+        feats = batch_column(batch, metadata, 'ramcache_hits')
         if self.classifier is None:
             decs = [True] * len(feats)
         else:
@@ -197,7 +323,7 @@ class FlashieldAP(AP):
             ods.bump("ml_predictions", v=len(feats))
             feats = np.reshape(feats, (-1, 1))
             decs = self.classifier.predict(feats)
-        decisions = dict(zip([k for k in batch], decs))
+        decisions = dict(zip(batch, decs))
         if not check_only:
             self.count_decisions(decisions)
         return decisions
@@ -223,16 +349,15 @@ class FlashieldProbAP(FlashieldAP):
         self.trainer = FlashieldModel(threshold=n, probability=True)
 
     def batchAccept(self, batch, ts, metadata=None, check_only=False):
-        feats = [metadata['ramcache_hits'][key] for key in batch]
+        feats = batch_column(batch, metadata, 'ramcache_hits')
         if self.classifier is None:
             decs = [True] * len(feats)
         else:
             ods.bump("ml_batches")
             ods.bump("ml_predictions", v=len(feats))
             feats = np.reshape(feats, (-1, 1))
-            decs = self.classifier.predict_proba(feats)[:, 1]
-            decs = [v >= self.threshold for v in decs]
-        decisions = dict(zip([k for k in batch], decs))
+            decs = self.classifier.predict_proba(feats)[:, 1] >= self.threshold
+        decisions = dict(zip(batch, decs))
         # if self.classifier:
         #     print(decisions)
         if not check_only:
@@ -261,6 +386,8 @@ class CoinFlipAP(AP):
 
 class CoinFlipDetAP(AP):
     """Deterministic Coin Flip AP"""
+    stateless = True
+
     def __init__(self, probability):
         super().__init__()
         self.prob = probability
@@ -288,6 +415,8 @@ class CoinFlipDetAP(AP):
 
 # learned admission policy
 class LearnedAP(AP):
+    stateless = True
+
     def __init__(self, threshold, model_path=None):
         assert model_path
         self.threshold = threshold
@@ -296,10 +425,10 @@ class LearnedAP(AP):
         self.features = 'dfeat+meta'
 
     def _predict(self, batch, ts):
-        Xs = list(batch.values())
+        features = batch_features(batch)
         # remove size and offset for now
-        Xs = [x[:-3] if len(x) == 12 else x for x in Xs]
-        features = np.array(Xs)
+        if features.ndim == 2 and features.shape[1] == 12:
+            features = features[:, :-3]
         # for x in Xs:
         #     self.seen_before[tuple(x)] += 1
         # TODO: Log and check for seen-before features
@@ -310,7 +439,6 @@ class LearnedAP(AP):
         try:
             return self.gbm.predict(features)
         except:
-            print(Xs)
             print(features)
             raise
 
@@ -318,9 +446,7 @@ class LearnedAP(AP):
         predictions = self._predict(batch, ts)
         # for a, b in zip(batch.keys(), predictions):
         #     print(f"ML_PRED {a} {b > self.threshold} {b}")
-        decisions = dict(
-            zip(batch.keys(), [pred > self.threshold for pred in predictions])
-        )
+        decisions = dict(zip(batch.keys(), predictions > self.threshold))
         if not check_only:
             self.count_decisions(decisions)
         return decisions
@@ -336,9 +462,8 @@ class LearnedSizeAP(LearnedAP):
 
     def batchAccept(self, batch, ts, metadata=None, check_only=False):
         predictions = self._predict(batch, ts)
-        sizes = metadata['size']
-        decisions = {k: pred / sizes[k] > self.threshold
-                     for k, pred in zip(batch.keys(), predictions)}
+        sizes = np.asarray(batch_column(batch, metadata, 'size'))
+        decisions = dict(zip(batch.keys(), predictions / sizes > self.threshold))
         if not check_only:
             self.count_decisions(decisions)
         return decisions
@@ -352,15 +477,13 @@ class NewMLAP(LearnedAP):
         assert len(self.gbm.feature_name()) == self.num_features, (self.gbm.feature_name(), self.num_features)
 
     def __predict(self, batch, ts):
-        Xs = list(batch.values())
-        assert len(Xs[0]) == self.num_features
-        features = np.array(Xs)
+        features = batch_features(batch)
+        assert features.shape[1] == self.num_features
         ods.bump("ml_batches")
         ods.bump("ml_predictions", v=len(features))
         try:
             return self.gbm.predict(features)
         except:
-            print(Xs)
             print(features)
             raise
 
@@ -675,16 +798,19 @@ class HybridAP(AP):
 
     def batchAccept(self, batch, ts, *, metadata=None, check_only=False):
         locations = {k: self.split(k, ts, metadata=metadata) for k in batch}
-        batches = [{}, {}]
+        batches = [[], []]
         results = {0: {}, 1: {}}
         decisions = {}
         for k, v in locations.items():
-            batches[v][k] = batch[k]
+            batches[v].append(k)
         for i, ap in enumerate(self.aps):
             ods.bump(f"ap_hybrid_to_{i}_{ap.name}", v=len(batches[i]))
         for i in [0, 1]:
             if batches[i]:
-                results[i] = self.aps[i].batchAccept(batches[i], ts, metadata=metadata)
+                sub = batch_subset(batch, batches[i])
+                t = time.time()
+                results[i] = self.aps[i].batchAccept(sub, ts, metadata=metadata)
+                ods.bump(f"ap_hybrid_secs_{i}_{self.aps[i].name}", v=time.time() - t)
                 decisions.update(results[i])
         assert len(decisions) == len(batch)
         if not check_only:
@@ -693,22 +819,59 @@ class HybridAP(AP):
 
 
 class EitherAP(AP):
+    """
+    Accepts if any child does. Children are evaluated as a cascade: stateless
+    ones only see the keys that earlier children left undecided, cheapest
+    (by measured time per key) first. Stateful children see every key, as
+    skipping one would change their later decisions.
+    """
+    # A key is decided once a child returns this.
+    decided_by = True
+    tag = "either"
+    decided_stat = "acceptby"
+
     def __init__(self, aps):
         self.aps = aps
         self.features = 'dfeat+meta'
+        self.evals = [0] * len(aps)
+        self.secs = [0.0] * len(aps)
+
+    @property
+    def stateless(self):
+        return all(ap.stateless for ap in self.aps)
+
+    def eval_order(self):
+        stateful = [i for i, ap in enumerate(self.aps) if not ap.stateless]
+        stateless = [i for i, ap in enumerate(self.aps) if ap.stateless]
+        stateless.sort(key=lambda i: (utils.safe_div(self.secs[i], self.evals[i]), i))
+        return stateful + stateless
 
     def batchAccept(self, batch, ts, *, metadata=None, check_only=False):
-        results = {}
-        decisions = {}
-        for i, ap in enumerate(self.aps):
-            results[i] = ap.batchAccept(batch, ts, metadata=metadata)
-        for k in batch:
-            decisions[k] = False
-            for i, ap in enumerate(self.aps):
-                if results[i][k]:
-                    ods.bump(f"ap_either_acceptby_{i}_{ap.name}")
-                    decisions[k] = True
-                    break
+        decisions = {k: not self.decided_by for k in batch}
+        undecided = list(batch)
+        for i in self.eval_order():
+            ap = self.aps[i]
+            sub = batch
+            if ap.stateless:
+                if not undecided:
+                    continue
+                if len(undecided) < len(batch):
+                    sub = batch_subset(batch, undecided)
+            t = time.time()
+            results = ap.batchAccept(sub, ts, metadata=metadata)
+            secs = time.time() - t
+            self.secs[i] += secs
+            self.evals[i] += len(sub)
+            ods.bump(f"ap_{self.tag}_evals_{i}_{ap.name}", v=len(sub))
+            ods.bump(f"ap_{self.tag}_secs_{i}_{ap.name}", v=secs)
+            still_undecided = []
+            for k in undecided:
+                if bool(results[k]) == self.decided_by:
+                    ods.bump(f"ap_{self.tag}_{self.decided_stat}_{i}_{ap.name}")
+                    decisions[k] = self.decided_by
+                else:
+                    still_undecided.append(k)
+            undecided = still_undecided
         assert len(decisions) == len(batch)
         if not check_only:
             self.count_decisions(decisions)
@@ -716,22 +879,10 @@ class EitherAP(AP):
 
 
 class AndAP(EitherAP):
-    def batchAccept(self, batch, ts, *, metadata=None, check_only=False):
-        results = {}
-        decisions = {}
-        for i, ap in enumerate(self.aps):
-            results[i] = ap.batchAccept(batch, ts, metadata=metadata)
-        for k in batch:
-            decisions[k] = True
-            for i, ap in enumerate(self.aps):
-                if not results[i][k]:
-                    ods.bump(f"ap_all_rejectby_{i}_{ap.name}")
-                    decisions[k] = False
-                    break
-        assert len(decisions) == len(batch)
-        if not check_only:
-            self.count_decisions(decisions)
-        return decisions
+    """Accepts if all children do; see EitherAP for the evaluation order."""
+    decided_by = False
+    tag = "all"
+    decided_stat = "rejectby"
 
 
 # class CachedLearnedSizeAP(LearnedSizeAP):
@@ -777,6 +928,8 @@ class AndAP(EitherAP):
 
 
 class OfflineAP(AP):
+    stateless = True
+
     def __init__(self, decisions, threshold, flip_threshold=True):
         super().__init__()
         self.threshold = threshold
@@ -805,6 +958,8 @@ class OfflineAP(AP):
 
 
 class OfflinePlus(AP):
+    stateless = True
+
     def __init__(self, threshold, *, only_used_chunks=True, check_future_use=True):
         super().__init__()
         self.threshold = threshold
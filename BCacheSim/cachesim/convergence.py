@@ -0,0 +1,123 @@
+"""Early stopping once the post-warmup interval metrics have converged.
+
+At each checkpoint, EarlyStopper takes the counter increments of the
+interval that just ended. After warmup, it puts confidence intervals on
+the target metrics: batch means for the ratio and the rate (successive
+intervals are correlated), and order statistics for the DT percentiles.
+The run has converged once every interval is within the relative
+tolerance of its estimate.
+"""
+
+import numpy as np
+import scipy.stats
+
+from .utils import ods
+
+COUNTERS = [
+    "iops_saved",
+    "iops_requests",
+    "flashcache/keys_written",
+    "service_time_used",
+    "service_time_writes",
+]
+
+TARGETS = [
+    "IOPSSavedRatio",
+    "FlashWriteRate",
+    "P50ServiceTimeUsedWithPut",
+    "P90ServiceTimeUsedWithPut",
+]
+
+
+class EarlyStopper(object):
+    def __init__(
+        self, tolerance, *, skip_intervals=0, min_intervals=36, confidence=0.95
+    ):
+        self.tolerance = tolerance
+        self.skip_intervals = skip_intervals
+        self.min_intervals = min_intervals
+        self.confidence = confidence
+        self.num_checkpoints = 0
+        self.last = {k: 0 for k in COUNTERS}
+        self.last_ts = None
+        self.intervals = {k: [] for k in COUNTERS + ["duration"]}
+        self.rel_errs = {}
+        self.converged = False
+
+    def update(self, ts_physical):
+        """Call at each checkpoint, with its trace time."""
+        deltas = {}
+        for k in COUNTERS:
+            v = ods.get(k)
+            deltas[k] = v - self.last[k]
+            self.last[k] = v
+        if self.last_ts is None:
+            self.last_ts = ods.get("start_ts_phy")
+        deltas["duration"] = ts_physical - self.last_ts
+        self.last_ts = ts_physical
+        self.num_checkpoints += 1
+        if self.num_checkpoints <= self.skip_intervals:
+            return self.converged
+        for k, v in deltas.items():
+            self.intervals[k].append(v)
+        if len(self.intervals["duration"]) >= self.min_intervals:
+            self.rel_errs = self.estimate_errors()
+            self.converged = max(self.rel_errs.values()) <= self.tolerance
+        return self.converged
+
+    def _batch_ratio_err(self, num, den):
+        """Relative half-width of the interval on sum(num)/sum(den)."""
+        num, den = np.asarray(num, dtype=float), np.asarray(den, dtype=float)
+        size = int(np.sqrt(len(num)))
+        nb = len(num) // size
+        # Drop the oldest intervals, so that batches end at the latest one.
+        num = num[len(num) - nb * size :].reshape(nb, size).sum(axis=1)
+        den = den[len(den) - nb * size :].reshape(nb, size).sum(axis=1)
+        est = num.sum() / den.sum() if den.sum() else 0
+        batches = num[den > 0] / den[den > 0]
+        if est == 0 or len(batches) < 2:
+            return np.inf
+        t = scipy.stats.t.ppf((1 + self.confidence) / 2, len(batches) - 1)
+        half = t * batches.std(ddof=1) / np.sqrt(len(batches))
+        return half / abs(est)
+
+    def _quantile_err(self, values, q):
+        """Relative half-width of the distribution-free interval on a quantile."""
+        values = np.sort(values)
+        n = len(values)
+        z = scipy.stats.norm.ppf((1 + self.confidence) / 2)
+        spread = z * np.sqrt(n * q * (1 - q))
+        lo = max(int(np.floor(n * q - spread)), 0)
+        hi = min(int(np.ceil(n * q + spread)), n - 1)
+        est = np.percentile(values, q * 100)
+        if est == 0:
+            return np.inf
+        return (values[hi] - values[lo]) / 2 / abs(est)
+
+    def estimate_errors(self):
+        ivs = self.intervals
+        st = np.add(ivs["service_time_used"], ivs["service_time_writes"])
+        return {
+            "IOPSSavedRatio": self._batch_ratio_err(
+                ivs["iops_saved"], ivs["iops_requests"]
+            ),
+            "FlashWriteRate": self._batch_ratio_err(
+                ivs["flashcache/keys_written"], ivs["duration"]
+            ),
+            "P50ServiceTimeUsedWithPut": self._quantile_err(st, 0.5),
+            "P90ServiceTimeUsedWithPut": self._quantile_err(st, 0.9),
+        }
+
+    def results(self, stopped_early):
+        def finite(v):
+            # None until there are min_intervals after warmup.
+            return float(v) if v is not None and np.isfinite(v) else None
+
+        rel_errs = {k: finite(self.rel_errs.get(k)) for k in TARGETS}
+        max_rel_err = finite(max(self.rel_errs.values(), default=None))
+        return {
+            "StoppedEarly": stopped_early,
+            "EarlyStopIntervals": len(self.intervals["duration"]),
+            "EarlyStopRelErr": rel_errs,
+            "EarlyStopMaxRelErr": max_rel_err,
+        }
@@ -18,6 +18,8 @@ class DynamicFeatures:
         self.last_access_time = {}
         self.granularity = granularity
         self.hr_unit = hr_unit
+        # Bumped on every update, so cached feature vectors can be checked.
+        self.version = 0
 
     def _key(self, key):
         if self.granularity.startswith('block') and type(key) != int and len(key) == 2:
@@ -26,6 +28,7 @@ class DynamicFeatures:
 
     def updateFeatures(self, key, ts, weight=1):
         key = self._key(key)
+        self.version += 1
         # empty startup or past 1 hr: start a new set
         if len(self.history) == 0 or ts > self.timestamps[0] + self.hr_unit:
             self.history.appendleft(defaultdict(int))
@@ -40,6 +43,21 @@ class DynamicFeatures:
         # update time since last access
         self.last_access_time[key] = ts
 
+    # updateFeatures at each of times (increasing seconds)
+    def updateFeaturesMany(self, key, times, weight=1):
+        self.updateFeatures(key, float(times[0]), weight=weight)
+        if len(times) == 1:
+            return
+        if times[-1] > self.timestamps[0] + self.hr_unit:
+            # starts a new set on the way
+            for ts in times[1:]:
+                self.updateFeatures(key, float(ts), weight=weight)
+            return
+        key = self._key(key)
+        self.version += 1
+        self.history[0][key] += weight * (len(times) - 1)
+        self.last_access_time[key] = float(times[-1])
+
     # only gets a single key's bloom-filter features
     def getFeature(self, key):
         key = self._key(key)
@@ -1,8 +1,13 @@
+from collections import Counter
 from collections import defaultdict
 from collections import namedtuple
+from collections.abc import Mapping
 import functools
+import math
 import shelve
 
+import numpy as np
+
 from .utils import ods
 from .legacy_utils import GET_OPS, PUT_OPS
 from ..episodic_analysis.episodes import Episode
@@ -25,6 +30,9 @@ class AccessPlus(object):
         self.num_chunks = self.chunk_range[1] - self.chunk_range[0]
         assert self.chunks == list(range(*self.chunk_range))
         self.pred_prefetch = None
+        # Request-scoped feature caches; see sim_features.FeatureContext.
+        self.meta_features_ = {}
+        self.feature_contexts = {}
 
         assert access.features
         if self.features.op in GET_OPS:
@@ -43,6 +51,12 @@ class AccessPlus(object):
         """In case we want to implement something more dynamic? TODO: Reconsider."""
         return self.chunks_
 
+    def meta_features(self, with_size=True):
+        """features.toList(with_size), computed once per request. Do not modify."""
+        if with_size not in self.meta_features_:
+            self.meta_features_[with_size] = self.features.toList(with_size=with_size)
+        return self.meta_features_[with_size]
+
     @property
     def is_get(self):
         return self.op == 'GET'
@@ -144,6 +158,295 @@ def _prefetchable_chunks(decisions, block_id, ts_prefetch, assumed_ea=None, thre
     return chunks, eps_chunk
 
 
+def chunk_mask(chunk_range):
+    """Residency bitmap with the chunks in [lo, hi) set."""
+    lo, hi = chunk_range
+    return (1 << hi) - (1 << lo)
+
+
+def chunks_mask(chunks):
+    """Residency bitmap with the given chunk ids set."""
+    mask = 0
+    for chunk_id in chunks:
+        mask |= 1 << chunk_id
+    return mask
+
+
+def mask_chunks(mask):
+    """Chunk ids set in a residency bitmap, ascending."""
+    chunks = []
+    while mask:
+        low = mask & -mask
+        chunks.append(low.bit_length() - 1)
+        mask ^= low
+    return chunks
+
+
+MISSING = object()
+
+
+class _ColumnView(Mapping):
+    """key -> value of one AdmitBuffer metadata field (keys that set it)."""
+
+    def __init__(self, buf, values):
+        self.buf = buf
+        self.values_ = values
+
+    def __getitem__(self, key):
+        v = self.values_[self.buf.rows[key]]
+        if v is MISSING:
+            raise KeyError(key)
+        return v
+
+    def __iter__(self):
+        return (k for k, v in zip(self.buf.keys_, self.values_) if v is not MISSING)
+
+    def __len__(self):
+        return sum(1 for v in self.values_ if v is not MISSING)
+
+
+class AdmitBuffer(Mapping):
+    """
+    Chunks awaiting an admission decision, stored as parallel columns
+    indexed by row: keys, feature rows, and one list per metadata field.
+    As a Mapping it is the key -> features batch that APs take, and
+    metadata() the field -> {key: value} they look values up in; APs that
+    can work on whole columns use features() and column() instead.
+    """
+
+    def __init__(self):
+        self.keys_ = []
+        self.rows = {}
+        self.feats = []
+        self.columns = {}
+
+    def add(self, key, features, metadata):
+        row = len(self.keys_)
+        self.rows[key] = row
+        self.keys_.append(key)
+        self.feats.append(features)
+        for field, values in self.columns.items():
+            values.append(metadata.get(field, MISSING))
+        for field in metadata:
+            if field not in self.columns:
+                self.columns[field] = [MISSING] * row + [metadata[field]]
+
+    def set(self, field, key, value):
+        if field not in self.columns:
+            self.columns[field] = [MISSING] * len(self.keys_)
+        self.columns[field][self.rows[key]] = value
+
+    def get_field(self, field, key, default=None):
+        v = self.columns[field][self.rows[key]] if field in self.columns else MISSING
+        return default if v is MISSING else v
+
+    def row_metadata(self, key, exclude=()):
+        row = self.rows[key]
+        return {
+            field: values[row]
+            for field, values in self.columns.items()
+            if values[row] is not MISSING and field not in exclude
+        }
+
+    def features(self):
+        return np.array(self.feats)
+
+    def column(self, field):
+        """Values of field for every row; KeyError if any row lacks it."""
+        values = self.columns[field]
+        if any(v is MISSING for v in values):
+            raise KeyError(field)
+        return values
+
+    def metadata(self):
+        return {field: _ColumnView(self, v) for field, v in self.columns.items()}
+
+    def subset(self, keys):
+        sub = AdmitBuffer()
+        rows = [self.rows[k] for k in keys]
+        sub.keys_ = list(keys)
+        sub.rows = {k: i for i, k in enumerate(sub.keys_)}
+        sub.feats = [self.feats[r] for r in rows]
+        sub.columns = {f: [v[r] for r in rows] for f, v in self.columns.items()}
+        return sub
+
+    def clear(self):
+        self.keys_.clear()
+        self.rows.clear()
+        self.feats.clear()
+        self.columns.clear()
+
+    def __getitem__(self, key):
+        return self.feats[self.rows[key]]
+
+    def __contains__(self, key):
+        return key in self.rows
+
+    def __iter__(self):
+        return iter(self.keys_)
+
+    def __len__(self):
+        return len(self.keys_)
+
+
+def batch_subset(batch, keys):
+    """The rows of an AP batch for keys, as the same kind of batch."""
+    if isinstance(batch, AdmitBuffer):
+        return batch.subset(keys)
+    return {k: batch[k] for k in keys}
+
+
+def batch_features(batch):
+    """Feature matrix of an AP batch, one row per key in batch order."""
+    if isinstance(batch, AdmitBuffer):
+        return batch.features()
+    return np.array(list(batch.values()))
+
+
+def batch_column(batch, metadata, field):
+    """Values of a metadata field for the keys of an AP batch, in order."""
+    if isinstance(batch, AdmitBuffer):
+        return batch.column(field)
+    return [metadata[field][k] for k in batch]
+
+
+class QuantileSketch(object):
+    """
+    Streaming quantiles of nonnegative values, kept as counts in log-spaced
+    buckets: bounded size, relative error under (BASE - 1) / 2.
+    """
+
+    BASE = 1.5
+    __slots__ = ("buckets", "count")
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+
+    def _bucket(self, v):
+        return 0 if v < 1 else 1 + int(math.log(v, self.BASE))
+
+    def add(self, v, n=1):
+        b = self._bucket(v)
+        self.buckets[b] = self.buckets.get(b, 0) + n
+        self.count += n
+
+    def add_sorted(self, values):
+        """Adds values (a sequence that does not decrease), a bucket at a time."""
+        i = 0
+        while i < len(values):
+            b = self._bucket(values[i])
+            # Binary search for the last value in bucket b.
+            lo, hi = i, len(values) - 1
+            while lo < hi:
+                mid = (lo + hi + 1) // 2
+                if self._bucket(values[mid]) == b:
+                    lo = mid
+                else:
+                    hi = mid - 1
+            self.add(values[i], n=lo - i + 1)
+            i = lo + 1
+
+    def quantile(self, q):
+        rank = q * (self.count - 1)
+        seen = 0
+        for b in sorted(self.buckets):
+            seen += self.buckets[b]
+            if seen > rank:
+                return 0 if b == 0 else self.BASE ** (b - 0.5)
+        return 0
+
+
+class EpisodeRecord(object):
+    """
+    Bookkeeping for a cached episode (QueueCache.cached_episodes).
+    Chunk sets are bitmaps, and hit/miss times are sketched as offsets (in
+    seconds) from the first access, so the record stays small on hot blocks.
+    """
+
+    __slots__ = (
+        "block_id",
+        "first_access_ts",
+        "last_access_ts",
+        "evicted",
+        "chunks",
+        "active_chunks",
+        "admitbuffer_chunks",
+        "admits_by_chunk",
+        "num_accesses",
+        "iops_hits",
+        "iops_partial_hits",
+        "iops_misses",
+        "hit_offsets",
+        "miss_offsets",
+        "decision_ts",
+        "decisions",
+        "partial_admits",
+    )
+
+    ADMITTED, REJECTED = 1, 2
+
+    def __init__(self, block_id, ts):
+        self.block_id = block_id
+        self.first_access_ts = ts
+        self.last_access_ts = ts
+        self.evicted = None
+        self.chunks = 0
+        self.active_chunks = 0
+        self.admitbuffer_chunks = 0
+        self.admits_by_chunk = Counter()
+        self.num_accesses = 0
+        self.iops_hits = 0
+        self.iops_partial_hits = 0
+        self.iops_misses = 0
+        self.hit_offsets = QuantileSketch()
+        self.miss_offsets = QuantileSketch()
+        # Admission decisions (flags) taken at decision_ts.
+        self.decision_ts = None
+        self.decisions = 0
+        # Number of flushes that admitted some chunks and rejected others.
+        self.partial_admits = 0
+
+    def num_active_chunks(self):
+        return self.active_chunks.bit_count()
+
+    def record_decision(self, ts, flag):
+        # A flush decides all of its chunks at one ts, and ts only grows.
+        if ts != self.decision_ts:
+            self.decision_ts = ts
+            self.decisions = 0
+        prev = self.decisions
+        self.decisions |= flag
+        if self.decisions != prev and self.decisions == self.ADMITTED | self.REJECTED:
+            self.partial_admits += 1
+
+    def record_access(self, is_hit, chunk_hit, ts):
+        self.num_accesses += 1
+        offset = (ts - self.first_access_ts).physical
+        if is_hit:
+            self.iops_hits += 1
+            self.hit_offsets.add(offset)
+        else:
+            self.iops_misses += 1
+            if chunk_hit:
+                self.iops_partial_hits += 1
+            self.miss_offsets.add(offset)
+
+    def record_accesses(self, is_hit, chunk_hit, timestamps):
+        """record_access at each of timestamps (SpacedTimestamps)."""
+        n = len(timestamps)
+        self.num_accesses += n
+        offsets = timestamps.physical - self.first_access_ts.physical
+        if is_hit:
+            self.iops_hits += n
+            self.hit_offsets.add_sorted(offsets)
+        else:
+            self.iops_misses += n
+            if chunk_hit:
+                self.iops_partial_hits += n
+            self.miss_offsets.add_sorted(offsets)
+
+
 @functools.total_ordering
 class Timestamp(namedtuple('Timestamp', ['logical', 'physical'])):
     def __hash__(self):
@@ -193,8 +496,40 @@ class Timestamp(namedtuple('Timestamp', ['logical', 'physical'])):
         return f'({format(self.logical, format_spec)},{format(phy, format_spec)}{ext})'
 
 
-def record_service_time_get(need_fetch, need_prefetch, acc):
-    tags = [f"ns_{acc.features.namespace}", f"user_{acc.features.user}"]
+class SpacedTimestamps(object):
+    """
+    Timestamps of n accesses in a row, one logical step apart and at
+    physical times start + (first + i) * step: a sequence of Timestamps,
+    made (once) on access. `physical` has the physical times as an array.
+    """
+
+    def __init__(self, logical, start, step, first, n):
+        self.logical = logical
+        self.physical = start + (first + np.arange(n)) * step
+        self.made = {}
+
+    def __len__(self):
+        return len(self.physical)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if i not in self.made:
+            self.made[i] = Timestamp(self.logical + i, float(self.physical[i]))
+        return self.made[i]
+
+    @functools.cached_property
+    def widest_gap(self):
+        """Index i of the largest self[i] - self[i - 1] (0 if n < 2)."""
+        if len(self) < 2:
+            return 0
+        return 1 + int(np.argmax(np.diff(self.physical)))
+
+
+def record_service_time_get(need_fetch, need_prefetch, acc, tenants=None):
+    # tenants: (namespace, user) labels from TopKTenants.
+    ns, user = tenants or (acc.features.namespace, acc.features.user)
+    tags = [f"ns_{ns}", f"user_{user}"]
 
     ods.bump("fetches_ios")
     range_fetch = min(need_fetch), max(need_fetch)
@@ -250,7 +585,7 @@ def record_service_time_get(need_fetch, need_prefetch, acc):
     ods.bump("service_time_used3_prefetch", v=service_time(0, num_with_prefetch3-num_fetch3))
 
 
-def record_service_time_put(acc):
+def record_service_time_put(acc, tenants=None):
     ods.bump("puts_ios")
     ods.bump("puts_chunks", v=acc.num_chunks)
     ods.bump("service_time_writes", v=service_time(1, acc.num_chunks))
@@ -259,7 +594,8 @@ def record_service_time_put(acc):
     ods.bump(["puts_chunks", "op", acc.features.op.name], v=acc.num_chunks)
     ods.bump(["service_time_writes", "op", acc.features.op.name], v=service_time(1, acc.num_chunks))
 
-    tags = [f"ns/{acc.features.namespace}", f"user/{acc.features.user}"]
+    ns, user = tenants or (acc.features.namespace, acc.features.user)
+    tags = [f"ns/{ns}", f"user/{user}"]
     for tag in tags:
         ods.bump(["puts_ios", tag])
         ods.bump(["puts_chunks", tag], v=acc.num_chunks)
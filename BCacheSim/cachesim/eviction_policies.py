@@ -19,7 +19,10 @@ from .utils import LOG_DEBUG, LOG_REQ, ods
 
 from .ep_helpers import _get_chunks_for_episode
 from .ep_helpers import _lookup_episode
+from .ep_helpers import AdmitBuffer
+from .ep_helpers import EpisodeRecord
 from .ep_helpers import Timestamp
+from .ep_helpers import chunk_mask, chunks_mask, mask_chunks
 
 
 class QueueItem(object):
@@ -143,6 +146,9 @@ class TTLItem(QueueItemWithStats):
 
 
 class EvictionImpl(object):
+    # Touching a key again, with nothing in between, changes nothing.
+    idempotent_touch = False
+
     def keys(self):
         return self.items.keys()
 
@@ -193,6 +199,8 @@ class TTLPolicy(EvictionImpl):
 
 
 class LRUPolicy(EvictionImpl):
+    idempotent_touch = True
+
     def __init__(self):
         self.items = OrderedDict()
 
@@ -322,6 +330,63 @@ class DTSLRUPolicy(EvictionImpl):
         return key in self.probation_items or key in self.protected_items
 
 
+class GhostTable(object):
+    """
+    Key -> float store for history that outlives cache residency.
+
+    Values live in a NumPy array. Once capacity keys are held, a CLOCK hand
+    forgets the first key that has not been read or written since the hand
+    last passed it. capacity=None keeps every key.
+    """
+
+    def __init__(self, capacity=None):
+        self.capacity = capacity
+        self.slots: dict[tuple[str, int], int] = {}
+        self.keys: list[tuple[str, int]] = []
+        self.values = np.zeros(min(capacity or 1024, 1024))
+        self.referenced = np.zeros(len(self.values), dtype=bool)
+        self.hand = 0
+        self.forgotten = 0
+
+    def __contains__(self, key: tuple[str, int]) -> bool:
+        return key in self.slots
+
+    def __len__(self) -> int:
+        return len(self.slots)
+
+    def get(self, key: tuple[str, int]) -> float:
+        i = self.slots[key]
+        self.referenced[i] = True
+        return float(self.values[i])
+
+    def set(self, key: tuple[str, int], value: float):
+        i = self.slots.get(key)
+        if i is None:
+            i = self._slot_for(key)
+        self.values[i] = value
+        self.referenced[i] = True
+
+    def _slot_for(self, key: tuple[str, int]) -> int:
+        if self.capacity is None or len(self.keys) < self.capacity:
+            i = len(self.keys)
+            if i == len(self.values):
+                n = 2 * i if self.capacity is None else min(2 * i, self.capacity)
+                self.values = np.resize(self.values, n)
+                self.referenced = np.resize(self.referenced, n)
+            self.keys.append(key)
+        else:
+            while self.referenced[self.hand]:
+                self.referenced[self.hand] = False
+                self.hand = (self.hand + 1) % self.capacity
+            i = self.hand
+            del self.slots[self.keys[i]]
+            self.keys[i] = key
+            self.hand = (i + 1) % self.capacity
+            self.forgotten += 1
+        self.slots[key] = i
+        return i
+
+
 class EDEPolicy(EvictionImpl):
     """
     Episode-Deadline Eviction (EDE):
@@ -335,6 +400,7 @@ class EDEPolicy(EvictionImpl):
         protected_cap: float,
         alpha_tti: float,
         cache_size: int,
+        ghost_factor: float | None = None,
     ):
         """
         EDE Policy with time-to-idle prediction and DT-per-byte protection with PROTECTED cap and α_tti EWMA adaptation.
@@ -344,6 +410,7 @@ class EDEPolicy(EvictionImpl):
             * alpha_tti: EWMA smoothing factor for time-to-idle updates (0.0-1.0)
                 - α_tti close to 1 → expiry estimates adapt quickly
                 - α_tti small → expiry estimates update slowly
+            * ghost_factor: EWMA history is kept for this many times cache_size keys (None: every key)
         """
         time_to_idle_threshold = 3600
 
@@ -366,23 +433,23 @@ class EDEPolicy(EvictionImpl):
         self.alpha_tti: float = alpha_tti
 
         # print(self.protected_items_size)
-        # track EWMA state
-        self.ewma_states: dict[tuple[str, int], dict[str, float]] = {}
+        # track EWMA state (ewma_tti), also for keys no longer in the cache
+        ghost_capacity = int(cache_size * ghost_factor) if ghost_factor else None
+        self.ewma_states = GhostTable(ghost_capacity)
 
     def update_ewma_time_to_idle(self, key: tuple[str, int], new_tti: float) -> float:
         """Update time-to-idle using EWMA with α_tti smoothing"""
         if key not in self.ewma_states:
             # Initialize EWMA state
-            self.ewma_states[key] = {"prev_tti": new_tti, "ewma_tti": new_tti}
+            self.ewma_states.set(key, new_tti)
             return new_tti
 
         # Apply EWMA here: ewma_tti = α_tti * new_tti + (1 - α_tti) * prev_ewma_tti
-        prev_ewma = self.ewma_states[key]["ewma_tti"]
+        prev_ewma = self.ewma_states.get(key)
         new_ewma = self.alpha_tti * new_tti + (1 - self.alpha_tti) * prev_ewma
 
         # Update EWMA state
-        self.ewma_states[key]["prev_tti"] = prev_ewma
-        self.ewma_states[key]["ewma_tti"] = new_ewma
+        self.ewma_states.set(key, new_ewma)
 
         return new_ewma
 
@@ -442,7 +509,7 @@ class EDEPolicy(EvictionImpl):
 
         # Initialize EWMA state
         if key not in self.ewma_states:
-            self.ewma_states[key] = {"prev_tti": time_to_idle, "ewma_tti": time_to_idle}
+            self.ewma_states.set(key, time_to_idle)
 
         # Determine if item should be protected
         if self.should_protect(key, item):
@@ -529,23 +596,34 @@ class EDEPolicy(EvictionImpl):
 
 
 class TTLModel(object):
+    # Admit buffer metadata fields that predict_batch needs.
+    metadata_keys = []
+
     def __init__(self, options):
         model_path = options.ttl_model_path
         self.models = {"ttl": lgb.Booster(model_file=model_path)}
         self.keys = ["ttl"]
 
-    def predict(self, features):
-        # print(features[0].shape)
-        features = [features]
-        preds = {k: self.models[k].predict(features)[0].astype(int) for k in self.keys}
+    def predict_batch(self, features, metadata=None):
+        """One TTL per row of features, with one Booster.predict per model."""
+        features = np.asarray(features)
+        preds = {k: self.models[k].predict(features).astype(int) for k in self.keys}
         ods.bump("ml_batches", v=len(self.keys))
-        ods.bump("ml_predictions", v=len(self.keys))
+        ods.bump("ml_predictions", v=len(self.keys) * len(features))
         return preds["ttl"]
 
+    def predict(self, features, metadata=None):
+        return self.predict_batch([features])[0]
+
 
 class TTLOpt(object):
-    def predict(self, features, metadata=None):
+    metadata_keys = ["episode"]
+
+    def predict_batch(self, features, metadata=None):
         # use episodes.max_interarrival
+        return [episode.max_interarrival[0] for episode in metadata["episode"]]
+
+    def predict(self, features, metadata=None):
         return metadata["episode"].max_interarrival[0]
 
 
@@ -747,20 +825,19 @@ class EvictionPolicy(object):
 
         if self.early_evict and ts_key in self.early_evict:
             for block_id in self.early_evict[ts_key]:
-                for chunk_id in range(128):
-                    key_to_evict = (block_id, chunk_id)
-                    if key_to_evict in self.cache:
-                        self.do_eviction(ts, key=key_to_evict)
-                        self.early_evictions += 1
-                        self.bump("early_evictions")
+                for chunk_id in self.resident_chunks(block_id, chunk_mask((0, 128))):
+                    self.do_eviction(ts, key=(block_id, chunk_id))
+                    self.early_evictions += 1
+                    self.bump("early_evictions")
         # TODO: If scheduled for early eviction, do not admit.
 
         # Avoid readmissions during episodes
         if self.evict_by == "episode":
             for block_id, acc in groups:
-                for chunk_id in acc.chunks():
+                mask = chunks_mask(acc.chunks())
+                for chunk_id in self.resident_chunks(block_id, mask):
                     k = (block_id, chunk_id)
-                    if k in self.cache and self.cache[k].last_access_time != ts:
+                    if self.cache[k].last_access_time != ts:
                         self.find(k, ts, count_as_hit=False)
                         self.episode_touches += 1
 
@@ -775,8 +852,7 @@ class EvictionPolicy(object):
             # Obsolete.
             for block_id, items in self.admitted_buffer.items():
                 if self.prefetch_when == "rejectfirst":
-                    eps_stats = self.cached_episodes[block_id]
-                    if eps_stats["iops_misses"] == 0:
+                    if self.cached_episodes[block_id].iops_misses == 0:
                         # TODO: assert not in block IDs
                         continue
 
@@ -1120,18 +1196,23 @@ class QueueCache(EvictionPolicy):
                 options.ede_protected_cap,
                 options.ede_alpha_tti,
                 self.cache_size,
+                ghost_factor=options.ede_ghost_factor,
             )
         else:
             self.cache = LRUPolicy()
         self.block_counts = Counter()
+        # block_id -> bitmap of the block's chunks in self.cache.
+        self.resident = {}
+        # Running aggregates of item.max_interarrival_time, kept on hit and
+        # evict so that the compute* stats do not scan the cache.
+        self.resident_max_ia_cum = Timestamp(0, 0)
+        self.max_ia_seen = Timestamp(0, 0)
         self.ap = ap
         if isinstance(ap, aps.OfflineAP):
             self.dynamic_features = None
-        # queue for batch admissions
-        self.admit_buffer = {}
-        # Metadata for admission buffer
+        # queue for batch admissions, with their metadata
+        self.admit_buffer = AdmitBuffer()
         self.admit_buffer_blocks = set()
-        self.admit_buffer_metadata = defaultdict(dict)
         # self.admit_buffer_inserted = {}
         # self.sizes = {}
 
@@ -1145,6 +1226,14 @@ class QueueCache(EvictionPolicy):
             self.prefetch = utils.compress_load(prefetch)
         self.episodes = episodes
         self.batch_size = batch_size
+        # Deferred admission: the admit buffer is flushed when it holds
+        # batch_size chunks, or when its oldest chunk has waited
+        # admit_flush_secs, rather than after every access. Buffered chunks
+        # count as hits, and towards occupancy, so keep half for the cache.
+        self.deferred_admission = options.admit_flush == "deferred"
+        self.admit_flush_secs = options.admit_flush_secs
+        if self.deferred_admission:
+            self.batch_size = max(1, min(batch_size, self.cache_size // 2))
 
         self.cached_episodes = {}
 
@@ -1173,100 +1262,72 @@ class QueueCache(EvictionPolicy):
         if "--fast" in sys.argv:
             return
         block_id, chunk_id = key
-        if block_id not in self.cached_episodes:
-            self.cached_episodes[block_id] = {
-                "block_id": block_id,
-                "first_access_ts": ts,
-                "last_access_ts": ts,
-                "admitted_ts": Counter(),
-                "rejected_ts": Counter(),
-                "evicted": None,
-                "chunks": set(),
-                "active_chunks": set(),
-                "admitbuffer_chunks": set(),
-                "num_accesses": 0,
-                "iops_hits": 0,
-                "iops_partial_hits": 0,
-                "iops_misses": 0,
-                "ts_hits": [],
-                "ts_misses": [],
-                "admits_by_chunk": Counter(),
-            }
-        eps_stats = self.cached_episodes[block_id]
-        eps_stats["last_access_ts"] = ts
-        eps_stats["chunks"].add(chunk_id)
+        eps = self.cached_episodes.get(block_id)
+        if eps is None:
+            eps = self.cached_episodes[block_id] = EpisodeRecord(block_id, ts)
+        bit = 1 << chunk_id
+        eps.last_access_ts = ts
+        eps.chunks |= bit
         if admit_buffer:
-            eps_stats["admitbuffer_chunks"].add(chunk_id)
+            eps.admitbuffer_chunks |= bit
         else:
-            if len(eps_stats["active_chunks"]) == 0:
+            if not eps.active_chunks:
                 self.bump("episodes_admitted")
-            eps_stats["active_chunks"].add(chunk_id)
-            eps_stats["admits_by_chunk"][chunk_id] += 1
+            eps.active_chunks |= bit
+            eps.admits_by_chunk[chunk_id] += 1
 
     def admit_episode(self, key, ts):
         if "--fast" in sys.argv:
             return
         block_id, chunk_id = key
-        eps_stats = self.cached_episodes[block_id]
-        eps_stats["admitted_ts"][ts] += 1
-        eps_stats["admits_by_chunk"][chunk_id] += 1
-        try:
-            eps_stats["admitbuffer_chunks"].remove(chunk_id)
-        except KeyError:
-            # print(key, ts)
-            # print(eps_stats)
-            # raise
-            pass
-        eps_stats["active_chunks"].add(chunk_id)
+        eps = self.cached_episodes[block_id]
+        bit = 1 << chunk_id
+        eps.record_decision(ts, EpisodeRecord.ADMITTED)
+        eps.admits_by_chunk[chunk_id] += 1
+        eps.admitbuffer_chunks &= ~bit
+        eps.active_chunks |= bit
 
     def dec_episode(self, key, ts, *, admit_buffer=False):
         if "--fast" in sys.argv:
             return
         block_id, chunk_id = key
-        eps_stats = self.cached_episodes[block_id]
-        if chunk_id not in eps_stats["chunks"]:
+        eps = self.cached_episodes[block_id]
+        bit = 1 << chunk_id
+        if not eps.chunks & bit:
             print(key)
-            # print(eps_stats)
-        try:
-            if admit_buffer:
-                eps_stats["rejected_ts"][ts] += 1
-                eps_stats["admitbuffer_chunks"].remove(chunk_id)
-            else:
-                eps_stats["active_chunks"].remove(chunk_id)
-        except KeyError:
-            pass
-            # print(f"Error: couldn't find chunk {chunk_id}")
-            # raise
-        if len(eps_stats["active_chunks"]) == 0:
-            eps_stats["evicted"] = ts
-            # TODO: log eps_stats
-            if len(eps_stats["admitbuffer_chunks"]) == 0:
-                a_ts = set(eps_stats["admitted_ts"].keys())
-                r_ts = set(eps_stats["rejected_ts"].keys())
-                eps_stats["partial_admits"] = len(a_ts & r_ts)
-                if eps_stats["partial_admits"] > 0:
-                    self.bump("warning_admits_partial", v=eps_stats["partial_admits"])
+        if admit_buffer:
+            eps.record_decision(ts, EpisodeRecord.REJECTED)
+            eps.admitbuffer_chunks &= ~bit
+        else:
+            eps.active_chunks &= ~bit
+        if not eps.active_chunks:
+            eps.evicted = ts
+            if not eps.admitbuffer_chunks:
+                if eps.partial_admits > 0:
+                    self.bump("warning_admits_partial", v=eps.partial_admits)
                     self.bump("warning_admits_partial_episodes")
-                for chunk_id, times_admitted in eps_stats["admits_by_chunk"].items():
+                for chunk_id, times_admitted in eps.admits_by_chunk.items():
                     self.bump_counter("chunk_admits_in_epsiode_dist", times_admitted)
-                # logger.dump("episodes", eps_stats)
+                if eps.iops_hits:
+                    self.bump_counter(
+                        "episode_hit_offset_p50_dist_mins",
+                        int(round(eps.hit_offsets.quantile(0.5) / 60)),
+                    )
                 del self.cached_episodes[block_id]
 
     def rec_episode(self, block_id, is_hit, chunk_hit, ts):
         if "--fast" in sys.argv:
             return
-        if block_id not in self.cached_episodes:
+        eps = self.cached_episodes.get(block_id)
+        if eps is not None:
+            eps.record_access(is_hit, chunk_hit, ts)
+
+    def rec_episodes(self, block_id, is_hit, chunk_hit, timestamps):
+        if "--fast" in sys.argv:
             return
-        eps_stats = self.cached_episodes[block_id]
-        eps_stats["num_accesses"] += 1
-        if is_hit:
-            eps_stats["iops_hits"] += 1
-            eps_stats["ts_hits"].append(ts)
-        else:
-            eps_stats["iops_misses"] += 1
-            if chunk_hit:
-                eps_stats["iops_partial_hits"] += 1
-            eps_stats["ts_misses"].append(ts)
+        eps = self.cached_episodes.get(block_id)
+        if eps is not None:
+            eps.record_accesses(is_hit, chunk_hit, timestamps)
 
     def str(self):
         return "size={}".format(len(self.cache))
@@ -1280,7 +1341,7 @@ class QueueCache(EvictionPolicy):
             reuse_dist = key_ts - self.cache[key].last_access_time
             assert reuse_dist.logical >= 0, "{} {}".format(key_ts, self.cache[key])
             if count_as_hit:
-                self.cache[key].markAccessed(key_ts)
+                self.mark_accessed(self.cache[key], key_ts)
                 self.bump("hits")
             elif touch:
                 self.cache[key].touch(key_ts)
@@ -1294,6 +1355,67 @@ class QueueCache(EvictionPolicy):
         # check if object in admission buffer --> hit
         return found or key in self.admit_buffer
 
+    def mark_accessed(self, item, key_ts):
+        """item.markAccessed(key_ts), updating the interarrival aggregates."""
+        prev = item.max_interarrival_time
+        item.markAccessed(key_ts)
+        if item.max_interarrival_time > prev:
+            self.resident_max_ia_cum += item.max_interarrival_time - prev
+            self.max_ia_seen = max(self.max_ia_seen, item.max_interarrival_time)
+
+    def computeMaxMaxInterarrivalTime(self):
+        # Per-item maxima only grow, and evicted ones are in max_max_*.
+        return max(self.max_ia_seen, self.max_max_interarrival_time)
+
+    def computeAvgMaxInterarrivalTime(self):
+        num = self.max_interarrival_time_cum + self.resident_max_ia_cum
+        return utils.safe_div(num, len(self.cache) + self.evictions)
+
+    def computeAvgObjectSize(self):
+        return utils.safe_div(len(self.cache), len(self.resident))
+
+    def resident_chunks(self, block_id, mask=-1):
+        """Chunk ids of the block in the cache (and in mask), ascending."""
+        return mask_chunks(self.resident.get(block_id, 0) & mask)
+
+    def touch_block(self, block_id, key_ts, chunk_range):
+        """
+        Same as find(count_as_hit=False) on each chunk in [lo, hi), but only
+        visits the resident ones: the rest would not change anything.
+        """
+        self.bump("queries", v=chunk_range[1] - chunk_range[0])
+        touched = self.resident_chunks(block_id, chunk_mask(chunk_range))
+        for chunk_id in touched:
+            key = (block_id, chunk_id)
+            self.cache[key].touch(key_ts)
+            if self.lru:
+                self.cache.touch(key)
+        return touched
+
+    def replay_finds(self, key, timestamps, count_as_hit=True):
+        """
+        Item and policy updates of find() at each of timestamps (a
+        SpacedTimestamps), without the stats, in one step. Requires an
+        idempotent policy touch (or no LRU).
+        """
+        item = self.cache[key]
+        if count_as_hit and len(timestamps) == 1:
+            self.mark_accessed(item, timestamps[0])
+        elif count_as_hit:
+            # Only the widest gap can raise max_interarrival_time past the
+            # first one, so marking the ends and that gap does the same.
+            last = len(timestamps) - 1
+            marks = sorted({0, timestamps.widest_gap, last})
+            for i in marks:
+                if i > 0:
+                    item.touch(timestamps[i - 1])
+                self.mark_accessed(item, timestamps[i])
+            item.hits += last + 1 - len(marks)
+        else:
+            item.touch(timestamps[-1])
+        if self.lru:
+            self.cache.touch(key)
+
     def handle_miss(self, key, ts, *args, **kwargs):
         if not self.find(key, ts, count_as_hit=False):
             self.insert(key, ts, *args, **kwargs)
@@ -1311,7 +1433,7 @@ class QueueCache(EvictionPolicy):
                 assert key in self.admit_buffer
                 for k, v in kwargs["metadata"].items():
                     if k.startswith("ramcache_"):
-                        self.admit_buffer_metadata[k][key] = v
+                        self.admit_buffer.set(k, key, v)
                 # Corner case: if two RAM evictions happen during admit buffer time, some hits will not be recorded in Flash Stats.
             ods.bump("ram_eviction_already_in_flash")
             return False
@@ -1324,58 +1446,69 @@ class QueueCache(EvictionPolicy):
         LOG_REQ(self.namespace, key, ts, "SET")
         assert key not in self.cache
         self.incr_episode(key, ts, admit_buffer=True)
-        # record features
-        self.admit_buffer[key] = keyfeaturelist
-
+        # metadata may be shared between chunks: do not modify it.
         if "ts" not in metadata:
-            metadata["ts"] = ts
-        for k in metadata:
-            self.admit_buffer_metadata[k][key] = metadata[k]
+            metadata = {**metadata, "ts": ts}
+        self.admit_buffer.add(key, keyfeaturelist, metadata)
 
         if self.keep_metadata:
-            self.insert_metadata[key] = (keyfeaturelist, metadata)
+            self.insert_metadata[key] = (keyfeaturelist, dict(metadata))
 
         block_id, _ = key
         self.admit_buffer_blocks.add(block_id)
+        if self.deferred_admission:
+            # Reserve room for the buffered chunks.
+            while len(self.cache) + len(self.admit_buffer) >= self.cache_size:
+                self.do_eviction(ts)
         if len(self.admit_buffer) < self.batch_size:
             # still space
             return
         self.process_admit_buffer(ts)
 
+    def flush_admit_buffer(self, ts):
+        """Called after each access; see deferred_admission."""
+        if not self.deferred_admission:
+            self.process_admit_buffer(ts)
+        elif self.admit_buffer and self.admit_flush_secs is not None:
+            oldest = self.admit_buffer.columns["ts"][0]
+            if (ts - oldest).physical >= self.admit_flush_secs:
+                self.process_admit_buffer(ts)
+
     def process_admit_buffer(self, ts):
         # process batch admission
         if not self.admit_buffer:
             return
+        self.bump("admit_flushes")
+        buf = self.admit_buffer
         decisions = self.ap.batchAccept(
-            self.admit_buffer,
-            ts,
-            metadata={**{"victim": self.cache.victim()}, **self.admit_buffer_metadata},
+            buf, ts, metadata={"victim": self.cache.victim(), **buf.metadata()}
         )
+        ttls = {}
+        if isinstance(self.cache, TTLPolicy):
+            # TODO: OPT-TTL
+            ttls = self.predict_ttls([k for k, dec in decisions.items() if dec])
         for nkey, dec in decisions.items():
             self.bump("ap.called")
-            if self.admit_buffer_metadata["ramcache_hits"].get(nkey, 0) > 0:
+            ramcache_hits = buf.get_field("ramcache_hits", nkey)
+            if ramcache_hits is not None and ramcache_hits > 0:
                 self.bump(["ap.called", "ram_hits"])
             if not dec:
                 self.rejections += 1
                 self.bump("rejections")
                 # Log episode rejections
                 self.dec_episode(nkey, ts, admit_buffer=True)
-                if nkey in self.admit_buffer_metadata["ramcache_hits"]:
-                    if self.admit_buffer_metadata["ramcache_hits"][nkey] == 0:
+                if ramcache_hits is not None:
+                    if ramcache_hits == 0:
                         self.bump("rejections_no_hit_in_ram")
-                        if self.admit_buffer_metadata["prefetch"].get(nkey, False):
+                        if buf.get_field("prefetch", nkey, False):
                             self.bump("rejections_no_hit_in_ram_prefetches")
 
                 if self.keep_metadata:
                     del self.insert_metadata[nkey]
             else:
-                # ts_access = self.admit_buffer_inserted[nkey]
-                ts_access = self.admit_buffer_metadata["ts"][nkey]
-                item_kwargs = {}
-                for k, dct in self.admit_buffer_metadata.items():
-                    if nkey in dct and k != "ts":
-                        item_kwargs[k] = dct[nkey]
-                if self.admit_buffer_metadata["prefetch"].get(nkey, False):
+                ts_access = buf.get_field("ts", nkey)
+                item_kwargs = buf.row_metadata(nkey, exclude=("ts",))
+                if item_kwargs.get("prefetch", False):
                     self.bump("prefetches")
                     self.prefetches += 1
                     if item_kwargs.get("at_ep_start", False):
@@ -1385,34 +1518,29 @@ class QueueCache(EvictionPolicy):
                 # admit into cache
                 self.admit_episode(nkey, ts)
                 # TTL
-                ttl = None
-                if isinstance(self.cache, TTLPolicy):
-                    # TODO: OPT-TTL
-                    # print(len(self.admit_buffer_metadata))
-                    # print(self.admit_buffer_metadata)
-                    metadata_ = {
-                        k: v[nkey]
-                        for k, v in self.admit_buffer_metadata.items()
-                        if nkey in v
-                    }
-                    ttl = self.ttl_predicter.predict(
-                        self.admit_buffer[nkey], metadata=metadata_
-                    )
-                    # print(ttl)
-                    self.bump("total_ttl", v=int(ttl))
-                    # assert ttl is not None
-                    # TODO: Log average TTL
+                ttl = ttls.get(nkey)
                 # ttl = ttl * 1.25
                 # ttl = min(ttl, 3600*2)
                 self.admit(nkey, ts, ts_access=ts_access, ttl=ttl, **item_kwargs)
                 # Queue for prefetching
                 block_id, chunk_id = nkey
-                self.admitted_buffer[block_id].append(
-                    (chunk_id, ts_access, self.admit_buffer[nkey])
-                )
-        self.admit_buffer.clear()
+                self.admitted_buffer[block_id].append((chunk_id, ts_access, buf[nkey]))
+        buf.clear()
         self.admit_buffer_blocks.clear()
-        self.admit_buffer_metadata.clear()
+
+    def predict_ttls(self, keys):
+        """TTLs for a batch of buffered keys, from one predict_batch call."""
+        if not keys:
+            return {}
+        features = [self.admit_buffer[k] for k in keys]
+        metadata = {
+            field: [self.admit_buffer.get_field(field, k) for k in keys]
+            for field in self.ttl_predicter.metadata_keys
+        }
+        ttls = self.ttl_predicter.predict_batch(features, metadata=metadata)
+        # TODO: Log average TTL
+        self.bump("total_ttl", v=sum(int(ttl) for ttl in ttls))
+        return dict(zip(keys, ttls))
 
     def admit(self, key, ts, *, ttl=None, ts_access=None, episode=None, **item_kwargs):
         block_id, chunk_id = key
@@ -1478,8 +1606,8 @@ class QueueCache(EvictionPolicy):
                     if item_kwargs.get("prefetch", False):
                         tags.append("prefetch")
                     if "--fast" not in sys.argv:
-                        eps_stats = self.cached_episodes[block_id]
-                        if eps_stats["admits_by_chunk"][chunk_id] > 1:
+                        eps = self.cached_episodes[block_id]
+                        if eps.admits_by_chunk[chunk_id] > 1:
                             tags.append("readmission")
                     if readmission_from_ep:
                         tags.append("readmissionEp")
@@ -1523,8 +1651,8 @@ class QueueCache(EvictionPolicy):
                 tags.append("prefetch")
 
             if "--fast" not in sys.argv:
-                eps_stats = self.cached_episodes[block_id]
-                if eps_stats["admits_by_chunk"][chunk_id] > 1:
+                eps = self.cached_episodes[block_id]
+                if eps.admits_by_chunk[chunk_id] > 1:
                     tags.append("readmission")
             if readmission_from_ep:
                 tags.append("readmissionEp")
@@ -1545,6 +1673,7 @@ class QueueCache(EvictionPolicy):
         )
 
         self.block_counts[block_id] += 1
+        self.resident[block_id] = self.resident.get(block_id, 0) | 1 << chunk_id
         self.keys_written += 1
         self.bump("keys_written")
 
@@ -1561,7 +1690,12 @@ class QueueCache(EvictionPolicy):
         evicted = self.cache.evict(key)
         if key:
             assert key == evicted[1].key
-        self.block_counts[evicted[1].key[0]] -= 1
+        block_id, chunk_id = evicted[1].key
+        self.block_counts[block_id] -= 1
+        self.resident_max_ia_cum -= evicted[1].max_interarrival_time
+        mask = self.resident.pop(block_id) & ~(1 << chunk_id)
+        if mask:
+            self.resident[block_id] = mask
         self.dec_episode(evicted[1].key, ts)
         self.log_eviction(ts, evicted)
         if self.on_evict:
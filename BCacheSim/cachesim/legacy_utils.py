@@ -1,6 +1,16 @@
 """Meta trace format specific utilities."""
+import collections
 from enum import Enum, unique
+import heapq
+import io
+import itertools
+import multiprocessing
+import os
+import re
 import sys
+import warnings
+
+import numpy as np
 
 try:
     from ..episodic_analysis.constants_meta import trace_has_pipeline
@@ -269,18 +279,496 @@ def read_processed_file_with_logical_ts(f, get_features=True, **kwargs):
     return k_accesses, start_ts, end_ts, physical_to_logical
 
 
-# read the processed file and return  list of (k, BlkAccess) sorted by access time.
-def read_processed_file_list_accesses(f, **kwargs):
-    k_accesses, start_ts, end_ts = read_processed_file(f, **kwargs)
-    _ = add_logical_timestamps(k_accesses)
-    accesses = []
+# stream the processed file as (k, BlkAccess) in access time order, with
+# logical timestamps, without holding the trace in memory.
+def stream_processed_file(f, get_features=True, only_gets=True, only_puts=False,
+                          with_pipeline=None, assert_monotonic=True,
+                          min_ts_from_start=None,
+                          max_ts_from_start=None,
+                          stats=None, collapse_repeats=False, byte_range=None):
+    """
+    Yields the same sequence as read_processed_file_list_accesses.
+
+    Relies on the trace already being sorted by time: the only reordering
+    needed is for repeated accesses, which spread over the next second and
+    are held in a small heap until later lines pass them. Trace stats
+    (start_ts, end_ts, total_iops*, max_key) are filled into `stats` as the
+    generator is consumed.
+
+    With collapse_repeats, a line with repeat=N is yielded once, with
+    features.repeat=N, and takes up N logical timestamps; the simulator
+    accounts for the follow-ups itself.
+
+    byte_range (lo, hi), from TraceTimeIndex, reads only the lines there.
+    """
+    if with_pipeline is None:
+        with_pipeline = trace_has_pipeline(f)
+    if stats is None:
+        stats = {}
+    stats.update(start_ts=None, end_ts=None, max_key=None,
+                 total_iops=0, total_iops_get=0, total_iops_put=0)
+    print(f"Reading from file {f}")
+    pending = []
+    ts_logical = 0
+
+    def release():
+        nonlocal ts_logical
+        _, _, k, acc = heapq.heappop(pending)
+        n = acc.features.repeat if acc.features is not None else 1
+        acc.ts_logical = ts_logical
+        ts_logical += n
+        stats['total_iops'] += n
+        if acc.features is not None:
+            if acc.features.op in GET_OPS:
+                stats['total_iops_get'] += n
+            elif acc.features.op in PUT_OPS:
+                stats['total_iops_put'] += n
+        if stats['max_key'] is None or k > stats['max_key'][0]:
+            stats['max_key'] = (k, acc)
+        return k, acc
 
-    for k in k_accesses:
-        for a in k_accesses[k].accesses:
-            accesses.append((k, a))
-    accesses.sort(key=lambda a: a[1].ts_logical, reverse=False)
+    last_ts = None
+    i = 0
+    with open(f, "rb") as fb:
+        for line in _read_lines(fb, byte_range):
+            try:
+                if line.startswith('#'):
+                    continue
+                parts = line.split(" ")
+                parts = [p.strip("\n") for p in parts]
+                k = parts[0]
+                off = int(parts[1])
+                size = int(parts[2])
+                ts = float(parts[3])
+                pipeline = None
+                op = None
+                repeat = 1
+                if size == 0:
+                    print(f"ERROR! 0-sized IO: {line}")
+                    continue
 
-    return accesses, start_ts, end_ts
+                start_ts = stats['start_ts']
+                stats['start_ts'] = ts if start_ts is None else min(start_ts, ts)
+                stats['end_ts'] = ts if stats['end_ts'] is None else max(stats['end_ts'], ts)
+                if last_ts is not None:
+                    assert last_ts <= ts, f"last_ts > ts: {last_ts} > {ts}"
+                last_ts = ts
+                if min_ts_from_start and ts - stats['start_ts'] < min_ts_from_start:
+                    continue
+                if max_ts_from_start and ts - stats['start_ts'] > max_ts_from_start:
+                    break
+
+                feat = None
+                if len(parts) >= 8:
+                    if with_pipeline:
+                        op = int(parts[4])
+                        pipeline = int(parts[5])
+                        namespace = int(parts[6])
+                        user = int(parts[7])
+                        if len(parts) >= 9:
+                            repeat = int(parts[8])
+                    else:
+                        op = int(parts[4])
+                        namespace = int(parts[5])
+                        user = int(parts[6])
+                        hostname = int(parts[7])
+                        if len(parts) >= 9:
+                            repeat = int(parts[8])
+                        k = (k, hostname)
+                elif len(parts) == 7:
+                    op = int(parts[4])
+                    namespace = int(parts[5])
+                    user = int(parts[6])
+
+                if op is not None:
+                    feat = KeyFeatures(op=op, pipeline=pipeline, namespace=namespace, user=user, offset=off, size=size, repeat=1)
+
+                if only_gets and (feat is None or feat.op not in GET_OPS):
+                    continue
+                if only_puts and (feat is None or feat.op not in PUT_OPS):
+                    continue
+
+                if not get_features:
+                    feat = None
+            except (ValueError, IndexError):
+                print("Error in parsing line ", line, parts)
+                continue
+
+            if collapse_repeats and feat is not None:
+                feat.repeat = repeat
+                repeat = 1
+            interval = 0 if repeat == 1 else 1. / (repeat - 1)
+            for repeat_i in range(repeat):
+                acc = BlkAccess(off, size, ts + repeat_i * interval, features=feat, block=k, ts_logical=i)
+                # Ties on ts go by line order, as in add_logical_timestamps.
+                heapq.heappush(pending, (acc.ts, i, k, acc))
+                i += 1
+            while pending and pending[0][0] <= ts:
+                yield release()
+    while pending:
+        yield release()
+
+
+def _read_lines(fb, byte_range=None):
+    """Decoded lines of binary file fb, or of byte_range (lo, hi) of it, one at a time."""
+    lo, hi = byte_range or (0, None)
+    fb.seek(lo)
+    pos = lo
+    for line in fb:
+        if hi is not None and pos >= hi:
+            return
+        pos += len(line)
+        yield line.decode()
+
+
+def _split_line_ranges(f, n, byte_range=None):
+    """Splits f (or byte_range of it) into n byte ranges that start and end on line boundaries."""
+    start, total = byte_range or (0, os.path.getsize(f))
+    bounds = [start]
+    with open(f, 'rb') as fb:
+        for j in range(1, n):
+            fb.seek(max(start + (total - start) * j // n, bounds[-1]))
+            fb.readline()
+            bounds.append(min(fb.tell(), total))
+    bounds.append(total)
+    return [(lo, hi) for lo, hi in zip(bounds, bounds[1:]) if hi > lo]
+
+
+class TraceTimeIndex(object):
+    """
+    Sidecar index from trace timestamps to byte offsets, so that a time
+    window can be read without parsing the lines before it.
+
+    Traces are sorted by time, so the index only samples one line every
+    `granularity` bytes: building it takes a seek per sample, not a parse
+    of the trace. byte_range() then scans at most one sample gap at each
+    end of the window for the exact line boundaries. The index is saved
+    next to the trace (in /tmp if that is not writable), and rebuilt if
+    the trace is newer.
+    """
+
+    def __init__(self, f, granularity=1 << 20):
+        self.f = f
+        self.total = os.path.getsize(f)
+        self.filename = self._filename(f)
+        if self.filename:
+            with np.load(self.filename) as data:
+                self.ts, self.offsets = data['ts'], data['offsets']
+        else:
+            self.ts, self.offsets = self._build(granularity)
+            self._save()
+
+    @staticmethod
+    def _candidates(f):
+        return [f + '.tidx.npz', os.path.join('/tmp', os.path.basename(f) + '.tidx.npz')]
+
+    @classmethod
+    def _filename(cls, f):
+        for filename in cls._candidates(f):
+            if os.path.exists(filename) and os.path.getmtime(filename) > os.path.getmtime(f):
+                return filename
+        return None
+
+    def _save(self):
+        for filename in self._candidates(self.f):
+            tmp_filename = f'{filename}.{os.getpid()}.npz'
+            try:
+                np.savez(tmp_filename, ts=self.ts, offsets=self.offsets)
+                os.replace(tmp_filename, filename)
+                self.filename = filename
+                return
+            except OSError:
+                continue
+
+    @staticmethod
+    def _line_ts(line):
+        if not line or line.startswith(b'#'):
+            return None
+        return float(line.split(b' ', 4)[3])
+
+    def _next_line(self, fb, offset):
+        """(offset, ts) of the first trace line starting at or after offset."""
+        fb.seek(max(offset - 1, 0))
+        if offset > 0:
+            fb.readline()
+        while True:
+            pos = fb.tell()
+            line = fb.readline()
+            if not line:
+                return self.total, None
+            ts = self._line_ts(line)
+            if ts is not None:
+                return pos, ts
+
+    def _build(self, granularity):
+        print(f"Building time index for {self.f}")
+        ts, offsets = [], []
+        with open(self.f, 'rb') as fb:
+            for offset in range(0, self.total, granularity):
+                pos, t = self._next_line(fb, offset)
+                if t is not None and (not offsets or pos > offsets[-1]):
+                    offsets.append(pos)
+                    ts.append(t)
+        return np.array(ts), np.array(offsets, dtype=np.int64)
+
+    @property
+    def start_ts(self):
+        return float(self.ts[0])
+
+    def _offset_of(self, fb, t):
+        """Offset of the first line with ts >= t."""
+        i = np.searchsorted(self.ts, t, side='left')
+        if i == 0:
+            return int(self.offsets[0])
+        pos = int(self.offsets[i - 1])
+        # Lines between samples are read from the sample before t.
+        fb.seek(pos)
+        for line in fb:
+            ts = self._line_ts(line)
+            if ts is not None and ts >= t:
+                return pos
+            pos += len(line)
+        return self.total
+
+    def byte_range(self, start_secs=0, end_secs=None):
+        """Byte range of the lines with start_secs <= ts - trace start < end_secs."""
+        with open(self.f, 'rb') as fb:
+            lo = self._offset_of(fb, self.start_ts + start_secs)
+            hi = self.total if end_secs is None else self._offset_of(fb, self.start_ts + end_secs)
+        return lo, max(lo, hi)
+
+
+# Ranges are this size at most, so the parent holds a few of them at a time.
+RANGE_BYTES = 64 << 20
+
+
+def _trace_ncols(f, byte_range=None):
+    """Number of fields on the first data line of f (or byte_range of it), or None."""
+    with open(f, 'rb') as fb:
+        fb.seek(byte_range[0] if byte_range else 0)
+        for line in fb:
+            if not line.startswith(b'#') and line.strip():
+                return len(line.decode().rstrip("\n").split(" "))
+    return None
+
+
+def _parse_lines(data):
+    """Line-by-line version of _parse_line_range, for ranges np.loadtxt rejects."""
+    keys, ts, ints = [], [], []
+    for line in data.split("\n"):
+        if not line or line.startswith('#'):
+            continue
+        parts = line.split(" ")
+        try:
+            if len(parts) < 8:
+                raise IndexError
+            row = [int(parts[1]), int(parts[2])] + [int(p) for p in parts[4:8]]
+            row.append(int(parts[8]) if len(parts) >= 9 else 1)
+            ts_ = float(parts[3])
+        except (ValueError, IndexError):
+            print("Error in parsing line ", line, parts)
+            continue
+        keys.append(parts[0])
+        ts.append(ts_)
+        ints.append(row)
+    return np.array(keys, dtype=str), np.array(ts, dtype=np.float64), np.array(ints, dtype=np.int64).reshape(-1, 7)
+
+
+def _parse_line_range(job):
+    """
+    Parses one byte range of a trace with at least 8 fields into columns:
+    keys, ts, and the integer fields (offset, size, op, the three feature
+    fields, repeat) with NumPy's text parser. Repeat defaults to 1.
+    """
+    f, lo, hi, ncols = job
+    with open(f, 'rb') as fb:
+        fb.seek(lo)
+        data = fb.read(hi - lo).decode()
+    usecols = list(range(min(ncols, 9)))
+    dtype = [('offset', np.int64), ('size', np.int64), ('ts', np.float64), ('ints', np.int64, (len(usecols) - 4,))]
+    try:
+        with warnings.catch_warnings():
+            # Ranges with only comments are fine.
+            warnings.simplefilter('ignore', UserWarning)
+            keys = np.loadtxt(io.StringIO(data), dtype=str, delimiter=' ', usecols=0, ndmin=1)
+            cols = np.loadtxt(io.StringIO(data), dtype=dtype, delimiter=' ', usecols=usecols[1:], ndmin=1)
+    except ValueError:
+        return _parse_lines(data)
+    if ncols == 8:
+        # usecols hides lines that also have a repeat field; count separators.
+        comment_spaces = sum(line.count(" ") for line in re.findall(r'^#.*$', data, re.M))
+        if data.count(" ") - comment_spaces != 7 * len(cols):
+            return _parse_lines(data)
+    ints = np.ones((len(cols), 7), dtype=np.int64)
+    ints[:, 0] = cols['offset']
+    ints[:, 1] = cols['size']
+    ints[:, 2:2 + cols['ints'].shape[1]] = cols['ints']
+    return keys, cols['ts'], ints
+
+
+def _imap_ahead(pool, fn, jobs, ahead):
+    """Ordered pool.imap that keeps at most `ahead` results outstanding."""
+    jobs = iter(jobs)
+    pending = collections.deque(pool.apply_async(fn, (job,)) for job in itertools.islice(jobs, ahead))
+    while pending:
+        result = pending.popleft().get()
+        pending.extend(pool.apply_async(fn, (job,)) for job in itertools.islice(jobs, 1))
+        yield result
+
+
+def stream_processed_file_parallel(f, get_features=True, only_gets=True, only_puts=False,
+                                   with_pipeline=None, assert_monotonic=True,
+                                   min_ts_from_start=None,
+                                   max_ts_from_start=None,
+                                   stats=None, processes=None, collapse_repeats=False,
+                                   byte_range=None):
+    """
+    Same output as stream_processed_file, but parses in parallel.
+
+    The trace is split at line boundaries into byte ranges of at most
+    RANGE_BYTES, and worker processes parse each one into NumPy columns.
+    Ranges come back in order, at most `processes` ahead of the consumer, so
+    memory stays bounded as with the line reader. Within a range, logical
+    timestamps are a stable sort on ts after expanding repeats; repeats that
+    spill past a range's last line are held over, like the line reader's heap.
+
+    With one process, inside a Pool worker (which cannot have children), or
+    for traces with fewer than 8 fields, this is stream_processed_file.
+    """
+    if with_pipeline is None:
+        with_pipeline = trace_has_pipeline(f)
+    if stats is None:
+        stats = {}
+    kwargs = dict(get_features=get_features, only_gets=only_gets, only_puts=only_puts,
+                  with_pipeline=with_pipeline, assert_monotonic=assert_monotonic,
+                  min_ts_from_start=min_ts_from_start, max_ts_from_start=max_ts_from_start,
+                  collapse_repeats=collapse_repeats, byte_range=byte_range)
+    processes = processes or os.cpu_count()
+    ncols = _trace_ncols(f, byte_range=byte_range)
+    if processes <= 1 or multiprocessing.current_process().daemon or ncols is None or ncols < 8:
+        yield from stream_processed_file(f, stats=stats, **kwargs)
+        return
+    lo, hi = byte_range or (0, os.path.getsize(f))
+    num_ranges = max(processes, -(-(hi - lo) // RANGE_BYTES))
+    jobs = [(f, lo_, hi_, ncols) for lo_, hi_ in _split_line_ranges(f, num_ranges, byte_range=byte_range)]
+    print(f"Reading from file {f} ({len(jobs)} ranges, {processes} processes)")
+    stats.update(start_ts=None, end_ts=None, max_key=None,
+                 total_iops=0, total_iops_get=0, total_iops_put=0)
+    valid_ops = [o.value for o in OpType]
+    get_ops = [o.value for o in GET_OPS]
+    put_ops = [o.value for o in PUT_OPS]
+    last_ts = None
+    line_base = 0
+    ts_logical = 0
+    # Repeats not yet released, as (ts, line, key, row, count, repeat), in order.
+    held = []
+    # Repeats share one KeyFeatures, as in the line reader.
+    feats = {}
+
+    def release(t, line_i, k, row, n, repeat):
+        nonlocal ts_logical
+        if line_i in feats:
+            feat, left = feats[line_i]
+        else:
+            # Expanded repeats count down from `repeat`; a collapsed access is alone.
+            feat, left = None, repeat // n
+            if get_features and with_pipeline:
+                feat = KeyFeatures(op=row[2], pipeline=row[3], namespace=row[4], user=row[5], offset=row[0], size=row[1], repeat=n)
+            elif get_features:
+                feat = KeyFeatures(op=row[2], namespace=row[3], user=row[4], offset=row[0], size=row[1], repeat=n)
+        if left > 1:
+            feats[line_i] = (feat, left - 1)
+        else:
+            feats.pop(line_i, None)
+        acc = BlkAccess(row[0], row[1], t, features=feat, block=k, ts_logical=ts_logical)
+        ts_logical += n
+        if stats['max_key'] is None or k > stats['max_key'][0]:
+            stats['max_key'] = (k, acc)
+        return k, acc
+
+    with multiprocessing.Pool(processes) as pool:
+        for keys, ts, ints in _imap_ahead(pool, _parse_line_range, jobs, processes):
+            nonzero = ints[:, 1] != 0
+            if stats['start_ts'] is None and nonzero.any():
+                stats['start_ts'] = float(ts[nonzero][0])
+            start_ts = stats['start_ts']
+            stop = False
+            if max_ts_from_start and start_ts is not None:
+                over = np.flatnonzero(nonzero & (ts - start_ts > max_ts_from_start))
+                if len(over):
+                    # The line reader stops at this line, after counting its ts.
+                    stop = True
+                    keys, ts, ints, nonzero = keys[:over[0] + 1], ts[:over[0] + 1], ints[:over[0] + 1], nonzero[:over[0] + 1]
+            op, repeat = ints[:, 2], ints[:, 6]
+            for line_i in np.flatnonzero(~nonzero):
+                print(f"ERROR! 0-sized IO: {keys[line_i]}")
+            mask = nonzero.copy()
+            if stop:
+                mask[-1] = False
+            valid_ts = ts[nonzero]
+            if len(valid_ts):
+                seen_ts = valid_ts if last_ts is None else np.append(last_ts, valid_ts)
+                backwards = np.flatnonzero(np.diff(seen_ts) < 0)
+                assert len(backwards) == 0, f"last_ts > ts: {seen_ts[backwards[0]]} > {seen_ts[backwards[0]+1]}"
+                last_ts = valid_ts[-1]
+                stats['end_ts'] = float(last_ts)
+            if min_ts_from_start:
+                mask &= ts - start_ts >= min_ts_from_start
+            for line_i in np.flatnonzero(mask & ~np.isin(op, valid_ops)):
+                print("Error in parsing line ", keys[line_i], ints[line_i].tolist())
+            mask &= np.isin(op, valid_ops)
+            is_get = np.isin(op, get_ops)
+            is_put = np.isin(op, put_ops)
+            if only_gets:
+                mask &= is_get
+            if only_puts:
+                mask &= is_put
+
+            lines = np.flatnonzero(mask)
+            if collapse_repeats and get_features:
+                # One access per line, taking up `repeat` logical timestamps.
+                line_of = lines
+                acc_ts = ts[lines]
+                counts = repeat[lines]
+            else:
+                # Expand repeats, spread over the next second.
+                line_of = np.repeat(lines, repeat[lines])
+                rep = repeat[line_of]
+                repeat_i = np.arange(len(line_of)) - np.repeat(np.cumsum(repeat[lines]) - repeat[lines], repeat[lines])
+                interval = np.where(rep == 1, 0, 1. / np.maximum(rep - 1, 1))
+                acc_ts = ts[line_of] + repeat_i * interval
+                counts = np.ones(len(line_of), dtype=np.int64)
+            stats['total_iops'] += int(counts.sum())
+            if get_features:
+                # As in the line reader, which counts by op from the features.
+                stats['total_iops_get'] += int(counts[is_get[line_of]].sum())
+                stats['total_iops_put'] += int(counts[is_put[line_of]].sum())
+
+            order = np.argsort(acc_ts, kind='stable')
+            keys_, rows = keys.tolist(), ints.tolist()
+            accs = ((t, line_base + line_i, keys_[line_i] if with_pipeline else (keys_[line_i], rows[line_i][5]),
+                     rows[line_i], n, rows[line_i][6])
+                    for t, line_i, n in zip(acc_ts[order].tolist(), line_of[order].tolist(), counts[order].tolist()))
+            # Later lines are no earlier than last_ts, so anything up to it is final.
+            held_ = []
+            for acc in heapq.merge(held, accs):
+                if stop or acc[0] <= last_ts:
+                    yield release(*acc)
+                else:
+                    held_.append(acc)
+            held = held_
+            line_base += len(ts)
+            if stop:
+                break
+    for acc in held:
+        yield release(*acc)
+
+
+# read the processed file and return  list of (k, BlkAccess) sorted by access time.
+def read_processed_file_list_accesses(f, **kwargs):
+    stats = {}
+    accesses = list(stream_processed_file(f, stats=stats, **kwargs))
+    return accesses, stats['start_ts'], stats['end_ts']
 
 
 def DEBUG_FLAG_ONECHUNK():
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+"""
+One-pass LRU curves: hit ratios, flash write rate and disk-head time (DT)
+for many cache sizes at once.
+
+Models what simulate_ap runs with --ap acceptall and LRU eviction:
+QueueCache with LRUPolicy admitting every miss, then touching the
+block's resident chunks in chunk order. Since that touch only moves
+chunks still in the cache, a smaller cache is not the top of a single
+LRU stack and chunk stack distances do not reproduce it. Instead, one
+pass over the trace drives a lean replica of the cache per size.
+
+For large traces, --sample-ratio samples blocks by hash (SHARDS-style)
+and scales cache sizes to match.
+"""
+
+import sys
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+from jsonargparse import ArgumentParser
+
+from ..episodic_analysis.episodes import service_time
+from . import utils
+
+
+class LRUReplica(object):
+    """QueueCache + LRUPolicy with an accept-all AP, reduced to the counters."""
+
+    def __init__(self, num_cache_elems):
+        self.cache_size = num_cache_elems
+        self.items = OrderedDict()
+        self.resident = {}
+        self.iops_saved = 0
+        self.chunk_hits = 0
+        self.keys_written = 0
+        self.evictions = 0
+        self.service_time_used = 0
+        self.st_stats = {}
+
+    def _admit(self, key):
+        block_id, chunk_id = key
+        self.items[key] = None
+        self.resident.setdefault(block_id, set()).add(chunk_id)
+        self.keys_written += 1
+        if len(self.items) >= self.cache_size:
+            (evicted_block, evicted_chunk), _ = self.items.popitem(last=False)
+            chunks = self.resident[evicted_block]
+            chunks.discard(evicted_chunk)
+            if not chunks:
+                del self.resident[evicted_block]
+            self.evictions += 1
+
+    def access(self, block_id, acc_chunks, interval):
+        misses = []
+        for chunk_id in acc_chunks:
+            k = (block_id, chunk_id)
+            if k in self.items:
+                self.items.move_to_end(k)
+                self.chunk_hits += 1
+            else:
+                misses.append(chunk_id)
+        if not misses:
+            self.iops_saved += 1
+        for chunk_id in misses:
+            self._admit((block_id, chunk_id))
+        # As in _touch_whole_block.
+        for chunk_id in sorted(self.resident.get(block_id, ())):
+            self.items.move_to_end((block_id, chunk_id))
+        if misses:
+            # As in record_service_time_get: one IO spanning the missed chunks.
+            st = service_time(1, max(misses) - min(misses) + 1)
+            self.service_time_used += st
+            self.st_stats[interval] = self.st_stats.get(interval, 0) + st
+
+
+def run_replicas(accesses, replicas, log_interval):
+    """
+    Reads the trace once, driving every replica. Returns totals shared by
+    all sizes: GET requests and chunks, DT of PUTs per interval, the
+    intervals with accesses, and the trace duration in seconds.
+    """
+    num_gets = chunk_queries = 0
+    put_st = {}
+    intervals = []
+    start_ts = end_ts = None
+    for block_id, acc in accesses:
+        if start_ts is None:
+            start_ts = acc.ts
+        end_ts = acc.ts
+        interval = int((acc.ts - start_ts) // log_interval)
+        if not intervals or intervals[-1] != interval:
+            intervals.append(interval)
+        acc_chunks = acc.chunks()
+        if acc.features.op in utils.PUT_OPS:
+            # PUTs bypass the cache; they only cost DT.
+            put_st[interval] = put_st.get(interval, 0) + service_time(
+                1, len(acc_chunks)
+            )
+            continue
+        num_gets += 1
+        chunk_queries += len(acc_chunks)
+        for replica in replicas:
+            replica.access(block_id, acc_chunks, interval)
+    duration_s = (end_ts or 0) - (start_ts or 0)
+    return num_gets, chunk_queries, put_st, intervals, duration_s
+
+
+def curves(
+    accesses,
+    *,
+    sizes_gb,
+    sample_ratio,
+    log_interval,
+    stats_start,
+):
+    """Metrics per cache size, named as in simulate_ap results."""
+    replicas = [
+        LRUReplica(
+            int(
+                (size_gb * 1024 * 1024 * 1024 * sample_ratio / 100)
+                // utils.BlkAccess.ALIGNMENT
+            )
+        )
+        for size_gb in sizes_gb
+    ]
+    num_gets, chunk_queries, put_st, intervals, duration_s = run_replicas(
+        accesses, replicas, log_interval
+    )
+    st_orig = service_time(num_gets, chunk_queries)
+    # Stats are logged once per interval with accesses, as in _checkpoint.
+    intervals_skip = int(stats_start // log_interval)
+    st_stats_puts = np.array([put_st.get(i, 0) for i in intervals])
+
+    rows = []
+    for size_gb, replica in zip(sizes_gb, replicas):
+        st_stats = np.array([replica.st_stats.get(i, 0) for i in intervals])
+        st_with_put = st_stats + st_stats_puts
+        if len(st_with_put) > intervals_skip + 1:
+            st_with_put = st_with_put[intervals_skip:]
+        rows.append(
+            {
+                "SizeGB": size_gb,
+                "NumCacheElems": replica.cache_size,
+                "IOPSSavedRatio": utils.safe_div(replica.iops_saved, num_gets),
+                "ChunkHitRatio": utils.safe_div(replica.chunk_hits, chunk_queries),
+                "FlashWriteRate": utils.mb_per_sec(
+                    replica.keys_written, duration_s, sample_ratio
+                ),
+                "NumCacheEviction": replica.evictions,
+                "ServiceTimeSavedRatio1": 1.0
+                - utils.safe_div(replica.service_time_used, st_orig),
+                "PeakServiceTimeUsedWithPut1": max(st_with_put, default=0),
+                "P50ServiceTimeUsedWithPut1": (
+                    np.percentile(st_with_put, 50) if len(st_with_put) else 0
+                ),
+            }
+        )
+    return pd.DataFrame(rows)
+
+
+def get_parser():
+    parser = ArgumentParser(description="One-pass LRU curves over cache sizes")
+    parser.add_argument("-t", "--trace", required=True)
+    parser.add_argument(
+        "--sizes-gb",
+        type=float,
+        nargs="+",
+        default=[25, 50, 100, 200, 400, 800],
+        help="Cache sizes in GB (at full scale, as --size_gb in simulate_ap)",
+    )
+    parser.add_argument(
+        "--sample-ratio",
+        type=float,
+        help="Sample blocks (in %%) from the trace, SHARDS-style",
+    )
+    parser.add_argument("--sample-seed", type=int, default=1)
+    parser.add_argument("--log-interval", default=600.0, type=float)
+    parser.add_argument("--stats-start", default=24 * 3600, type=float)
+    parser.add_argument("-o", "--output", help="CSV file for the curves")
+    return parser
+
+
+def main(options):
+    tracefile = options.trace
+    input_file_name = tracefile[: -len(".trace")].split("/")[-1]
+    region = tracefile[: -len(".trace")].split("/")[-3]
+    trace_sample_ratio = float(input_file_name.split("_")[-1])
+    sample_ratio = options.sample_ratio or trace_sample_ratio
+    trace_kwargs = dict(
+        region=region,
+        sample_ratio=trace_sample_ratio,
+        start=float(input_file_name.split("_")[-2]),
+        only_gets=False,
+    )
+    if sample_ratio != trace_sample_ratio:
+        assert (
+            sample_ratio < trace_sample_ratio
+        ), f"Cannot sample {sample_ratio}% from a {trace_sample_ratio}% trace"
+        trace_kwargs["subsample_ratio"] = sample_ratio
+        trace_kwargs["sample_seed"] = options.sample_seed
+    _, accesses = utils.stream_processed_accesses(
+        tracefile, input_file_name=input_file_name, **trace_kwargs
+    )
+    df = curves(
+        accesses,
+        sizes_gb=options.sizes_gb,
+        sample_ratio=sample_ratio,
+        log_interval=options.log_interval,
+        stats_start=options.stats_start,
+    )
+    print(df.to_string(index=False))
+    if options.output:
+        df.to_csv(options.output, index=False)
+    return df
+
+
+if __name__ == "__main__":
+    main(get_parser().parse_args(sys.argv[1:]))
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+"""
+Miniature simulations, for ranking configs before launching full runs.
+
+Each miniature runs the real simulator (simulate_cache_driver) with
+--sample-ratio: blocks are sampled by hash as the trace streams, and the
+cache is scaled by the same ratio. Every config is run with several
+sample seeds, i.e. independent block samples, and the spread across seeds
+gives a confidence interval for each metric. Metrics are ones that do not
+depend on the sample ratio, so estimates compare directly to full runs.
+
+    rank:      miniatures of every config, ranked on --metric.
+    calibrate: also runs every config on the full trace, and reports the
+               miniature error per sample ratio, to pick a safe one.
+"""
+
+import contextlib
+import multiprocessing
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import scipy.stats
+from jsonargparse import ArgumentParser
+
+from . import sim_cache, simulate_ap, utils
+
+# Metric -> whether higher is better.
+METRICS = {
+    "IOPSSavedRatio": True,
+    "ChunkHitRatio": True,
+    "ServiceTimeSavedRatio1": True,
+    "FlashWriteRate": False,
+    "PeakServiceTimeUsedWithPutUtil1": False,
+    "P50ServiceTimeWithPutUtil1": False,
+}
+
+
+def config_name(config):
+    """runs/example/ede/config.json -> ede; other files by their stem."""
+    if os.path.basename(config) == "config.json":
+        return os.path.basename(os.path.dirname(os.path.abspath(config)))
+    return os.path.splitext(os.path.basename(config))[0]
+
+
+def _simulate(job):
+    """Runs in a fresh worker process. Returns the metrics of one run."""
+    args = simulate_ap.get_parser().parse_args(job["argv"])
+    args.tracefile = args.trace
+    args.config = [str(x) for x in args.config]
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(
+        devnull
+    ), contextlib.redirect_stderr(devnull):
+        # The driver still logs to its .out and .err files.
+        logjson = sim_cache.simulate_cache_driver(args)
+    return {k: logjson["results"][k] for k in METRICS}
+
+
+def _job(options, config, *, sample_ratio=None, sample_seed=1):
+    argv = [
+        "--config",
+        config,
+        "--trace",
+        options.trace,
+        "--output-dir",
+        os.path.join(options.output_dir, config_name(config)),
+        "--ignore-existing",
+    ]
+    if options.size_gb:
+        argv += ["--size_gb", str(options.size_gb)]
+    if sample_ratio:
+        argv += ["--sample-ratio", str(sample_ratio), "--sample-seed", str(sample_seed)]
+    return dict(
+        argv=argv,
+        config=config_name(config),
+        sample_ratio=sample_ratio,
+        sample_seed=sample_seed,
+    )
+
+
+def load_trace(tracefile):
+    """
+    Materializes the trace cache once, as simulate_sharded does, rather than
+    in every worker: all jobs stream the whole trace and sample blocks from
+    it as they go, so they share one cache file.
+    """
+    # Same trace as simulate_cache_driver asks for.
+    input_file_name = tracefile[: -len(".trace")].split("/")[-1]
+    _, accesses = utils.stream_processed_accesses(
+        tracefile,
+        region=tracefile[: -len(".trace")].split("/")[-3],
+        input_file_name=input_file_name,
+        sample_ratio=float(input_file_name.split("_")[-1]),
+        start=float(input_file_name.split("_")[-2]),
+        only_gets=False,
+    )
+    if hasattr(accesses, "close"):
+        accesses.close()
+
+
+def run_jobs(jobs, processes=None):
+    processes = min(len(jobs), processes or os.cpu_count())
+    print(f"Simulating {len(jobs)} runs ({processes} processes)")
+    # One job per worker, so that each starts with fresh global stats.
+    with multiprocessing.Pool(processes=processes, maxtasksperchild=1) as pool:
+        results = pool.map(_simulate, jobs, chunksize=1)
+    return pd.DataFrame(
+        [
+            dict(
+                Config=job["config"],
+                SampleRatio=job["sample_ratio"],
+                SampleSeed=job["sample_seed"],
+                **res,
+            )
+            for job, res in zip(jobs, results)
+        ]
+    )
+
+
+def estimate(runs, *, confidence=0.95):
+    """Mean and t-interval per config and sample ratio, across seeds."""
+    rows = []
+    for (config, sample_ratio), df in runs.groupby(
+        ["Config", "SampleRatio"], sort=False
+    ):
+        row = {"Config": config, "SampleRatio": sample_ratio, "NumSeeds": len(df)}
+        for k in METRICS:
+            mean = df[k].mean()
+            half = np.nan
+            if len(df) > 1:
+                sem = df[k].std(ddof=1) / np.sqrt(len(df))
+                half = scipy.stats.t.ppf((1 + confidence) / 2, len(df) - 1) * sem
+            row[k] = mean
+            row[f"{k}Lo"] = mean - half
+            row[f"{k}Hi"] = mean + half
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def rank(estimates, metric):
+    """Rank 1 is best. Tied if the config's interval overlaps the one above."""
+    df = estimates.sort_values(metric, ascending=not METRICS[metric])
+    df = df.reset_index(drop=True)
+    df.insert(1, "Rank", np.arange(1, len(df) + 1))
+    df.insert(
+        2,
+        "TiedWithAbove",
+        (df[f"{metric}Lo"] <= df[f"{metric}Hi"].shift())
+        & (df[f"{metric}Hi"] >= df[f"{metric}Lo"].shift()),
+    )
+    return df
+
+
+def calibrate(estimates, full, metric):
+    """Miniature vs full error per sample ratio, and whether the rankings agree."""
+    full = full.set_index("Config")
+    rows = []
+    for sample_ratio, df in estimates.groupby("SampleRatio", sort=False):
+        df = df.set_index("Config")
+        row = {"SampleRatio": sample_ratio}
+        for k in METRICS:
+            rel_err = (df[k] - full[k]).abs() / full[k].abs()
+            covered = (df[f"{k}Lo"] <= full[k]) & (full[k] <= df[f"{k}Hi"])
+            row[f"{k}MaxRelErr"] = rel_err.max()
+            row[f"{k}Coverage"] = covered.mean()
+        row["MaxRelErr"] = max(row[f"{k}MaxRelErr"] for k in METRICS)
+        order = full.index.intersection(df.index)
+        row["RankTau"] = (
+            scipy.stats.kendalltau(df.loc[order, metric], full.loc[order, metric])[0]
+            if len(order) > 1
+            else np.nan
+        )
+        rows.append(row)
+    return pd.DataFrame(rows).sort_values("SampleRatio")
+
+
+def get_parser():
+    parser = ArgumentParser(description="Miniature simulations for ranking configs")
+    parser.add_argument("command", choices=["rank", "calibrate"])
+    parser.add_argument("-t", "--trace", required=True)
+    parser.add_argument(
+        "--configs", nargs="+", required=True, help="simulate_ap config files"
+    )
+    parser.add_argument(
+        "--sample-ratios",
+        type=float,
+        nargs="+",
+        default=[0.01],
+        help="Blocks (in %%) to sample for the miniatures",
+    )
+    parser.add_argument(
+        "--seeds", type=int, default=3, help="Miniatures per config and sample ratio"
+    )
+    parser.add_argument(
+        "--size_gb", type=float, help="Cache size in GB, instead of each config's"
+    )
+    parser.add_argument(
+        "--metric",
+        default="PeakServiceTimeUsedWithPutUtil1",
+        choices=list(METRICS),
+        help="Metric to rank on",
+    )
+    parser.add_argument("--confidence", type=float, default=0.95)
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.05,
+        help="calibrate: largest relative error that counts as safe",
+    )
+    parser.add_argument("--processes", type=int)
+    parser.add_argument("-o", "--output-dir", default="runs/miniature")
+    return parser
+
+
+def main(options):
+    jobs = [
+        _job(options, config, sample_ratio=sample_ratio, sample_seed=seed)
+        for sample_ratio in options.sample_ratios
+        for config in options.configs
+        for seed in range(1, options.seeds + 1)
+    ]
+    if options.command == "calibrate":
+        jobs += [_job(options, config) for config in options.configs]
+    load_trace(options.trace)
+    runs = run_jobs(jobs, processes=options.processes)
+    os.makedirs(options.output_dir, exist_ok=True)
+    runs.to_csv(os.path.join(options.output_dir, "runs.csv"), index=False)
+
+    minis = runs[runs["SampleRatio"].notna()]
+    estimates = estimate(minis, confidence=options.confidence)
+    for sample_ratio, df in estimates.groupby("SampleRatio", sort=False):
+        ranking = rank(df, options.metric)
+        print(f"\nRanking on {options.metric}, {sample_ratio:g}% of blocks:")
+        cols = ["Config", "Rank", "TiedWithAbove"]
+        cols += [f"{options.metric}{s}" for s in ["", "Lo", "Hi"]]
+        cols += [k for k in METRICS if k != options.metric]
+        print(ranking[cols].to_string(index=False))
+        ranking.to_csv(
+            os.path.join(options.output_dir, f"ranking_{sample_ratio:g}.csv"),
+            index=False,
+        )
+
+    if options.command == "calibrate":
+        full = runs[runs["SampleRatio"].isna()]
+        errors = calibrate(estimates, full, options.metric)
+        print("\nMiniature vs full:")
+        print(errors.set_index("SampleRatio").T.to_string())
+        errors.to_csv(os.path.join(options.output_dir, "calibration.csv"), index=False)
+        safe = errors[
+            (errors["MaxRelErr"] <= options.tolerance)
+            & (errors["RankTau"].fillna(1) >= 1)
+        ]
+        if len(safe):
+            print(
+                f"Smallest safe sample ratio: {safe['SampleRatio'].min():g}% "
+                f"(max rel err {options.tolerance:g})"
+            )
+        else:
+            print(f"No sample ratio is within a max rel err of {options.tolerance:g}")
+
+
+if __name__ == "__main__":
+    main(get_parser().parse_args(sys.argv[1:]))
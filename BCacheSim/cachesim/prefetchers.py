@@ -1,4 +1,6 @@
+import collections
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 try:
@@ -12,6 +14,7 @@ from ..episodic_analysis.episodes import offset_to_chunks
 from .ep_helpers import _get_chunks_for_episode
 from .ep_helpers import _prefetchable_chunks
 from .ep_helpers import AccessPlus
+from .ep_helpers import AdmitBuffer
 
 
 class Prefetcher(object):
@@ -67,11 +70,11 @@ class Prefetcher(object):
             in_cache = block_id in self.cache.cached_episodes
             iops_misses = 0
             if in_cache:
-                iops_misses += self.cache.cached_episodes[block_id]["iops_misses"]
+                iops_misses += self.cache.cached_episodes[block_id].iops_misses
             if self.pf_when == 'rejectfirst-either':
                 in_cache = in_cache or block_id in self.ram_cache.cached_episodes
                 if block_id in self.ram_cache.cached_episodes:
-                    iops_misses += self.ram_cache.cached_episodes[block_id]["iops_misses"]
+                    iops_misses += self.ram_cache.cached_episodes[block_id].iops_misses
             if not in_cache:
                 ods.bump("prefetch_rejectfirst_ep_notfound")
                 return False
@@ -127,21 +130,22 @@ class Prefetcher(object):
                 else:
                     chks = range(*episode.chunk_range)
         if metadata_chks is None:
-            metadata_chks = {chk: dict(metadata_init) for chk in chks}
+            # Shared: insert() and AdmitBuffer.add() do not modify it.
+            metadata_chks = {chk: metadata_init for chk in chks}
         return chks, metadata_chks
 
     def filter_existing(self, chks, misses, block_id):
         filtered_chks = []
+        # Chunks of the block in either cache.
+        cached = self.cache.resident.get(block_id, 0)
+        if self.ram_cache:
+            cached |= self.ram_cache.resident.get(block_id, 0)
         for chunk_id in chks:
             if chunk_id in misses:
                 self.insert_cache.bump("prefetches_failed_inmiss")
                 self.insert_cache.prefetches_failed_exists += 1
                 continue
-            k = (block_id, chunk_id)
-
-            ram_cache_found = self.ram_cache and k in self.ram_cache.cache
-            flash_cache_found = k in self.cache.cache
-            if not ram_cache_found and not flash_cache_found:
+            if not cached >> chunk_id & 1:
                 filtered_chks.append(chunk_id)
             else:
                 self.insert_cache.bump("prefetches_failed_exists_incache")
@@ -149,17 +153,12 @@ class Prefetcher(object):
         return filtered_chks
 
     def filter_ap(self, chks, acc, metadata):
-        admit_buffer_ = {}
-        metadata_ = {kk: {} for kk in metadata}
+        admit_buffer_ = AdmitBuffer()
         for chk in chks:
             k = (acc.block_id, chk)
-            admit_buffer_[k] = self.cache.collect_features(k, acc)
-            for kk in metadata[chk]:
-                if kk not in metadata_:
-                    metadata_[kk] = {}
-                metadata_[kk][k] = metadata[chk][kk]
+            admit_buffer_.add(k, self.cache.collect_features(k, acc), metadata[chk])
         need_prefetch = []
-        decisions = self.ap.batchAccept(admit_buffer_, acc.ts, metadata=metadata_, check_only=True)
+        decisions = self.ap.batchAccept(admit_buffer_, acc.ts, metadata=admit_buffer_.metadata(), check_only=True)
         for nkey, dec in decisions.items():
             if dec:
                 need_prefetch.append(nkey[1])
@@ -186,6 +185,58 @@ class Prefetcher(object):
         return need_prefetch
 
 
+def prediction_windows(accesses, size=128):
+    """Groups accesses into windows of `size` GETs, with their prefetch model inputs."""
+    batch, batch_pf = [], []
+    for acc in accesses:
+        batch.append(acc)
+        if acc.is_get:
+            batch_pf.append(acc)
+        if len(batch_pf) >= size:
+            yield batch, batch_pf, np.array([acc_.meta_features(with_size=True) for acc_ in batch_pf])
+            batch, batch_pf = [], []
+    if len(batch) > 0:
+        yield batch, batch_pf, np.array([acc_.meta_features(with_size=True) for acc_ in batch_pf])
+
+
+class PredictionPipeline(object):
+    """
+    Scores prediction windows on a worker thread, keeping at least `lookahead`
+    accesses submitted ahead of the simulation cursor. LightGBM releases the
+    GIL while predicting, so the simulator does not wait on it.
+
+    Windows come out in order, with the same predictions as the inline path.
+    """
+    def __init__(self, model, *, lookahead):
+        self.model = model
+        self.lookahead = lookahead
+
+    def run(self, windows):
+        pending = collections.deque()
+        ahead = 0
+        pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="prefetch-predict")
+        try:
+            for batch, batch_pf, features in windows:
+                future = pool.submit(self.model.predict_window, features) if len(features) > 0 else None
+                pending.append((batch, batch_pf, future))
+                ahead += len(batch)
+                while ahead > self.lookahead:
+                    ahead -= len(pending[0][0])
+                    yield self._collect(*pending.popleft())
+            while pending:
+                yield self._collect(*pending.popleft())
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+    def _collect(self, batch, batch_pf, future):
+        if future is None:
+            return batch, batch_pf, []
+        predictions = future.result()
+        # Stats are bumped here, not on the worker, so that they land in the right interval.
+        self.model.count_window(len(batch_pf))
+        return batch, batch_pf, predictions
+
+
 class PrefetcherModel(object):
     def predict(self, features):
         raise NotImplementedError
@@ -220,21 +271,40 @@ class LearnedRangePrefetcherModel(PrefetcherModel):
         chunk_r = offset_to_chunks(start, end)
         return list(range(*chunk_r)), {"chunk_r": chunk_r}
 
+    @property
+    def all_keys(self):
+        return self.keys
+
     def predict_batch(self, features):
-        preds = {k: self.models[k].predict(features) for k in self.keys}
-        ods.bump("ml_batches", v=len(self.keys))
-        ods.bump("ml_predictions", v=len(features) * len(self.keys))
-        starts = np.maximum(0, preds["offset_start"])
-        ends = np.maximum(0, preds["offset_end"])
-        sizes = np.maximum(0, preds["size"])
-        ends = np.maximum(ends, sizes+starts)
-        starts = [utils.BlkAccess.roundDownToBlockBegin(int(s)) for s in starts]
-        ends = [utils.BlkAccess.roundUpToBlockEnd(int(e)) for e in ends]
-        ranges = list(zip(starts, ends))
-        for s, e in ranges:
-            assert 0 <= s <= e
-        chunks_rs = [offset_to_chunks(start, end)
-                     for start, end in ranges]
+        results = self.predict_window(features)
+        self.count_window(len(features))
+        return results
+
+    def count_window(self, n):
+        ods.bump("ml_batches", v=len(self.all_keys))
+        ods.bump("ml_predictions", v=n * len(self.all_keys))
+
+    def _predict_matrix(self, features, keys):
+        """One column of raw predictions per model, for a whole window."""
+        return np.column_stack([self.models[k].predict(features) for k in keys])
+
+    def predict_window(self, features):
+        """
+        Side-effect free batch prediction, so that it can run off the
+        simulation thread (see PredictionPipeline). Stats are bumped by
+        count_window once the window is consumed.
+        """
+        preds = np.maximum(0, self._predict_matrix(features, self.keys))
+        starts = preds[:, self.keys.index("offset_start")]
+        ends = preds[:, self.keys.index("offset_end")]
+        sizes = preds[:, self.keys.index("size")]
+        ends = np.maximum(ends, sizes + starts)
+        align = utils.BlkAccess.ALIGNMENT
+        # Same as roundDownToBlockBegin / roundUpToBlockEnd, then offset_to_chunks.
+        starts = starts.astype(np.int64) // align * align
+        ends = (ends.astype(np.int64) // align + 1) * align - 1
+        assert np.all((0 <= starts) & (starts <= ends))
+        chunks_rs = zip((starts // align + 1).tolist(), ((ends + 1) // align + 1).tolist())
         return [(list(range(*cr)), {"chunk_r": cr}) for cr in chunks_rs]
 
 
@@ -259,17 +329,15 @@ class LearnedRangeConfPrefetcherModel(LearnedRangePrefetcherModel):
         stats["prob"] = preds["pred_net_pf_st_binary"][0]
         return chunks, stats
 
-    def predict_batch(self, features):
-        results = super().predict_batch(features)
-        xs = []
-        for _, stats in results:
-            xs.append(stats["chunk_r"])
-        features_with_preds = np.append(features, np.array(xs), 1)
-        preds_ = {k: self.models[k].predict(features_with_preds)
-                  for k in self.e_keys}
-        ods.bump("ml_batches", v=len(self.e_keys))
-        ods.bump("ml_predictions", v=len(features) * len(self.e_keys))
-        for i, (_, stats) in enumerate(results):
-            stats["prob"] = preds_["pred_net_pf_st_binary"][i]
+    @property
+    def all_keys(self):
+        return self.keys + self.e_keys
 
+    def predict_window(self, features):
+        results = super().predict_window(features)
+        chunk_rs = np.array([stats["chunk_r"] for _, stats in results])
+        features_with_preds = np.append(features, chunk_rs.reshape(-1, 2), 1)
+        probs = self._predict_matrix(features_with_preds, self.e_keys)
+        for (_, stats), prob in zip(results, probs[:, self.e_keys.index("pred_net_pf_st_binary")]):
+            stats["prob"] = prob
         return results
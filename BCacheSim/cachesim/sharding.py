@@ -0,0 +1,435 @@
+"""Block-sharded parallel simulation (approximate).
+
+Blocks are hash-partitioned across K worker processes. Each shard simulates
+its own cache with 1/K of the capacity and its own admission policy, over the
+accesses to its blocks only. The per-interval stats are summed at the end, so
+peak and percentile DT are computed on the merged series.
+
+This is an approximation: shards cannot borrow capacity from each other, and
+rate-limited APs see 1/K of the write budget each. --shard-validate measures
+how far off this is by also running single-process and sharded simulations
+on a hash-sampled subset of blocks.
+"""
+
+import copy
+import functools
+import multiprocessing
+import operator
+import os
+import sys
+import time
+
+import numpy as np
+
+from . import prefetchers, sim_cache, utils
+from .ep_helpers import Timestamp
+from .utils import ods
+
+# Independent seeds, so that shard membership and the validation sample
+# are uncorrelated.
+SHARD_SEED = 7
+VALIDATION_SEED = 13
+
+# Series that hold timestamps or durations, rather than counts.
+MAX_SERIES = [
+    "time_phy",
+    "time_elapsed_phy",
+    "time_log",
+    "duration",
+    "realtime_elapsed",
+]
+
+# Metrics compared between the sharded and single-process validation runs.
+VALIDATION_METRICS = [
+    "ChunkHitRatio",
+    "IOPSSavedRatio",
+    "FlashWriteRatio",
+    "PeakServiceTime",
+    "P90ServiceTime",
+    "P50ServiceTime",
+]
+
+# Inherited by forked workers instead of being pickled for each one.
+_episodes = None
+
+
+def shard_of(block_id, num_shards):
+    return utils.block_hash(block_id, seed=SHARD_SEED) % num_shards
+
+
+def in_validation_sample(block_id, sample):
+    return utils.block_in_sample(block_id, sample, seed=VALIDATION_SEED)
+
+
+def _shard_filename(results_file, tag):
+    return results_file.replace("_cache_perf.txt", f"_{tag}_cache_perf.txt")
+
+
+def _simulate_shard(job):
+    """Runs in a fresh worker process. Returns the raw ods stats of one shard."""
+    options = job["options"]
+    shard, num_shards, sample = job["shard"], job["num_shards"], job["sample"]
+    sample_ratio = job["sample_ratio"] * sample / num_shards
+    num_cache_elems, ram_cache_elems = job["cache_elems"]
+    num_cache_elems = int(num_cache_elems * sample // num_shards)
+    if ram_cache_elems:
+        ram_cache_elems = ram_cache_elems * sample // num_shards
+
+    ap, prefetcher, cache, ram_cache = sim_cache.build_cache(
+        options,
+        sample_ratio=sample_ratio,
+        num_cache_elems=num_cache_elems,
+        ram_cache_elems=ram_cache_elems,
+        episodes=_episodes,
+    )
+
+    trace_stats, accesses = utils.stream_processed_accesses(
+        job["tracefile"], input_file_name=job["input_file_name"], **job["trace_kwargs"]
+    )
+    accesses = (
+        (block_id, acc)
+        for block_id, acc in accesses
+        if shard_of(block_id, num_shards) == shard
+        and (sample == 1 or in_validation_sample(block_id, sample))
+    )
+
+    logjson = copy.deepcopy(job["logjson"])
+    logjson["sampleRatio"] = sample_ratio
+    logjson["AdmissionPolicy"] = ap.name
+    logjson["results"]["NumCacheElems"] = num_cache_elems
+    if ram_cache_elems:
+        logjson["results"]["NumRamCacheElems"] = ram_cache_elems
+    sdumper = sim_cache.StatsDumper(
+        cache,
+        logjson,
+        options.output_dir,
+        job["results_file"],
+        prefetcher=prefetcher,
+        admission_policy=ap,
+        ram_cache=ram_cache,
+        trace_stats=trace_stats,
+        start_time=time.time(),
+        skip_first_secs=options.stats_start,
+    )
+    lock = utils.LockFile(job["results_file"] + ".lock")
+
+    sim_cache.simulate_cache(
+        cache,
+        accesses,
+        sample_ratio,
+        # Only used for progress estimates.
+        trace_stats["total_iops_get"] * sample / num_shards,
+        trace_stats["total_iops"] * sample / num_shards,
+        trace_stats["trace_duration_secs"],
+        options=options,
+        ram_cache=ram_cache,
+        limit=options.limit,
+        log_interval=options.log_interval,
+        prefetcher=prefetcher,
+        sdumper=sdumper,
+        admit_chunk_threshold=options.ap_chunk_threshold,
+        block_level=options.block_level,
+        lock=lock,
+        start_ts=Timestamp(0, trace_stats["start_ts"]),
+    )
+    lock.delete()
+
+    def ia_totals(cache_):
+        if cache_ is None:
+            return None
+        # Only QueueCache keeps a running total over resident items.
+        resident = getattr(cache_, "resident_max_ia_cum", None)
+        if resident is None:
+            resident = sum(
+                (item.max_interarrival_time for item in cache_.cache.values()),
+                start=Timestamp(0, 0),
+            )
+        num = cache_.max_interarrival_time_cum + resident
+        return num, len(cache_.cache) + cache_.evictions
+
+    return {
+        "counters": ods.counters,
+        "freq": ods.freq,
+        "batches": ods.batches,
+        "ia": ia_totals(cache),
+        "ram_ia": ia_totals(ram_cache),
+        "ap": repr(ap),
+        "ap_name": ap.name,
+        "cache": repr(cache),
+    }
+
+
+def _ffill(series):
+    """ods.append pads skipped intervals with 0; carry the last value instead."""
+    out = []
+    for v in series:
+        out.append(out[-1] if out and v == 0 else v)
+    return out
+
+
+def _pad(series, length, cumulative):
+    fill = series[-1] if cumulative and series else 0
+    return series + [fill] * (length - len(series))
+
+
+def _sum(values):
+    # Timestamp + 0 works, but 0 + Timestamp does not.
+    values = sorted(values, key=lambda v: isinstance(v, int))
+    return functools.reduce(operator.add, values)
+
+
+def merge_stats(shard_stats):
+    """Sums counters, freqs and per-interval series across shards."""
+    counters = {}
+    for stats in shard_stats:
+        for k, v in stats["counters"].items():
+            if k not in counters:
+                counters[k] = v
+            elif k == "start_ts_phy":
+                counters[k] = min(counters[k], v)
+            elif k.endswith("/warmup_finished"):
+                # The cache is warm once every shard is.
+                counters[k] = max(counters[k], v)
+            else:
+                counters[k] = counters[k] + v
+    for k in list(counters):
+        if k.endswith("/warmup_finished") and any(
+            k not in stats["counters"] for stats in shard_stats
+        ):
+            del counters[k]
+
+    freq = {}
+    for stats in shard_stats:
+        for k, vals in stats["freq"].items():
+            merged = freq.setdefault(k, {})
+            for kk, v in vals.items():
+                merged[kk] = merged.get(kk, 0) + v
+
+    num_intervals = max(
+        len(stats["batches"].get("time_phy", [])) for stats in shard_stats
+    )
+    batches = {}
+    for k in set(k for stats in shard_stats for k in stats["batches"]):
+        is_max = k in MAX_SERIES or k.removesuffix("_stats") in MAX_SERIES
+        cumulative = is_max or k.endswith("_stats")
+        series = []
+        for stats in shard_stats:
+            if k not in stats["batches"]:
+                continue
+            s = stats["batches"][k]
+            if cumulative:
+                s = _ffill(s)
+            series.append(_pad(s, num_intervals, cumulative))
+        if is_max:
+            batches[k] = [max(vs) for vs in zip(*series)]
+        else:
+            batches[k] = [_sum(vs) for vs in zip(*series)]
+
+    return {
+        "counters": counters,
+        "freq": freq,
+        "batches": batches,
+        "idx": num_intervals - 1,
+    }
+
+
+def summarize(stats, *, skip_intervals=0):
+    """Sample-ratio independent metrics, for comparing runs on the same blocks."""
+    counters, batches = stats["counters"], stats["batches"]
+    st = np.add(
+        np.diff(batches.get("service_time_used_stats", [0]), prepend=0),
+        np.diff(batches.get("service_time_writes_stats", [0]), prepend=0),
+    )
+    if len(st) > skip_intervals + 1:
+        st = st[skip_intervals:]
+    return {
+        "ChunkHitRatio": utils.safe_div(
+            counters.get("chunk_hits", 0), counters.get("chunk_queries", 0)
+        ),
+        "IOPSSavedRatio": utils.safe_div(
+            counters.get("iops_saved", 0), counters.get("iops_requests", 0)
+        ),
+        "FlashWriteRatio": utils.safe_div(
+            counters.get("flashcache/keys_written", 0),
+            counters.get("chunk_queries", 0),
+        ),
+        "PeakServiceTime": float(np.max(st)),
+        "P90ServiceTime": float(np.percentile(st, 90)),
+        "P50ServiceTime": float(np.percentile(st, 50)),
+    }
+
+
+class MergedCache(object):
+    """Stands in for the per-shard caches when dumping the merged stats."""
+
+    def __init__(self, desc, ia_totals):
+        self.desc = desc
+        # StatsDumper checks this for policy-specific stats.
+        self.cache = None
+        self.ia_num = functools.reduce(
+            operator.add, (num for num, _ in ia_totals), Timestamp(0, 0)
+        )
+        self.ia_den = sum(den for _, den in ia_totals)
+
+    def computeAvgMaxInterarrivalTime(self):
+        return utils.safe_div(self.ia_num, self.ia_den)
+
+    def __repr__(self):
+        return self.desc
+
+
+def simulate_sharded(
+    options,
+    logjson,
+    *,
+    results_file,
+    tracefile,
+    input_file_name,
+    trace_kwargs,
+    sample_ratio,
+    episodes=None,
+    lock=None,
+    start_time=None,
+):
+    global _episodes
+    num_shards = options.shards
+    validate = options.shard_validate
+
+    # Materialize the trace cache once, rather than in every worker.
+    trace_stats, accesses = utils.stream_processed_accesses(
+        tracefile, input_file_name=input_file_name, **trace_kwargs
+    )
+    if hasattr(accesses, "close"):
+        accesses.close()
+    del accesses
+    print(trace_stats)
+    logjson["blkCount"] = trace_stats["max_key"][0]
+    logjson["totalIOPSGet"] = trace_stats["total_iops_get"]
+    logjson["totalIOPS"] = logjson["totalIOPSGet"]
+    logjson["totalIOPSPut"] = trace_stats["total_iops_put"]
+    logjson["traceSeconds"] = trace_stats["trace_duration_secs"]
+
+    cache_elems = sim_cache.get_cache_elems(options, sample_ratio)
+    job = dict(
+        options=options,
+        tracefile=tracefile,
+        input_file_name=input_file_name,
+        trace_kwargs=trace_kwargs,
+        sample_ratio=sample_ratio,
+        cache_elems=cache_elems,
+        logjson=logjson,
+    )
+    jobs = []
+    for i in range(num_shards):
+        tag = f"shard{i}of{num_shards}"
+        jobs.append(
+            dict(
+                job,
+                shard=i,
+                num_shards=num_shards,
+                sample=1,
+                results_file=_shard_filename(results_file, tag),
+            )
+        )
+    if validate:
+        for i in range(num_shards):
+            tag = f"validate{validate:g}_shard{i}of{num_shards}"
+            jobs.append(
+                dict(
+                    job,
+                    shard=i,
+                    num_shards=num_shards,
+                    sample=validate,
+                    results_file=_shard_filename(results_file, tag),
+                )
+            )
+        jobs.append(
+            dict(
+                job,
+                shard=0,
+                num_shards=1,
+                sample=validate,
+                results_file=_shard_filename(
+                    results_file, f"validate{validate:g}_single"
+                ),
+            )
+        )
+
+    _episodes = episodes
+    processes = min(len(jobs), os.cpu_count())
+    print(f"Simulating {num_shards} shards ({len(jobs)} jobs, {processes} processes)")
+    # One job per worker, so that each starts with fresh global stats.
+    with multiprocessing.Pool(processes=processes, maxtasksperchild=1) as pool:
+        pending = pool.map_async(_simulate_shard, jobs, chunksize=1)
+        while not pending.ready():
+            if lock:
+                lock.touch()
+            pending.wait(60)
+        results = pending.get()
+    _episodes = None
+
+    for job_ in jobs:
+        utils.rm_missing_ok(job_["results_file"] + ".part")
+        utils.rm_missing_ok(job_["results_file"] + ".part.lzma")
+        utils.rm_missing_ok(job_["results_file"] + ".stats.part.lzma")
+
+    shard_results = results[:num_shards]
+    merged = merge_stats(shard_results)
+    ods.counters = merged["counters"]
+    ods.freq = merged["freq"]
+    ods.batches = merged["batches"]
+    ods.idx = merged["idx"]
+
+    logjson["AdmissionPolicy"] = shard_results[0]["ap_name"]
+    logjson["results"]["NumCacheElems"] = cache_elems[0]
+    logjson["results"]["NumShards"] = num_shards
+    logjson["results"]["NumCacheElemsPerShard"] = cache_elems[0] // num_shards
+    if options.ram_cache:
+        logjson["results"]["NumRamCacheElems"] = cache_elems[1]
+
+    if validate:
+        skip_intervals = int(options.stats_start // options.log_interval)
+        single = summarize(results[-1], skip_intervals=skip_intervals)
+        sharded = summarize(
+            merge_stats(results[num_shards:-1]), skip_intervals=skip_intervals
+        )
+        divergence = {}
+        print(f"Shard validation on {validate:g} of blocks ({num_shards} shards vs 1):")
+        for k in VALIDATION_METRICS:
+            rel_err = utils.safe_div(abs(sharded[k] - single[k]), abs(single[k]))
+            divergence[k] = {
+                "single": single[k],
+                "sharded": sharded[k],
+                "relErr": rel_err,
+            }
+            print(
+                f"    {k:<16} - {single[k]:.5g} vs {sharded[k]:.5g} ({rel_err * 100:.2f}%)"
+            )
+        logjson["shardValidation"] = {"sample": validate, "metrics": divergence}
+        logjson["results"]["ShardMaxRelErr"] = max(
+            v["relErr"] for v in divergence.values()
+        )
+
+    ram_cache = None
+    if options.ram_cache:
+        ram_cache = MergedCache(
+            f"{num_shards} shards", [r["ram_ia"] for r in shard_results]
+        )
+    sdumper = sim_cache.StatsDumper(
+        MergedCache(
+            f"{num_shards} shards x {shard_results[0]['cache']}",
+            [r["ia"] for r in shard_results],
+        ),
+        logjson,
+        options.output_dir,
+        results_file,
+        prefetcher=prefetchers.Prefetcher(options=options),
+        admission_policy=f"{num_shards} shards x {shard_results[0]['ap']}",
+        ram_cache=ram_cache,
+        trace_stats=trace_stats,
+        start_time=start_time,
+        skip_first_secs=options.stats_start,
+    )
+    dump_stats = "--fast" not in sys.argv or options.log_interval >= 600
+    sdumper.dump(None, verbose=True, suffix=".lzma", dump_stats=dump_stats)
+    return logjson
@@ -1,11 +1,14 @@
 import copy
 import gc
+import heapq
 import json
+import math
 import os
 import pickle
 import pprint
 import random
 import sys
+import threading
 import time
 import traceback
 from collections import defaultdict
@@ -19,10 +22,13 @@ from . import admission_policies as aps
 from . import dynamic_features as dyn_features
 from . import eviction_policies as evictp
 from . import prefetchers, utils
+from .convergence import EarlyStopper
 from .ep_helpers import (
     AccessPlus,
+    SpacedTimestamps,
     Timestamp,
     _lookup_episode,
+    chunk_mask,
     record_service_time_get,
     record_service_time_put,
 )
@@ -40,6 +46,10 @@ CACHE_LOCATIONS = {
     "_ram": "Ram",
 }
 
+# Chunks of a whole block, numbered as in BlkAccess.chunks(); exclusive range.
+BLOCK_CHUNK_RANGE = (1, utils.BlkAccess.MAX_BLOCK_SIZE // utils.BlkAccess.ALIGNMENT + 1)
+BLOCK_CHUNK_MASK = chunk_mask(BLOCK_CHUNK_RANGE)
+
 
 class StatsDumper(object):
     def __init__(
@@ -67,11 +77,29 @@ class StatsDumper(object):
         self.skip_first_secs = skip_first_secs
         self.df_analysis = None
         self.admission_policy = admission_policy
+        self.writer_pid = None
         analysis_filename = os.path.join(output_dir, "df_analysis.csv")
         if os.path.exists(analysis_filename):
             self.df_analysis = pd.read_csv(analysis_filename)
 
-    def dump(self, stats_, *, suffix="", verbose=False, dump_stats=False):
+    def wait(self):
+        """Waits for the background writer of the previous dump, if any."""
+        if self.writer_pid is None:
+            return
+        _, status = os.waitpid(self.writer_pid, 0)
+        self.writer_pid = None
+        if os.waitstatus_to_exitcode(status) != 0:
+            print("Warning: background stats dump failed", file=sys.stderr)
+
+    def dump(
+        self,
+        stats_,
+        *,
+        suffix="",
+        verbose=False,
+        dump_stats=False,
+        background=False,
+    ):
         logjson = self.logjson
         trace_duration_secs = logjson["traceSeconds"]
         sample_ratio = logjson["sampleRatio"]
@@ -195,6 +223,17 @@ class StatsDumper(object):
             logjson["results"][label + "NumCacheEviction"] = ods.get(
                 f"{cache_ns}/evictions"
             )
+            if isinstance(getattr(cache, "cache", None), evictp.EDEPolicy):
+                ghost = cache.cache.ewma_states
+                logjson["results"][label + "EDEGhostCapacity"] = ghost.capacity
+                logjson["results"][label + "EDEGhostKeys"] = len(ghost)
+                logjson["results"][label + "EDEGhostForgotten"] = ghost.forgotten
+            logjson["results"][label + "AdmitFlushes"] = ods.get(
+                f"{cache_ns}/admit_flushes"
+            )
+            logjson["results"][label + "AvgAdmitBatchSize"] = utils.safe_div(
+                ods.get(f"{cache_ns}/ap.called"), ods.get(f"{cache_ns}/admit_flushes")
+            )
             logjson["results"][label + "MeanTimeInSystem"] = utils.safe_div(
                 ods.get(f"{cache_ns}/total_time_in_system"),
                 ods.get(f"{cache_ns}/keys_written"),
@@ -716,6 +755,9 @@ class StatsDumper(object):
             "flashcache/episodes_admitted2"
         )
 
+        logjson["results"]["TenantPromotions"] = ods.get("tenants/promotions")
+        logjson["results"]["TenantDemotions"] = ods.get("tenants/demotions")
+
         logjson["results"]["EvictionAvgTTL"] = utils.safe_div(
             ods.get("flashcache/total_ttl"), chunks_written
         )
@@ -947,15 +989,33 @@ class StatsDumper(object):
         if verbose:
             print(msg, file=sys.stderr)
 
-        logjson_ = utils.stringify_keys(copy.deepcopy(logjson))
         os.makedirs(self.output_dir, 0o755, exist_ok=True)
+        dumps = []
         if dump_stats:
-            # TODO: Check how long this call is taking
-            statsjson_ = utils.stringify_keys(copy.deepcopy(statsjson))
-            dump_logjson(statsjson_, self.filename + ".stats" + suffix, verbose=verbose)
-
+            dumps.append((statsjson, self.filename + ".stats" + suffix))
         # Dump this last because manager will think it is complete once it sees this
-        dump_logjson(logjson_, self.filename + suffix, verbose=verbose)
+        dumps.append((logjson, self.filename + suffix))
+
+        # At most one dump in flight, so files are replaced in order.
+        self.wait()
+        # Forking with other threads alive (e.g. PredictionPipeline's) can
+        # leave the child holding their locks; write in place instead.
+        if background and hasattr(os, "fork") and threading.active_count() == 1:
+            # The forked writer sees a copy-on-write snapshot of the stats,
+            # so serialization and compression happen off the simulation loop.
+            pid = os.fork()
+            if pid == 0:
+                code = 1
+                try:
+                    write_dumps(dumps, verbose=verbose)
+                    code = 0
+                except Exception:
+                    traceback.print_exc()
+                finally:
+                    os._exit(code)
+            self.writer_pid = pid
+        else:
+            write_dumps(dumps, verbose=verbose)
 
         if verbose:
             print("Command:")
@@ -964,12 +1024,25 @@ class StatsDumper(object):
         return self.filename + suffix
 
 
+def write_dumps(dumps, verbose=False):
+    for json_, filename in dumps:
+        json_ = utils.stringify_keys(copy.deepcopy(json_))
+        dump_logjson(json_, filename, verbose=verbose)
+
+
 def dump_logjson(json_, filename, verbose=False):
+    # Write to a temporary file first, so that readers never see a partial file.
+    tmp_filename = os.path.join(
+        os.path.dirname(filename), f".{os.path.basename(filename)}.{os.getpid()}.tmp"
+    )
     if filename.endswith(".lzma"):
-        compress_json.dump(json_, filename, json_kwargs=dict(indent=2))
+        compress_json.dump(
+            json_, tmp_filename, compression="lzma", json_kwargs=dict(indent=2)
+        )
     else:
-        with open(filename, "w+") as out:
+        with open(tmp_filename, "w+") as out:
             json.dump(json_, out, indent=2)
+    os.replace(tmp_filename, filename)
     if verbose:
         print(f"Results written to {filename}", file=sys.stderr)
 
@@ -1029,6 +1102,16 @@ class CacheSimulator(object):
         self.config = kwargs
         assert not self.config.get("block_level", False)
         self._init_logs()
+        self.early_stopper = None
+        if options is not None and options.early_stop:
+            self.early_stopper = EarlyStopper(
+                options.early_stop,
+                skip_intervals=int(options.stats_start // self.config["log_interval"]),
+                min_intervals=options.early_stop_min_intervals,
+            )
+        self.tenants = utils.TopKTenants(
+            options.tenant_top_k if options is not None else 0
+        )
         self.hooks = defaultdict(list)
         if hasattr(cache.ap, "hooks"):
             for k, v in cache.ap.hooks.items():
@@ -1524,7 +1607,10 @@ class CacheSimulator(object):
             if self.sdumper and save:
                 # Only dump stats on the first one (to check it works)
                 self.sdumper.dump(
-                    None, suffix=".part.lzma", dump_stats=self.last_print["time"] == 0
+                    None,
+                    suffix=".part.lzma",
+                    dump_stats=self.last_print["time"] == 0,
+                    background=True,
                 )
 
             # Put this after dump because dumping is slow
@@ -1544,6 +1630,8 @@ class CacheSimulator(object):
             ods.get("service_time_nocache_stats")
         )
         ods.idx = int((acc_ts - self.start_ts).physical // self.config["log_interval"])
+        if self.early_stopper:
+            self.early_stopper.update(acc_ts.physical)
 
     def _touch_lockfile(self):
         self.config["lock"].touch()
@@ -1557,8 +1645,9 @@ class CacheSimulator(object):
             self.last_log_tracetime = acc_ts
 
         if self.start_ts is None:
-            self.start_ts = acc_ts
-            ods.counters["start_ts_phy"] = acc_ts.physical
+            # Shards pass in the trace start so that their intervals line up.
+            self.start_ts = self.config.get("start_ts") or acc_ts
+            ods.counters["start_ts_phy"] = self.start_ts.physical
 
         if time.time() - self.last_syscheck >= 60 * 2:
             self._syscheck()
@@ -1566,7 +1655,7 @@ class CacheSimulator(object):
         # stats management
         # TODO: Make boundaries more exact, to account for empty intervals.
         # Buckets should be x[timestamp / interval]++
-        curr_i = int((acc_ts - self.start_ts).physical // self.config["log_interval"])
+        curr_i = self._interval(acc_ts)
         # dur = (acc_ts - self.last_log_tracetime).physical
         # if dur > self.config['log_interval']:
         if curr_i != ods.idx:
@@ -1576,26 +1665,34 @@ class CacheSimulator(object):
                 or time.time() - self.last_print["time"] > self.print_every_n_mins * 60,
             )
 
-    def _prefetch_batch(self, batch_pf, batch):
-        features = np.array([acc_.features.toList(with_size=True) for acc_ in batch_pf])
-        if len(features) > 0:
-            predictions = self.cache.prefetcher.predict_batch(features)
-            for acc_, pred in zip(batch_pf, predictions):
-                acc_.pred_prefetch = pred
+    def _interval(self, acc_ts):
+        """Index of the stats interval that acc_ts falls in."""
+        return int((acc_ts - self.start_ts).physical // self.config["log_interval"])
+
+    def _prefetch_batch(self, batch_pf, batch, predictions):
+        for acc_, pred in zip(batch_pf, predictions):
+            acc_.pred_prefetch = pred
         return batch
 
     def _add_prefetch_predictions(self, acc_iterable):
-        batch = []
-        batch_pf = []
-        for acc_ in acc_iterable:
-            batch.append(acc_)
-            if acc_.is_get:
-                batch_pf.append(acc_)
-            if len(batch_pf) >= 128:
-                yield from self._prefetch_batch(batch_pf, batch)
-                batch, batch_pf = [], []
-        if len(batch) > 0:
-            yield from self._prefetch_batch(batch_pf, batch)
+        model = self.cache.prefetcher
+        windows = prefetchers.prediction_windows(acc_iterable, size=128)
+        lookahead = self.options.prefetch_lookahead if self.options is not None else 0
+        if lookahead > 0:
+            windows = prefetchers.PredictionPipeline(model, lookahead=lookahead).run(
+                windows
+            )
+        else:
+            windows = (
+                (
+                    batch,
+                    batch_pf,
+                    model.predict_batch(features) if len(features) else [],
+                )
+                for batch, batch_pf, features in windows
+            )
+        for batch, batch_pf, predictions in windows:
+            yield from self._prefetch_batch(batch_pf, batch, predictions)
 
     def _get_chunk_range(self, access):
         """
@@ -1723,45 +1820,64 @@ class CacheSimulator(object):
             # REQUIRES: episode
             size = episode.size / utils.BlkAccess.ALIGNMENT
             if block_id in cache.cached_episodes:
-                size -= len(cache.cached_episodes[block_id]["active_chunks"])
+                size -= cache.cached_episodes[block_id].num_active_chunks()
             size *= utils.BlkAccess.ALIGNMENT
             size /= 4 * 1024 * 1024
         return size
 
     def _touch_whole_block(self, acc):
-        prefetch_size = utils.BlkAccess.MAX_BLOCK_SIZE
-        acc_ = utils.BlkAccess(0, prefetch_size, acc.ts.physical, block=acc.block_id)
-        chks = acc_.chunks()
-        for chunk_id in chks:
+        if "--log-req" not in sys.argv:
+            # Only resident chunks change; see QueueCache.touch_block.
+            for cache in (self.ram_cache, self.cache):
+                if cache:
+                    cache.touch_block(acc.block_id, acc.ts, BLOCK_CHUNK_RANGE)
+            return
+        for chunk_id in range(*BLOCK_CHUNK_RANGE):
             k = (acc.block_id, chunk_id)
             _ = self.ram_cache and self.ram_cache.find(k, acc.ts, count_as_hit=False)
             _ = self.cache.find(k, acc.ts, count_as_hit=False)
 
-    def _update_dynamic_features(self, acc):
+    def _flush_admit_buffers(self, ts):
+        self.insert_cache.flush_admit_buffer(ts)
+        # Behind a RAM cache, flash is filled by RAM evictions and otherwise
+        # only flushes when full, as before; deferred admission also flushes
+        # it by age. RAM goes first: its flush can evict into flash.
+        if self.ram_cache and self.cache.deferred_admission:
+            self.cache.flush_admit_buffer(ts)
+
+    def _update_dynamic_features(self, acc, timestamps=None):
+        """Updates for acc, or for accesses like it at each of timestamps."""
         cache = self.cache
         # update dynamic features (independent of in the cache)
         if cache.dynamic_features:
+
+            def update(key, weight=1):
+                if timestamps is None:
+                    cache.dynamic_features.updateFeatures(
+                        key, acc.ts.physical, weight=weight
+                    )
+                else:
+                    cache.dynamic_features.updateFeaturesMany(
+                        key, timestamps.physical, weight=weight
+                    )
+
             granularity = cache.dynamic_features.granularity
             if granularity.startswith("block"):
                 weight = 1
                 if granularity == "block-st":
                     weight = service_time(1, len(acc.chunks))
-                cache.dynamic_features.updateFeatures(
-                    acc.block_id, acc.ts.physical, weight=weight
-                )
+                update(acc.block_id, weight=weight)
             elif granularity == "chunk":
                 for chunk_id in acc.chunks:
-                    k = (acc.block_id, chunk_id)
-                    cache.dynamic_features.updateFeatures(k, acc.ts.physical)
+                    update((acc.block_id, chunk_id))
             elif granularity == "both":
-                cache.dynamic_features.updateFeatures(acc.block_id, acc.ts.physical)
+                update(acc.block_id)
                 for chunk_id in acc.chunks:
-                    k = (acc.block_id, chunk_id)
-                    cache.dynamic_features.updateFeatures(k, acc.ts.physical)
+                    update((acc.block_id, chunk_id))
             else:
                 raise Exception(f"Unknown granularity: {granularity}")
 
-    def _log_st(self, need_fetch, need_prefetch, all_chunks_hit, acc):
+    def _log_st(self, need_fetch, need_prefetch, all_chunks_hit, acc, tenants=None):
         acc_chunks = acc.chunks
         ods.bump("iops_requests")
         ods.bump("chunk_queries", len(acc_chunks))
@@ -1773,7 +1889,8 @@ class CacheSimulator(object):
             service_time(1, len(acc_chunks)),
         )
 
-        tags = [f"ns/{acc.features.namespace}", f"user/{acc.features.user}"]
+        tenants = tenants or self.tenants.labels(acc)
+        tags = [f"ns/{tenants[0]}", f"user/{tenants[1]}"]
         for tag in tags:
             ods.bump(["iops_requests", tag])
             ods.bump(["chunk_queries", tag], len(acc_chunks))
@@ -1785,9 +1902,9 @@ class CacheSimulator(object):
             assert len(need_prefetch) == 0 and all_chunks_hit
         else:
             assert not all_chunks_hit
-            record_service_time_get(need_fetch, need_prefetch, acc)
+            record_service_time_get(need_fetch, need_prefetch, acc, tenants)
 
-    def run_get(self, acc):
+    def run_get(self, acc, tenants=None):
         cache = self.cache
         ram_cache = self.ram_cache
         insert_cache = self.insert_cache
@@ -1837,6 +1954,8 @@ class CacheSimulator(object):
             acc_chunks,
             acc.block_id,
         )
+        # Nothing to admit: a repeat right after this changes only timestamps.
+        settled = all_chunks_hit and not misses
 
         episode = _lookup_episode(
             cache.episodes, acc.block_id, acc.ts, prune_old="--debug" in sys.argv
@@ -1869,7 +1988,10 @@ class CacheSimulator(object):
 
         for chunk_id in misses:
             k = (acc.block_id, chunk_id)
-            metadata = dict(metadata_init)
+            # insert() does not modify metadata, so only copy it to override.
+            metadata = metadata_init
+            if chunk_id in promotions or (episode and episode.chunk_level):
+                metadata = dict(metadata_init)
             if chunk_id in promotions:
                 metadata["promotion"] = 1
             # TODO: Fix this hack.
@@ -1885,8 +2007,7 @@ class CacheSimulator(object):
             featvec = insert_cache.collect_features(k, acc)
             insert_cache.insert(k, acc.ts, featvec, metadata=metadata)
 
-        # TODO: Make this a flag.
-        insert_cache.process_admit_buffer(acc.ts)
+        self._flush_admit_buffers(acc.ts)
 
         # TODO: Make this a flag.
         # To touch chunks from the same block and hopefully avoid readmissions
@@ -1899,14 +2020,223 @@ class CacheSimulator(object):
         need_prefetch = self.prefetcher.run(
             acc, all_chunks_hit, any_chunk_hit, episode, misses, size
         )
-        insert_cache.process_admit_buffer(acc.ts)  # TODO: Make this a flag.
+        self._flush_admit_buffers(acc.ts)
         # END PREFETCHING
 
-        self._log_st(need_fetch, need_prefetch, all_chunks_hit, acc)
+        self._log_st(need_fetch, need_prefetch, all_chunks_hit, acc, tenants)
 
         # Trigger event handler for prefetching.
         # TODO: Review and possibly deprecate.
         cache.on_access_end(acc.ts, groups=groups, access=acc.acc)
+        return settled
+
+    def _closed_form_repeats_ok(self):
+        """Whether settled repeats only touch state that _replay_hits covers."""
+        caches = [c for c in (self.cache, self.ram_cache) if c]
+        return (
+            all(
+                isinstance(c, evictp.QueueCache)
+                and (not c.lru or c.cache.idempotent_touch)
+                and not c.deferred_admission
+                for c in caches
+            )
+            and self.cache.episodes is None
+            and not self.cache.early_evict
+            and self.cache.evict_by != "episode"
+            and not any(self.hooks.values())
+            and "--log-req" not in sys.argv
+        )
+
+    def _with_repeats(self, accesses, runs=False):
+        """
+        Adds the follow-ups of collapsed accesses (features.repeat = N),
+        1/(N-1)s apart, where the expanded trace has them: by timestamp, and
+        before later accesses with the same one. Yields (acc, repeat), with
+        repeat the state shared by the follow-ups of one access (None for
+        accesses from the trace). Logical timestamps count the follow-ups.
+
+        With runs, the follow-ups of a GET that come in a row (with nothing
+        else in between) are yielded once, as the first of them, with
+        repeat["run"] = (access, r, count): follow-ups r to r + count - 1.
+        """
+        pending = []
+        logical = 0
+        collapsed = False
+
+        def next_run(bound):
+            nonlocal logical
+            _, i, r, parent, repeat = heapq.heappop(pending)
+            n = parent.features.repeat
+            end = r + 1
+            if runs and parent.is_get:
+                # Binary search for the last follow-up before the next
+                # pending one and the next access (at bound).
+                def in_run(e):
+                    ts = self._repeat_ts(parent, e)
+                    return ts <= bound and (not pending or (ts, i, e) < pending[0][:3])
+
+                lo, hi = r, n - 1
+                while lo < hi:
+                    mid = (lo + hi + 1) // 2
+                    if in_run(mid):
+                        lo = mid
+                    else:
+                        hi = mid - 1
+                end = lo + 1
+            repeat["run"] = (parent, r, end - r)
+            follow_up = self._repeat_of(parent, r, logical)
+            logical += end - r
+            if end < n:
+                heapq.heappush(
+                    pending, (self._repeat_ts(parent, end), i, end, parent, repeat)
+                )
+            return follow_up, repeat
+
+        for i, acc in enumerate(accesses):
+            while pending and pending[0][0] <= acc.ts.physical:
+                yield next_run(acc.ts.physical)
+            n = acc.features.repeat
+            collapsed = collapsed or n > 1
+            if collapsed:
+                acc.ts = Timestamp(logical=logical, physical=acc.ts.physical)
+                acc.acc.ts_logical = logical
+            logical += 1
+            yield acc, None
+            if n == 1:
+                continue
+            repeat = {"items": None, "replay": None, "run": None}
+            heapq.heappush(pending, (self._repeat_ts(acc, 1), i, 1, acc, repeat))
+        while pending:
+            yield next_run(math.inf)
+
+    @staticmethod
+    def _repeat_ts(acc, r):
+        """Physical time of the r-th follow-up of acc."""
+        return acc.ts.physical + r * (1.0 / (acc.features.repeat - 1))
+
+    def _repeat_of(self, acc, r, logical):
+        """The r-th follow-up of an access with features.repeat > 1."""
+        follow_up = utils.BlkAccess(
+            acc.acc.orig_offset,
+            acc.acc.orig_endoffset - acc.acc.orig_offset + 1,
+            self._repeat_ts(acc, r),
+            features=acc.features,
+            block=acc.acc.block,
+            ts_logical=logical,
+        )
+        follow_up = AccessPlus(acc.block_id, follow_up)
+        follow_up.pred_prefetch = acc.pred_prefetch
+        return follow_up
+
+    def _chunk_items(self, acc):
+        """
+        The RAM and flash items of acc's chunks: None if not resident, True
+        if in the admit buffer (which hits are logged by).
+        """
+        items = []
+        for cache in (self.ram_cache, self.cache):
+            if not cache:
+                continue
+            for chunk_id in acc.chunks:
+                k = (acc.block_id, chunk_id)
+                if k in cache.cache:
+                    items.append(cache.cache[k])
+                else:
+                    items.append(k in cache.admit_buffer or None)
+        return items
+
+    def _run_repeats(self, follow_up, repeat):
+        """
+        A run of GET follow-ups of a collapsed access (see _with_repeats),
+        starting with follow_up.
+
+        Once a follow-up settles (see run_get), the next one that finds the
+        same items does exactly the same, apart from timestamps: it is run
+        to record its stats, and later ones that still find those items
+        (and get the same tenant labels) are applied by _replay_hits, all
+        those left in the stats interval (and keeping their labels) at once.
+        Returns the last follow-up run, or the one the early stopper
+        converged at.
+        """
+        parent, r, count = repeat["run"]
+        step = 1.0 / (parent.features.repeat - 1)
+        logical = follow_up.ts.logical
+        done = 0
+        while True:
+            tenants = self.tenants.labels(follow_up)
+            items = self._chunk_items(follow_up)
+
+            def same(recorded):
+                return recorded is not None and all(
+                    a is b for a, b in zip(recorded, items)
+                )
+
+            replay = repeat["replay"]
+            if replay and replay[0] == tenants and same(replay[1]):
+                n = min(count - done, 1 + self.tenants.stable(follow_up))
+                # Binary search for the last one in follow_up's interval.
+                interval = self._interval(follow_up.ts)
+                lo, hi = 1, n
+                while lo < hi:
+                    mid = (lo + hi + 1) // 2
+                    ts = Timestamp(0, self._repeat_ts(parent, r + done + mid - 1))
+                    if self._interval(ts) == interval:
+                        lo = mid
+                    else:
+                        hi = mid - 1
+                n = lo
+                if n > 1:
+                    self.tenants.labels(follow_up, n=n - 1)
+                timestamps = SpacedTimestamps(
+                    logical + done, parent.ts.physical, step, r + done, n
+                )
+                self._replay_hits(follow_up, replay[2], timestamps)
+                done += n
+            else:
+                if same(repeat["items"]):
+                    with ods.recording() as calls:
+                        settled = self.run_get(follow_up, tenants)
+                    repeat["replay"] = (
+                        (tenants, items, ods.totals(calls)) if settled else None
+                    )
+                else:
+                    settled = self.run_get(follow_up, tenants)
+                repeat["items"] = items if settled else None
+                done += 1
+            if done == count:
+                return self._repeat_of(parent, r + done - 1, logical + done - 1)
+            follow_up = self._repeat_of(parent, r + done, logical + done)
+            self._stats(follow_up.ts)
+            if self.early_stopper and self.early_stopper.converged:
+                return follow_up
+
+    def _replay_hits(self, follow_up, totals, timestamps):
+        """
+        Applies settled follow-ups like follow_up at each of timestamps
+        without re-running them, in one step: `totals` (the stats of one)
+        are repeated, and hits and touches go straight to the items.
+        """
+        ods.replay(totals, len(timestamps))
+        self.cache.rec_episodes(follow_up.block_id, True, True, timestamps)
+        self._update_dynamic_features(follow_up, timestamps)
+        # As in run_get: RAM hits only check flash.
+        ram_mask = 0
+        if self.ram_cache:
+            ram_mask = self.ram_cache.resident.get(follow_up.block_id, 0)
+        for chunk_id in follow_up.chunks:
+            k = (follow_up.block_id, chunk_id)
+            if ram_mask >> chunk_id & 1:
+                self.ram_cache.replay_finds(k, timestamps)
+            else:
+                self.cache.replay_finds(k, timestamps)
+        # As in _touch_whole_block.
+        for cache in (self.ram_cache, self.cache):
+            if not cache:
+                continue
+            for chunk_id in cache.resident_chunks(follow_up.block_id, BLOCK_CHUNK_MASK):
+                cache.replay_finds(
+                    (follow_up.block_id, chunk_id), timestamps, count_as_hit=False
+                )
 
     def run_put(self, acc):
         if acc.chunk_range[0] != 0:
@@ -1915,7 +2245,7 @@ class CacheSimulator(object):
             ods.bump("warning_put_notfirst")
             if self.cache.block_counts[acc.block_id] > 0:
                 ods.bump("warning_put_already_in_cache")
-        record_service_time_put(acc)
+        record_service_time_put(acc, self.tenants.labels(acc))
 
     def run(self, accesses, total_iops_get, total_iops, total_secs):
         self.realtime_start = time.time()
@@ -1924,6 +2254,7 @@ class CacheSimulator(object):
         self.total_secs = total_secs
 
         accesses = (AccessPlus(*args) for args in accesses)
+        self.closed_form_repeats = self._closed_form_repeats_ok()
 
         if (
             self.cache.prefetch_range == "acctime-episode-predict"
@@ -1931,10 +2262,22 @@ class CacheSimulator(object):
         ):
             accesses = self._add_prefetch_predictions(accesses)
 
-        for acc in accesses:
+        stopped_early = False
+        for acc, repeat in self._with_repeats(
+            accesses, runs=self.closed_form_repeats
+        ):
             self._stats(acc.ts)
+            if self.early_stopper and self.early_stopper.converged:
+                # The last checkpoint closed the final interval.
+                stopped_early = True
+                break
             try:
-                if acc.is_get:
+                if acc.is_get and repeat and self.closed_form_repeats:
+                    acc = self._run_repeats(acc, repeat)
+                    if self.early_stopper and self.early_stopper.converged:
+                        stopped_early = True
+                        break
+                elif acc.is_get:
                     self.run_get(acc)
                 elif acc.is_put:
                     self.run_put(acc)
@@ -1945,7 +2288,27 @@ class CacheSimulator(object):
                 print(f"Access to block {acc.block_id} at TS={acc.ts}, {acc.acc}")
                 raise
 
-        self._checkpoint(acc.ts, print_log=True, save=False)
+        # Deferred admission can leave chunks in the buffers, RAM's first.
+        for cache in (self.ram_cache, self.cache):
+            if cache and cache.deferred_admission:
+                cache.process_admit_buffer(acc.ts)
+        if not stopped_early:
+            self._checkpoint(acc.ts, print_log=True, save=False)
+        if self.early_stopper:
+            results = self.early_stopper.results(stopped_early)
+            results["EarlyStopGetsFraction"] = utils.safe_div(
+                ods.get("iops_requests"), self.total_iops_get
+            )
+            self.sdumper.logjson["results"].update(results)
+            if stopped_early:
+                print(
+                    f"Stopped early after {results['EarlyStopIntervals']} intervals"
+                    f" ({results['EarlyStopGetsFraction'] * 100:.1f}% of GETs),"
+                    f" max rel err {results['EarlyStopMaxRelErr']:.4f}"
+                )
+
+        # Callers remove the partial dumps once the run is complete.
+        self.sdumper.wait()
 
 
 def simulate_cache(
@@ -1967,6 +2330,90 @@ def simulate_cache(
     # return csim.stats
 
 
+def get_cache_elems(options, sample_ratio):
+    """Returns (flash, RAM) cache sizes in chunks, scaled by the sample ratio."""
+    if options.cache_elems:
+        num_cache_elems = options.cache_elems
+    else:
+        num_cache_elems = (
+            options.size_gb * 1024 * 1024 * 1024 * sample_ratio / 100
+        ) // utils.BlkAccess.ALIGNMENT
+    num_cache_elems = int(num_cache_elems)
+
+    ram_cache_elems = None
+    if options.ram_cache:
+        if options.ram_cache_elems:
+            ram_cache_elems = options.ram_cache_elems
+        else:
+            ram_cache_elems = (
+                options.ram_cache_size_gb * 1024 * 1024 * 1024 * sample_ratio / 100
+            ) // utils.BlkAccess.ALIGNMENT
+    return num_cache_elems, ram_cache_elems
+
+
+def build_cache(
+    options, *, sample_ratio, num_cache_elems, ram_cache_elems=None, episodes=None
+):
+    """Constructs the AP, prefetcher and flash (+ optional RAM) cache."""
+    use_lru = not (options.fifo or options.lirs)
+    ap = aps.construct(
+        options.ap,
+        options,
+        sample_ratio=sample_ratio,
+        num_cache_elems=num_cache_elems,
+        episodes=episodes,
+    )
+
+    prefetcher = prefetchers.Prefetcher(options=options)
+
+    if options.learned_ap_granularity is None:
+        options.learned_ap_granularity = (
+            "block" if options.prefetch_when != "never" else "chunk"
+        )
+    dfeat = dyn_features.DynamicFeatures(
+        options.learned_ap_filter_count, granularity=options.learned_ap_granularity
+    )
+
+    if options.lirs:
+        cache = evictp.LIRSCache(None, num_cache_elems, 1.0, ap)
+    else:
+        cache = evictp.QueueCache(
+            None,
+            num_cache_elems,
+            ap,
+            lru=use_lru,
+            dynamic_features=dfeat,
+            options=options,
+            batch_size=options.batch_size,
+            episodes=episodes,
+            evict_by="episode" if options.evict_by_episode else "chunk",
+            prefetch_when=options.prefetch_when,
+            prefetch_range=options.prefetch_range,
+            prefetcher=prefetcher.model,
+        )
+
+    ram_cache = None
+    if options.ram_cache:
+        ram_ap = ap if options.ram_ap_clone else aps.AcceptAll()
+        ram_cache = evictp.QueueCache(
+            None,
+            ram_cache_elems,
+            ram_ap,
+            lru=True,
+            dynamic_features=dfeat,
+            options=options,  # TODO: Check for side-effecfts
+            episodes=episodes,
+            keep_metadata=True,
+            on_evict=cache.handle_miss,
+            namespace="ramcache",
+        )
+
+    prefetcher.set_cache(
+        cache=cache, ram_cache=ram_cache, insert_cache=ram_cache, ap=ap
+    )
+    return ap, prefetcher, cache, ram_cache
+
+
 def simulate_cache_driver(options) -> dict | None:
     start_time = time.time()
     print(pprint.pformat(options.as_dict()), flush=True)
@@ -1997,7 +2444,31 @@ def simulate_cache_driver(options) -> dict | None:
     os.makedirs(output_dir, 0o755, exist_ok=True)
 
     input_file_name = tracefile[: -len(".trace")].split("/")[-1]
-    out_prefix = f"{output_dir}/{input_file_name}"
+    # TODO: These should be read from config
+    trace_sample_ratio = float(input_file_name.split("_")[-1])
+    sample_ratio = trace_sample_ratio
+    output_name = input_file_name
+    if options.sample_ratio and options.sample_ratio != trace_sample_ratio:
+        assert options.sample_ratio < trace_sample_ratio, (
+            f"Cannot sample {options.sample_ratio}% from a {trace_sample_ratio}% trace"
+        )
+        # Spatial sampling of blocks as the trace is streamed.
+        sample_ratio = options.sample_ratio
+        name_parts = input_file_name.split("_")
+        if options.sample_seed != 1:
+            name_parts[0] += f"-seed{options.sample_seed}"
+        output_name = "_".join(name_parts[:-1] + [f"{sample_ratio:g}"])
+    if options.window_start is not None:
+        # Stats cover the window; the warmup before it only fills the cache.
+        options.stats_start = options.warmup_secs
+        name_parts = output_name.split("_")
+        name_parts[0] += f"-win{options.window_start:g}"
+        if options.window_secs:
+            name_parts[0] += f"+{options.window_secs:g}"
+        if options.warmup_secs:
+            name_parts[0] += f"-warm{options.warmup_secs:g}"
+        output_name = "_".join(name_parts)
+    out_prefix = f"{output_dir}/{output_name}"
     # TODO: Make this be an argument
     # if "dt_per_byte_score" in options:
     if "--dt-per-byte-score" in sys.argv:
@@ -2011,6 +2482,10 @@ def simulate_cache_driver(options) -> dict | None:
     # elif "ede_alpha_tti" in options:
     elif "--ede-alpha-tti" in sys.argv:
         results_file = out_prefix + f"_ewma_{options.ede_alpha_tti}" + "_cache_perf.txt"
+    elif "--ede-ghost-factor" in sys.argv:
+        results_file = (
+            out_prefix + f"_ghost_{options.ede_ghost_factor:g}" + "_cache_perf.txt"
+        )
     else:
         results_file = out_prefix + "_cache_perf.txt"
     lock = utils.LockFile(out_prefix + ".lock", timeout=600)
@@ -2053,9 +2528,7 @@ def simulate_cache_driver(options) -> dict | None:
     sys.stderr = utils.CopyStream(sys.stderr, out_prefix + ".err")
     print(f"Logging to {out_prefix}.out")
 
-    # TODO: These should be read from config
     region = tracefile[: -len(".trace")].split("/")[-3]
-    sample_ratio = float(input_file_name.split("_")[-1])
     sample_start = float(input_file_name.split("_")[-2])
 
     # output is formatted as json from the following dict
@@ -2072,24 +2545,37 @@ def simulate_cache_driver(options) -> dict | None:
         logjson["EvictionPolicy"] = "LRU"
 
     trace_kwargs = dict(
-        region=region, sample_ratio=sample_ratio, start=sample_start, only_gets=False
+        region=region,
+        sample_ratio=trace_sample_ratio,
+        start=sample_start,
+        only_gets=False,
     )
+    if sample_ratio != trace_sample_ratio:
+        trace_kwargs["subsample_ratio"] = sample_ratio
+        trace_kwargs["sample_seed"] = options.sample_seed
+    if options.collapse_repeats:
+        trace_kwargs["collapse_repeats"] = True
+    if options.window_start is not None:
+        assert (
+            options.warmup_secs <= options.window_start
+        ), "Warmup window starts before the trace"
+        window_end = None
+        if options.window_secs:
+            window_end = options.window_start + options.window_secs
+        trace_kwargs["byte_range"] = utils.TraceTimeIndex(tracefile).byte_range(
+            options.window_start - options.warmup_secs, window_end
+        )
 
     logjson["sampleRatio"] = sample_ratio
     # TODO: Phase out sampling ratio.
     logjson["samplingRatio"] = sample_ratio
     logjson["sampleStart"] = sample_start
+    logjson["traceSampleRatio"] = trace_sample_ratio
     logjson["trace_kwargs"] = trace_kwargs
 
     logjson["results"] = {}
 
-    if options.cache_elems:
-        num_cache_elems = options.cache_elems
-    else:
-        num_cache_elems = (
-            options.size_gb * 1024 * 1024 * 1024 * sample_ratio / 100
-        ) // utils.BlkAccess.ALIGNMENT
-    num_cache_elems = int(num_cache_elems)
+    num_cache_elems, ram_cache_elems = get_cache_elems(options, sample_ratio)
 
     episodes = None
     if options.offline_ap_decisions:
@@ -2114,70 +2600,38 @@ def simulate_cache_driver(options) -> dict | None:
                     utils.rm_missing_ok(options.offline_ap_decisions)
                 raise
 
-    ap = aps.construct(
-        options.ap,
+    if options.shards > 1:
+        assert not options.early_stop, "Shards would stop at different points"
+        # Imported here as sharding builds on this module.
+        from . import sharding
+
+        sharding.simulate_sharded(
+            options,
+            logjson,
+            results_file=results_file,
+            tracefile=tracefile,
+            input_file_name=input_file_name,
+            trace_kwargs=trace_kwargs,
+            sample_ratio=sample_ratio,
+            episodes=episodes,
+            lock=lock,
+            start_time=start_time,
+        )
+        lock.delete()
+        utils.rm_missing_ok(lock.filename)
+        print("Complete")
+        return logjson
+
+    ap, prefetcher, cache, ram_cache = build_cache(
         options,
         sample_ratio=sample_ratio,
         num_cache_elems=num_cache_elems,
+        ram_cache_elems=ram_cache_elems,
         episodes=episodes,
     )
 
     logjson["AdmissionPolicy"] = ap.name
 
-    prefetcher = prefetchers.Prefetcher(options=options)
-
-    if options.learned_ap_granularity is None:
-        options.learned_ap_granularity = (
-            "block" if options.prefetch_when != "never" else "chunk"
-        )
-    dfeat = dyn_features.DynamicFeatures(
-        options.learned_ap_filter_count, granularity=options.learned_ap_granularity
-    )
-
-    if options.lirs:
-        cache = evictp.LIRSCache(None, num_cache_elems, 1.0, ap)
-    else:
-        cache = evictp.QueueCache(
-            None,
-            num_cache_elems,
-            ap,
-            lru=use_lru,
-            dynamic_features=dfeat,
-            options=options,
-            batch_size=options.batch_size,
-            episodes=episodes,
-            evict_by="episode" if options.evict_by_episode else "chunk",
-            prefetch_when=options.prefetch_when,
-            prefetch_range=options.prefetch_range,
-            prefetcher=prefetcher.model,
-        )
-
-    ram_cache = None
-    if options.ram_cache:
-        if options.ram_cache_elems:
-            ram_cache_elems = options.ram_cache_elems
-        else:
-            ram_cache_elems = (
-                options.ram_cache_size_gb * 1024 * 1024 * 1024 * sample_ratio / 100
-            ) // utils.BlkAccess.ALIGNMENT
-        ram_ap = ap if options.ram_ap_clone else aps.AcceptAll()
-        ram_cache = evictp.QueueCache(
-            None,
-            ram_cache_elems,
-            ram_ap,
-            lru=True,
-            dynamic_features=dfeat,
-            options=options,  # TODO: Check for side-effecfts
-            episodes=episodes,
-            keep_metadata=True,
-            on_evict=cache.handle_miss,
-            namespace="ramcache",
-        )
-
-    prefetcher.set_cache(
-        cache=cache, ram_cache=ram_cache, insert_cache=ram_cache, ap=ap
-    )
-
     if options.cachelib_trace:
 
         def stream_cachelib_trace(filename):
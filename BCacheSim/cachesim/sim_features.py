@@ -18,20 +18,23 @@ def count_feat(feat_subset):
     return cnt
 
 
-def collect_features(cache, key, acc):
-    block_id, chunk_id = key
+def _request_parts(cache, acc, block_id):
+    """
+    Feature vector segments for one request, in feature order. Request- and
+    block-level segments are lists; None marks the per-chunk dfeat segment.
+    """
     features = cache.ap.features.split('+')
-    featvec = []
+    parts = []
     for feat_idx in features:
         if feat_idx == 'meta':
-            featvec.extend(acc.features.toList(with_size=True))
+            parts.append(acc.meta_features(with_size=True))
         elif feat_idx == 'meta_nosize':
-            featvec.extend(acc.features.toList(with_size=False))
+            parts.append(acc.meta_features(with_size=False))
         elif feat_idx == 'dfeat':
-            featvec.extend(cache.dynamic_features.getFeature(key))
+            parts.append(None)
         elif feat_idx == 'block':
             assert cache.dynamic_features.granularity.startswith('block') or cache.dynamic_features.granularity == 'both'
-            featvec.extend(cache.dynamic_features.getFeature(block_id))
+            parts.append(cache.dynamic_features.getFeature(block_id))
         elif feat_idx == 'chunk':
             assert cache.dynamic_features.granularity == 'both'
             cfeat = np.zeros(cache.dynamic_features.hours, dtype=int)
@@ -40,9 +43,9 @@ def collect_features(cache, key, acc):
             # For chunk, do we iterate over all chunks in block or just current access?
             for chunk_id_ in acc.chunks:
                 cfeat += cache.dynamic_features.getFeature((block_id, chunk_id_))
-            featvec.extend(cfeat.tolist())
+            parts.append(cfeat.tolist())
         elif feat_idx == 'shard':
-            featvec.append(key[0][1])
+            parts.append([block_id[1]])
         elif feat_idx == 'chunk_ind':
             raise NotImplementedError('chunk_ind')
             # for chunk_id_ in range(1, 65):
@@ -51,7 +54,50 @@ def collect_features(cache, key, acc):
             pass
         else:
             raise NotImplementedError(feat_idx)
-    return featvec
+    return parts
+
+
+class FeatureContext(object):
+    """
+    Feature vectors of one request for one cache. Every consumer in run_get
+    (AP filtering of prefetches, insertion of misses and prefetches) asks
+    here, so the request- and block-level segments are computed once and
+    only dfeat is looked up per chunk. Recomputed if the dynamic features
+    change in between (run_get updates them after inserting misses).
+    """
+    def __init__(self, cache, acc):
+        self.cache = cache
+        self.acc = acc
+        self.version = None
+        self.parts = None
+        self.rows = {}
+
+    def _current_version(self):
+        dynamic_features = self.cache.dynamic_features
+        return dynamic_features.version if dynamic_features else None
+
+    def get(self, key):
+        version = self._current_version()
+        if self.parts is None or version != self.version:
+            self.parts = _request_parts(self.cache, self.acc, key[0])
+            self.version = version
+            self.rows.clear()
+        if key not in self.rows:
+            featvec = []
+            for part in self.parts:
+                if part is None:
+                    part = self.cache.dynamic_features.getFeature(key)
+                featvec.extend(part)
+            self.rows[key] = featvec
+        return self.rows[key]
+
+
+def collect_features(cache, key, acc):
+    """Feature vector of key for request acc; shared within the request."""
+    ctx = acc.feature_contexts.get(cache.namespace)
+    if ctx is None:
+        ctx = acc.feature_contexts[cache.namespace] = FeatureContext(cache, acc)
+    return ctx.get(key)
     # if self.dynamic_features:
     #     self.admit_buffer[key] = self.dynamic_features.getFeature(key)
     #     # self.admit_buffer[key].append(
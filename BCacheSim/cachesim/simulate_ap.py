@@ -40,6 +40,17 @@ def get_parser():
         "--ram-ap-clone", action="store_true", help="Have same RAM AP as flash"
     )
     parser.add_argument("--batch-size", default=512, type=int, help="Batchsize for GBM")
+    parser.add_argument(
+        "--admit-flush",
+        default="access",
+        choices=["access", "deferred"],
+        help="Flush the admit buffer after every access, or only when it holds --batch-size chunks (or at --admit-flush-secs)",
+    )
+    parser.add_argument(
+        "--admit-flush-secs",
+        type=float,
+        help="With --admit-flush deferred: also flush once the oldest buffered chunk is this old (trace seconds)",
+    )
     parser.add_argument(
         "--offline-ap",
         help="Simulate with a offline admission policy",
@@ -130,6 +141,12 @@ def get_parser():
         "--prefetcher-model-path",
         help="Set the file that stores the prefetch policy's model",
     )
+    parser.add_argument(
+        "--prefetch-lookahead",
+        type=int,
+        default=1024,
+        help="Run prefetch model inference this many accesses ahead of the simulation, on a worker thread (0: inline)",
+    )
     parser.add_argument("--early-evict", help="Early eviction decisions")
     parser.add_argument("--prefetch", help="Prefetch (early admission)")
     parser.add_argument(
@@ -158,7 +175,64 @@ def get_parser():
     parser.add_argument("--log-req", action="store_true", help="Log requests")
     parser.add_argument("--log-prefetch", action="store_true", help="Log prefetchs")
     parser.add_argument("--fast", action="store_true", help="Fast (skips things)")
+    parser.add_argument(
+        "--sample-ratio",
+        type=float,
+        help="Sample blocks (in %%) from the trace at load time, instead of a pre-sampled trace",
+    )
+    parser.add_argument(
+        "--sample-seed", type=int, default=1, help="Seed for --sample-ratio"
+    )
+    parser.add_argument(
+        "--window-start",
+        type=float,
+        help="Simulate from this many seconds into the trace, seeking via a sidecar time index",
+    )
+    parser.add_argument(
+        "--window-secs",
+        type=float,
+        help="With --window-start: length of the window (default: to the end)",
+    )
+    parser.add_argument(
+        "--warmup-secs",
+        type=float,
+        default=0,
+        help="With --window-start: also simulate this long before the window, without stats (replaces --stats-start)",
+    )
+    parser.add_argument(
+        "--collapse-repeats",
+        action="store_true",
+        help="Read repeated accesses as one, and apply settled follow-ups in bulk where the caches allow (queue caches without episodes, hooks, early eviction or deferred admission); elsewhere each follow-up is run",
+    )
+    parser.add_argument(
+        "--shards",
+        type=int,
+        default=1,
+        help="Approximate: hash-partition blocks over this many processes",
+    )
+    parser.add_argument(
+        "--shard-validate",
+        type=float,
+        help="Fraction of blocks to compare sharded vs single-process runs on",
+    )
 
+    parser.add_argument(
+        "--early-stop",
+        type=float,
+        help="Stop once the post-warmup hit ratio, write rate and P50/P90 DT are within this relative error (95%% CI)",
+    )
+    parser.add_argument(
+        "--early-stop-min-intervals",
+        type=int,
+        default=36,
+        help="Log intervals after warmup before --early-stop can stop",
+    )
+    parser.add_argument(
+        "--tenant-top-k",
+        type=int,
+        default=0,
+        help="Keep per-namespace and per-user stats for this many of each, the rest as 'other' (0: all)",
+    )
     parser.add_argument(
         "--limit", type=float, help="Process at most this fraction of total IOPS"
     )
@@ -211,6 +285,12 @@ def get_parser():
         default=0.2,
         help="EWMA smoothing factor for time-to-idle updates (0.0-1.0)",
     )
+    parser.add_argument(
+        "--ede-ghost-factor",
+        type=float,
+        default=0,
+        help="EDE keeps time-to-idle history for this many times the cache size in keys (0: unbounded)",
+    )
     return parser
 
 
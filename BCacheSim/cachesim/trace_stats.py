@@ -0,0 +1,416 @@
+#!/usr/bin/env python3
+"""
+Trace characterization in one vectorized pass: op mix, access sizes, block
+popularity, interarrival times and working set over time.
+
+The trace is parsed into NumPy columns (as in stream_processed_file_parallel)
+and every statistic is computed on the columns, with no per-access Python
+objects. Parsed columns are cached as .npz in /tmp, and a cached .npz can
+be given in place of the trace. Working sets per window are estimated with
+HyperLogLog sketches, which merge across windows for the cumulative curve.
+
+Output is a small JSON file (compressed if it ends in .lzma). load() reads
+it back with the per-window and per-rank tables as DataFrames.
+"""
+
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+
+import compress_json
+import numpy as np
+import pandas as pd
+from jsonargparse import ArgumentParser
+
+from . import legacy_utils
+from .legacy_utils import GET_OPS, PUT_OPS, BlkAccess, OpType
+
+COLUMNS = ["block", "ts", "offset", "size", "op", "namespace", "user", "repeat"]
+QUANTILES = [0.01, 0.05, 0.1, 0.25, 0.5, 0.75, 0.9, 0.95, 0.99]
+
+
+def _cache_filename(tracefile):
+    filehash = subprocess.check_output(f"md5sum {tracefile}", shell=True).split()[0]
+    name = os.path.basename(tracefile)[: -len(".trace")]
+    return f"/tmp/trace-columns-{name}_{filehash[-6:].decode()}.npz"
+
+
+def _parse_columns(tracefile, processes=None):
+    with_pipeline = legacy_utils.trace_has_pipeline(tracefile)
+    ncols = legacy_utils._trace_ncols(tracefile)
+    if ncols is None or ncols < 8:
+        return _read_columns_by_line(tracefile)
+    processes = processes or os.cpu_count()
+    jobs = [
+        (tracefile, lo, hi, ncols)
+        for lo, hi in legacy_utils._split_line_ranges(tracefile, processes)
+    ]
+    # Pool workers cannot have children.
+    if len(jobs) > 1 and not multiprocessing.current_process().daemon:
+        with multiprocessing.Pool(len(jobs)) as pool:
+            parsed = pool.map(legacy_utils._parse_line_range, jobs)
+    else:
+        parsed = [legacy_utils._parse_line_range(job) for job in jobs]
+    keys = np.concatenate([p[0] for p in parsed])
+    ts = np.concatenate([p[1] for p in parsed])
+    ints = np.concatenate([p[2] for p in parsed])
+    del parsed
+    # Integer columns: offset, size, op, then pipeline, namespace, user or
+    # namespace, user, hostname, then repeat.
+    if with_pipeline:
+        block = pd.factorize(keys)[0]
+        namespace, user = ints[:, 4], ints[:, 5]
+    else:
+        block = pd.MultiIndex.from_arrays([keys, ints[:, 5]]).factorize()[0]
+        namespace, user = ints[:, 3], ints[:, 4]
+    repeat = ints[:, 6]
+    cols = dict(
+        block=block,
+        ts=ts,
+        offset=ints[:, 0],
+        size=ints[:, 1],
+        op=ints[:, 2],
+        namespace=namespace,
+        user=user,
+        repeat=repeat,
+    )
+    keep = cols["size"] != 0
+    return {k: v[keep] for k, v in cols.items()}
+
+
+def _read_columns_by_line(tracefile):
+    """Fallback for traces that are not uniformly formatted."""
+    rows = []
+    blocks = {}
+    for k, acc in legacy_utils.stream_processed_file(
+        tracefile, only_gets=False, collapse_repeats=True
+    ):
+        f = acc.features
+        rows.append(
+            (
+                blocks.setdefault(k, len(blocks)),
+                acc.ts,
+                f.offset,
+                f.size,
+                f.op.value,
+                f.namespace,
+                f.user,
+                f.repeat,
+            )
+        )
+    return {
+        k: np.array([r[i] for r in rows], dtype=float if k == "ts" else np.int64)
+        for i, k in enumerate(COLUMNS)
+    }
+
+
+def read_columns(tracefile, processes=None):
+    """Trace (or its cached .npz) -> dict of columns, one row per trace line."""
+    if tracefile.endswith(".npz"):
+        cached_filename = tracefile
+    else:
+        cached_filename = _cache_filename(tracefile)
+        if not os.path.exists(cached_filename) or os.path.getmtime(
+            cached_filename
+        ) <= os.path.getmtime(tracefile):
+            cols = _parse_columns(tracefile, processes=processes)
+            tmp_filename = f"{cached_filename}.{os.getpid()}.npz"
+            np.savez(tmp_filename, **cols)
+            os.replace(tmp_filename, cached_filename)
+    with np.load(cached_filename) as data:
+        return {k: data[k] for k in COLUMNS}
+
+
+def expand_repeats(cols):
+    """One row per access: repeats spread over the next second, as in the readers."""
+    repeat = cols["repeat"]
+    if (repeat == 1).all():
+        return cols
+    rows = np.repeat(np.arange(len(repeat)), repeat)
+    starts = np.cumsum(repeat) - repeat
+    repeat_i = np.arange(len(rows)) - np.repeat(starts, repeat)
+    rep = repeat[rows]
+    out = {k: v[rows] for k, v in cols.items()}
+    out["ts"] = out["ts"] + repeat_i / np.maximum(rep - 1, 1)
+    out["repeat"] = np.ones(len(rows), dtype=np.int64)
+    order = np.argsort(out["ts"], kind="stable")
+    return {k: v[order] for k, v in out.items()}
+
+
+def _hash64(x, seed=1):
+    """splitmix64 finalizer, vectorized."""
+    z = x.astype(np.uint64) + np.uint64(0x9E3779B97F4A7C15 * seed % 2**64)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
+
+
+def _bit_length(x):
+    """int.bit_length of each uint64, by binary search with shifts."""
+    x = x.copy()
+    n = np.zeros(x.shape, dtype=np.int64)
+    for s in (32, 16, 8, 4, 2, 1):
+        big = x >> np.uint64(s) > 0
+        n[big] += s
+        x[big] >>= np.uint64(s)
+    return n + (x > 0)
+
+
+class HyperLogLogs(object):
+    """One HyperLogLog sketch (2**precision registers) per group."""
+
+    def __init__(self, num_groups, precision=12):
+        self.p = precision
+        self.m = 1 << precision
+        self.registers = np.zeros((num_groups, self.m), dtype=np.uint8)
+
+    def add(self, groups, items):
+        h = _hash64(items)
+        idx = (h >> np.uint64(64 - self.p)).astype(np.int64)
+        rest = h << np.uint64(self.p)
+        # Rank = leading zeros of the remaining bits + 1. Not via float64,
+        # which rounds away the low bits.
+        bit_length = _bit_length(rest)
+        rank = np.minimum(64 - bit_length + 1, 64 - self.p + 1).astype(np.uint8)
+        np.maximum.at(self.registers, (groups, idx), rank)
+
+    @staticmethod
+    def estimate(registers):
+        """Cardinality per row of `registers`."""
+        m = registers.shape[-1]
+        alpha = 0.7213 / (1 + 1.079 / m)
+        est = alpha * m * m / np.sum(2.0 ** -registers.astype(np.float64), axis=-1)
+        zeros = np.sum(registers == 0, axis=-1)
+        # Linear counting for small cardinalities.
+        small = (est <= 2.5 * m) & (zeros > 0)
+        est[small] = m * np.log(m / zeros[small])
+        return est
+
+    def estimates(self):
+        return self.estimate(self.registers)
+
+    def cumulative_estimates(self):
+        """Cardinality of the union of groups 0..i, for each i."""
+        return self.estimate(np.maximum.accumulate(self.registers, axis=0))
+
+
+def _log_ranks(n, points=200):
+    if n == 0:
+        return np.zeros(0, dtype=np.int64)
+    return np.unique(np.geomspace(1, n, points).astype(np.int64))
+
+
+def _log_hist(values, lo, hi, bins_per_decade=10):
+    """CDF of values at log-spaced edges."""
+    values = np.sort(values)
+    edges = np.logspace(
+        np.log10(lo), np.log10(hi), int(np.log10(hi / lo) * bins_per_decade) + 1
+    )
+    cdf = np.searchsorted(values, edges, side="right") / max(len(values), 1)
+    return {"Edges": edges.tolist(), "CDF": cdf.tolist()}
+
+
+def _quantiles(values):
+    if len(values) == 0:
+        return {}
+    return {f"P{q * 100:g}": float(v) for q, v in zip(QUANTILES, np.quantile(values, QUANTILES))}
+
+
+def characterize(cols, *, sample_ratio=100, window=3600, hll_precision=12):
+    """Columns (from read_columns) -> dict of trace stats."""
+    accs = expand_repeats(cols)
+    ts, block, op = accs["ts"], accs["block"], accs["op"]
+    is_get = np.isin(op, [o.value for o in GET_OPS])
+    is_put = np.isin(op, [o.value for o in PUT_OPS])
+    start_ts, end_ts = (float(ts[0]), float(ts[-1])) if len(ts) else (0.0, 0.0)
+    duration = end_ts - start_ts
+    num_blocks = int(block.max()) + 1 if len(block) else 0
+
+    # Sizes, as BlkAccess: chunk-aligned, and as requested.
+    first_chunk = accs["offset"] // BlkAccess.ALIGNMENT
+    last_chunk = (accs["offset"] + accs["size"] - 1) // BlkAccess.ALIGNMENT
+    num_chunks = last_chunk - first_chunk + 1
+    aligned_size = num_chunks * BlkAccess.ALIGNMENT
+
+    # Popularity: GETs per block, and object extents over all accesses.
+    gets_per_block = np.bincount(block[is_get], minlength=num_blocks)
+    puts_per_block = np.bincount(block[is_put], minlength=num_blocks)
+    obj_start = np.full(num_blocks, np.iinfo(np.int64).max)
+    np.minimum.at(obj_start, block, accs["offset"])
+    obj_end = np.zeros(num_blocks, dtype=np.int64)
+    np.maximum.at(obj_end, block, accs["offset"] + accs["size"])
+    popular = np.sort(gets_per_block[gets_per_block > 0])[::-1]
+    ranks = _log_ranks(len(popular))
+    get_share = np.cumsum(popular) / max(popular.sum(), 1)
+
+    # Interarrival times between GETs to the same block.
+    get_block, get_ts = block[is_get], ts[is_get]
+    order = np.lexsort((get_ts, get_block))
+    same = np.diff(get_block[order]) == 0
+    interarrivals = np.diff(get_ts[order])[same]
+
+    # Working set per window, of GETs.
+    num_windows = int(duration // window) + 1
+    win = ((ts - start_ts) // window).astype(np.int64)
+    blocks_hll = HyperLogLogs(num_windows, hll_precision)
+    blocks_hll.add(win[is_get], block[is_get])
+    chunks_hll = HyperLogLogs(num_windows, hll_precision)
+    get_chunks = num_chunks[is_get]
+    rows = np.repeat(np.arange(len(get_chunks)), get_chunks)
+    chunk_ids = (
+        np.repeat(first_chunk[is_get], get_chunks)
+        + np.arange(len(rows))
+        - np.repeat(np.cumsum(get_chunks) - get_chunks, get_chunks)
+    )
+    chunks_hll.add(
+        win[is_get][rows],
+        block[is_get][rows] * (BlkAccess.MAX_BLOCK_SIZE // BlkAccess.ALIGNMENT)
+        + chunk_ids,
+    )
+    working_set = {
+        "WindowStart": (start_ts + np.arange(num_windows) * window).tolist(),
+        "Accesses": np.bincount(win, minlength=num_windows).tolist(),
+        "GETs": np.bincount(win[is_get], minlength=num_windows).tolist(),
+        "PUTs": np.bincount(win[is_put], minlength=num_windows).tolist(),
+        "GETBytes": np.bincount(
+            win[is_get], weights=aligned_size[is_get], minlength=num_windows
+        ).tolist(),
+        "Blocks": blocks_hll.estimates().tolist(),
+        "Chunks": chunks_hll.estimates().tolist(),
+        "CumulativeBlocks": blocks_hll.cumulative_estimates().tolist(),
+        "CumulativeChunks": chunks_hll.cumulative_estimates().tolist(),
+    }
+
+    has_gets = gets_per_block > 0
+    return {
+        "SampleRatio": sample_ratio,
+        "Summary": {
+            "Accesses": len(ts),
+            "GETs": int(is_get.sum()),
+            "PUTs": int(is_put.sum()),
+            "Blocks": num_blocks,
+            "Namespaces": len(np.unique(accs["namespace"])),
+            "Users": len(np.unique(accs["user"])),
+            "StartTs": start_ts,
+            "EndTs": end_ts,
+            "DurationSecs": duration,
+            # Scaled up by the sample ratio, as for the full trace.
+            "RequestRate": len(ts) / duration * 100 / sample_ratio if duration else 0,
+            "AvgAccessSizeMB": float(aligned_size.mean()) / 1024 / 1024 if len(ts) else 0,
+            "AvgObjSizeMB": float((obj_end - obj_start).mean()) / 1024 / 1024 if num_blocks else 0,
+            "AvgObjEndMB": float(obj_end.mean()) / 1024 / 1024 if num_blocks else 0,
+            "PutPerAccess": float(is_put.mean()) if len(ts) else 0,
+            "PutOnlyBlocks": float(np.mean(~has_gets & (puts_per_block > 0))) if num_blocks else 0,
+            "OneHitWonderRate": float(np.mean(gets_per_block[has_gets] == 1)) if has_gets.any() else 0,
+            "CompulsoryMissRate": float(has_gets.sum() / is_get.sum()) if is_get.any() else 0,
+        },
+        "OpMix": {
+            o.name: int(n)
+            for o in OpType
+            if (n := np.count_nonzero(op == o.value))
+        },
+        "AccessSize": {
+            "Quantiles": _quantiles(aligned_size),
+            "OrigQuantiles": _quantiles(accs["size"]),
+            "Hist": _log_hist(aligned_size, BlkAccess.ALIGNMENT, BlkAccess.MAX_BLOCK_SIZE),
+        },
+        "Popularity": {
+            "Rank": ranks.tolist(),
+            "GETs": popular[ranks - 1].tolist(),
+            "GETShare": get_share[ranks - 1].tolist(),
+            "Quantiles": _quantiles(popular),
+        },
+        "Interarrival": {
+            "Count": len(interarrivals),
+            "Quantiles": _quantiles(interarrivals),
+            "Hist": _log_hist(interarrivals, 1e-3, max(duration, 1)),
+        },
+        "WorkingSet": {
+            "WindowSecs": window,
+            "HLLPrecision": hll_precision,
+            **working_set,
+        },
+    }
+
+
+def dump(stats, filename):
+    if filename.endswith(".lzma"):
+        compress_json.dump(stats, filename)
+    else:
+        with open(filename, "w") as f:
+            json.dump(stats, f, indent=1)
+
+
+def load(filename):
+    """
+    Reads a stats file. Working set (per window) and popularity (per rank)
+    come back as DataFrames.
+    """
+    if filename.endswith(".lzma"):
+        stats = compress_json.load(filename)
+    else:
+        with open(filename) as f:
+            stats = json.load(f)
+    stats["WorkingSet"] = pd.DataFrame(
+        {k: v for k, v in stats["WorkingSet"].items() if isinstance(v, list)}
+    )
+    stats["Popularity"]["Curve"] = pd.DataFrame(
+        {k: stats["Popularity"].pop(k) for k in ["Rank", "GETs", "GETShare"]}
+    )
+    return stats
+
+
+def get_parser():
+    parser = ArgumentParser(description="Trace stats in one vectorized pass")
+    parser.add_argument(
+        "-t", "--trace", required=True, help="Trace, or its cached columns (.npz)"
+    )
+    parser.add_argument(
+        "--sample-ratio",
+        type=float,
+        help="Sample ratio (in %%) of the trace; from its name by default",
+    )
+    parser.add_argument(
+        "--window", type=float, default=3600, help="Working set window (seconds)"
+    )
+    parser.add_argument(
+        "--hll-precision",
+        type=int,
+        default=12,
+        help="HyperLogLog registers per window, as a power of 2",
+    )
+    parser.add_argument("--processes", type=int)
+    parser.add_argument(
+        "-o", "--output", help="Stats file (.json or .json.lzma); next to the trace by default"
+    )
+    return parser
+
+
+def main(options):
+    tracefile = options.trace
+    sample_ratio = options.sample_ratio
+    if sample_ratio is None:
+        name = os.path.basename(tracefile)
+        if name.endswith(".npz"):
+            name = name[len("trace-columns-") : -len(".npz")].rsplit("_", 1)[0]
+        else:
+            name = name[: -len(".trace")]
+        sample_ratio = float(name.split("_")[-1])
+    cols = read_columns(tracefile, processes=options.processes)
+    stats = characterize(
+        cols,
+        sample_ratio=sample_ratio,
+        window=options.window,
+        hll_precision=options.hll_precision,
+    )
+    output = options.output or tracefile.rsplit(".", 1)[0] + "_stats.json.lzma"
+    dump(stats, output)
+    print(json.dumps(stats["Summary"], indent=1))
+    print(f"Stats written to {output}")
+    return stats
+
+
+if __name__ == "__main__":
+    main(get_parser().parse_args(sys.argv[1:]))
@@ -5,77 +5,98 @@ import gzip
 import pickle
 import os
 import shelve
+import shutil
 import subprocess
 import hashlib
 import itertools
+import math
 import json
 # import jsonpickle
 import sys
 import time
 from pathlib import Path
+import spookyhash
 from .legacy_utils import BlkAccess
-from .legacy_utils import read_processed_file_list_accesses
+from .legacy_utils import read_processed_file_list_accesses  # noqa: F401
+from .legacy_utils import stream_processed_file_parallel
 from .legacy_utils import read_processed_file_with_logical_ts  # noqa: F401
 from .legacy_utils import GET_OPS, PUT_OPS, get_output_suffix  # noqa: F401
+from .legacy_utils import TraceTimeIndex  # noqa: F401
 
 
-def stream_processed_accesses(f, *, region=None, input_file_name=None, sample_ratio=None, start=None, **kwargs):
+def stream_processed_accesses(f, *, region=None, input_file_name=None, sample_ratio=None, start=None,
+                               subsample_ratio=None, sample_seed=1, **kwargs):
+    """
+    Returns (stats, accesses), memoizing the parsed trace in /tmp.
+
+    subsample_ratio (in %, like sample_ratio) keeps a deterministic subset of
+    blocks as they stream by, so one trace can drive sims at several sample
+    ratios. The cache file always holds the whole trace.
+    """
+    stats, accesses = _stream_processed_accesses(
+        f, region=region, input_file_name=input_file_name, **kwargs)
+    if subsample_ratio is None:
+        return stats, accesses
+    keep = subsample_ratio / (sample_ratio or 100)
+    # Counts are scaled estimates; the sampled stream is not known until read.
+    stats = dict(stats, subsample_ratio=subsample_ratio, sample_seed=sample_seed)
+    for k in ['total_iops', 'total_iops_get', 'total_iops_put']:
+        stats[k] = int(stats[k] * keep)
+    accesses = ((k, acc) for k, acc in accesses if block_in_sample(k, keep, seed=sample_seed))
+    return stats, accesses
+
+
+def _stream_processed_accesses(f, *, region=None, input_file_name=None, **kwargs):
     # memoize
     assert os.path.exists(f), f"{f} does not exist"
-    filehash = subprocess.check_output(f"md5sum {f}", shell=True).split()[0]
+    if kwargs.get('byte_range'):
+        # Hashing the whole trace would undo the point of reading a slice.
+        stat = os.stat(f)
+        filehash = hashlib.md5(f'{stat.st_size}:{stat.st_mtime}'.encode()).hexdigest().encode()
+    else:
+        filehash = subprocess.check_output(f"md5sum {f}", shell=True).split()[0]
     # import platform
     # pywhich = platform.python_implementation()
     kwargs_hash = hashlib.md5(json.dumps(kwargs, sort_keys=True).encode('utf-8')).hexdigest()[-6:]
     cached_filename = f'/tmp/cache-sim-accesses-{region}_{input_file_name}_{filehash[-6:].decode()}_{kwargs_hash}_batched.pkl'
     if not os.path.exists(cached_filename) or os.path.getmtime(cached_filename) <= os.path.getmtime(__file__) or os.path.getmtime(cached_filename) <= os.path.getmtime(__file__.replace("utils", "legacy_utils")):
-        if os.path.exists(cached_filename):
-            mtime = os.path.getmtime(cached_filename)
-        else:
-            mtime = 0
-        accesses, start_ts, end_ts = read_processed_file_list_accesses(f, **kwargs)
-        max_key = max(accesses, key=lambda x: x[0])
-        total_iops = len(accesses)
-        total_iops_get = sum(1 for _, acc in accesses if acc.features.op in GET_OPS)
-        total_iops_put = sum(1 for _, acc in accesses if acc.features.op in PUT_OPS)
-        assert total_iops == total_iops_get + total_iops_put
-        trace_duration_secs = round(end_ts - start_ts, 2)
-        stats = {
-            'total_iops': total_iops,
-            'total_iops_get': total_iops_get,
-            'total_iops_put': total_iops_put,
-            'max_key': max_key,
-            'trace_duration_secs': trace_duration_secs,
-            'start_ts': start_ts,
-            'end_ts': end_ts,
-            'filename': f,
-            'trace_hash': filehash,
-            'kwargs_hash': kwargs_hash,
-            'kwargs': kwargs,
-        }
-        if not os.path.exists(cached_filename) or os.path.getmtime(cached_filename) == mtime:
-            if os.path.exists(cached_filename):
-                os.remove(cached_filename)
-            try:
-                with open(cached_filename, 'wb') as f:
-                    pickle.dump(stats, f, protocol=4)
-                    batch = []
-                    for acc in accesses:
-                        batch.append(acc)
-                        if len(batch) >= 512:
-                            pickle.dump(batch, f, protocol=4)
-                            batch = []
-                    if batch:
-                        pickle.dump(batch, f, protocol=4)
+        stats = {}
+        accesses = stream_processed_file_parallel(f, stats=stats, **kwargs)
+        # Accesses go straight to disk, so memory stays flat regardless of
+        # trace length. Stats are only known at the end but must lead the
+        # cache file, so batches are spooled and appended after them.
+        tmp_filename = f'{cached_filename}.{os.getpid()}'
+        try:
+            with open(f'{tmp_filename}.accs', 'wb') as fw:
+                batch = []
+                for acc in accesses:
+                    batch.append(acc)
+                    if len(batch) >= 512:
+                        pickle.dump(batch, fw, protocol=4)
                         batch = []
-            except:
-                if os.path.exists(cached_filename):
-                    os.remove(cached_filename)
-        return stats, accesses
-    else:
-        print(f"Streaming {f} ({cached_filename})")
-        gen = stream_pickle(cached_filename)
-        stats = next(gen)
-        return stats, gen
+                if batch:
+                    pickle.dump(batch, fw, protocol=4)
+            assert stats['total_iops'] == stats['total_iops_get'] + stats['total_iops_put']
+            stats.update({
+                'trace_duration_secs': round(stats['end_ts'] - stats['start_ts'], 2),
+                'filename': f,
+                'trace_hash': filehash,
+                'kwargs_hash': kwargs_hash,
+                'kwargs': kwargs,
+            })
+            with open(tmp_filename, 'wb') as fw, open(f'{tmp_filename}.accs', 'rb') as fr:
+                pickle.dump(stats, fw, protocol=4)
+                shutil.copyfileobj(fr, fw)
+            # Atomic, so concurrent runs never see a partial cache file.
+            os.replace(tmp_filename, cached_filename)
+        finally:
+            for fn in [tmp_filename, f'{tmp_filename}.accs']:
+                if os.path.exists(fn):
+                    os.remove(fn)
+    print(f"Streaming {f} ({cached_filename})")
+    gen = stream_pickle(cached_filename)
+    stats = next(gen)
+    return stats, gen
 
 
 def stream_pickle(filename):
@@ -102,6 +123,16 @@ def stream_pickle(filename):
                 # sys.exit(75) # Temp failure: retry
 
 
+def block_hash(block_id, seed=1):
+    """Deterministic 64-bit hash of a block id (stable across runs and processes)."""
+    return spookyhash.hash64(bytes(str(block_id), "utf-8"), seed=seed)
+
+
+def block_in_sample(block_id, keep, seed=1):
+    """Spatial sampling: keeps a deterministic fraction `keep` of blocks."""
+    return block_hash(block_id, seed=seed) / ((1 << 64) - 1) < keep
+
+
 def make_format_string(fields):
     print_fmt_hdr = "{0[0]:<12}"
     print_fmt_line = "{:<12}"
@@ -258,6 +289,50 @@ class Stats(object):
             self.freq[key][v] = init
         self.freq[key][v] += inc
 
+    @contextlib.contextmanager
+    def recording(self):
+        """Records bump() and bump_counter() calls made in the block, for replay()."""
+        calls = []
+
+        def bump(key, v=1, init=0):
+            calls.append(('bump', self._key(key), v, init))
+            Stats.bump(self, key, v=v, init=init)
+
+        def bump_counter(key, v, inc=1, init=0):
+            calls.append(('bump_counter', self._key(key), v, inc, init))
+            Stats.bump_counter(self, key, v, inc=inc, init=init)
+
+        self.bump, self.bump_counter = bump, bump_counter
+        try:
+            yield calls
+        finally:
+            del self.bump, self.bump_counter
+
+    @staticmethod
+    def totals(calls):
+        """Recorded calls summed by counter, for replay()."""
+        totals = {}
+        for name, key, *args in calls:
+            if name == 'bump':
+                k, v = (name, key, args[1]), args[0]
+            else:
+                k, v = (name, key, args[0], args[2]), args[1]
+            totals[k] = totals.get(k, 0) + v
+        return totals
+
+    def replay(self, totals, times=1):
+        """
+        Repeats recorded calls (their totals()) `times` times, each counter
+        bumped once. Float sums can differ from repeated calls in the last
+        bits.
+        """
+        for (name, key, *args), total in totals.items():
+            if name == 'bump':
+                # Recorded keys are already joined.
+                self.counters[key] = self.counters.get(key, args[0]) + total * times
+            else:
+                self.bump_counter(key, args[0], inc=total * times, init=args[1])
+
     def get(self, key, *, init=None):
         key = self._key(key)
         if key in self.counters:
@@ -337,10 +412,123 @@ class Stats(object):
     def get_all_with_prefix(self, prefix):
         return [(k, v) for k, v in self.counters.items() if k.startswith(prefix)]
 
+    def fold(self, suffix, into):
+        """
+        Adds every counter ending in `suffix` (and its checkpointed series)
+        to the same key ending in `into` instead, and drops the original.
+        Distributions (freq) are merged the same way.
+        """
+        for key in [k for k in self.freq if k.endswith(suffix)]:
+            dst = self.freq.setdefault(key[:-len(suffix)] + into, {})
+            for v, count in self.freq.pop(key).items():
+                dst[v] = dst.get(v, 0) + count
+        for key in [k for k in self.counters if k.endswith(suffix)]:
+            dst = key[:-len(suffix)] + into
+            # Moves counts, so not a bump for recording() to capture.
+            Stats.bump(self, dst, v=self.counters.pop(key))
+            if key + '_stats' not in self.batches:
+                continue
+            src_s = self.batches.pop(key + '_stats')
+            dst_s = self.batches.get(dst + '_stats', [])
+            # Series are cumulative: a shorter one carries its last value.
+            length = max(len(src_s), len(dst_s))
+            src_s = src_s + src_s[-1:] * (length - len(src_s))
+            dst_s = dst_s + (dst_s[-1:] or [0]) * (length - len(dst_s))
+            self.batches[dst + '_stats'] = [a + b for a, b in zip(src_s, dst_s)]
+
 
 ods = Stats()
 
 
+class TopKTenants(object):
+    """
+    Picks the tags for per-tenant stats: the K namespaces (and users) with
+    the most requests get their own, the rest share 'other'.
+
+    Request counts come from a Space-Saving table of `capacity` tenants,
+    so memory stays bounded however many tenants the trace has. A tenant
+    is promoted once its guaranteed count (count minus Space-Saving error)
+    passes the smallest among the top K by `margin`, so near-ties do not
+    keep swapping. Its stats are exact from then on; the requests before
+    that (at most its count) are in 'other', and are logged as
+    tenants/untracked/<tag>. A demoted tenant's stats are folded into
+    'other', so the tags always add up to the untagged totals. k=0 gives
+    every tenant a tag.
+    """
+    OTHER = 'other'
+
+    def __init__(self, k, capacity=None, margin=0.1):
+        self.k = k
+        self.capacity = capacity or 4 * k
+        self.margin = margin
+        assert not k or self.capacity > k
+        self.counts = {}  # kind -> Space-Saving table of {tenant: count}
+        self.errs = {}  # kind -> {tenant: overestimate of its count}
+        self.top = {}  # kind -> set of promoted tenants
+        self.floor = {}  # kind -> lower bound on the count to promote at
+
+    def labels(self, acc, n=1):
+        """Counts `n` requests of acc's tenants. Returns (namespace, user) labels."""
+        return (self.observe('ns', acc.features.namespace, n),
+                self.observe('user', acc.features.user, n))
+
+    def stable(self, acc):
+        """How many more requests of acc's tenants keep their labels."""
+        if not self.k:
+            return math.inf
+        left = math.inf
+        for kind, tenant in (('ns', acc.features.namespace), ('user', acc.features.user)):
+            if tenant in self.top.get(kind, ()):
+                continue
+            if tenant not in self.counts.get(kind, {}) or kind not in self.floor:
+                return 0
+            # Promoted once its guaranteed count passes the floor.
+            guaranteed = self.counts[kind][tenant] - self.errs[kind][tenant]
+            left = min(left, max(0, math.floor(self.floor[kind]) - guaranteed))
+        return left
+
+    def observe(self, kind, tenant, n=1):
+        if not self.k:
+            return tenant
+        counts = self.counts.setdefault(kind, {})
+        errs = self.errs.setdefault(kind, {})
+        top = self.top.setdefault(kind, set())
+        if tenant in counts:
+            counts[tenant] += n
+        elif len(counts) < self.capacity:
+            counts[tenant] = n
+            errs[tenant] = 0
+        else:
+            # Space-Saving: take over the smallest count outside the top K.
+            victim = min((t for t in counts if t not in top), key=counts.get)
+            errs[tenant] = counts.pop(victim)
+            del errs[victim]
+            counts[tenant] = errs[tenant] + n
+        if tenant not in top and counts[tenant] - errs[tenant] > self.floor.get(kind, 0):
+            self._promote(kind, tenant, n)
+        return tenant if tenant in top else self.OTHER
+
+    def _promote(self, kind, tenant, n):
+        counts, top = self.counts[kind], self.top[kind]
+        if len(top) >= self.k:
+            weakest = min(top, key=counts.get)
+            # Top counts only grow, so this holds until the next promotion.
+            self.floor[kind] = counts[weakest] * (1 + self.margin)
+            if counts[tenant] - self.errs[kind][tenant] <= self.floor[kind]:
+                return
+            top.remove(weakest)
+            ods.bump('tenants/demotions')
+            del ods.counters[f'tenants/untracked/{kind}/{weakest}']
+            # Tags are ns/<tenant> or ns_<tenant>, depending on the stat.
+            for sep in '/_':
+                ods.fold(f'/{kind}{sep}{weakest}', f'/{kind}{sep}{self.OTHER}')
+        top.add(tenant)
+        ods.bump('tenants/promotions')
+        ods.counters[f'tenants/untracked/{kind}/{tenant}'] = counts[tenant] - n
+        if len(top) >= self.k:
+            self.floor[kind] = min(counts[t] for t in top) * (1 + self.margin)
+
+
 def key_refmt(key):
     block_id, chunk_id = key
     return f"{block_id}|#|body-0-{chunk_id-1}"
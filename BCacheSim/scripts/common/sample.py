@@ -6,6 +6,7 @@ import random
 import sys
 
 import numpy as np
+import spookyhash
 
 from tqdm import tqdm
 
@@ -187,6 +188,76 @@ class SamplerSetup(object):
         return allowed_blocks
 
 
+def hash_fraction(key, seed):
+    """Maps a key to [0, 1]. Membership depends only on (key, seed)."""
+    return spookyhash.hash64(key.encode('utf-8'), seed=seed) / ((1 << 64) - 1)
+
+
+def hash_range(ssetup):
+    """Slice [lo, hi) of hash space that corresponds to [start, end) hosts."""
+    args = ssetup.args
+    # Same scaling as get_allowed_blocks, applied to the fraction of blocks
+    # instead of the cumulative fraction of accesses. The two agree in
+    # expectation since the hash does not depend on popularity.
+    factor = 1.
+    if ssetup.new_sampling:
+        factor = ssetup.sampling_rate / ssetup.num_hosts
+    if args.orig_rate and args.orig_rate != 1:
+        factor /= args.orig_rate
+    return args.start * factor, args.end * factor
+
+
+def write_hash_sampled_keys(key_file, out_keys_filename, lo, hi, seed):
+    """Streams the key file, keeping keys in [lo, hi). Constant memory."""
+    num_items, num_total = 0, 0
+    num_bytes = os.path.getsize(key_file)
+    with open(key_file) as f, open(out_keys_filename, 'w') as fw, tqdm(total=num_bytes, **tqdm_kwargs) as pbar:
+        for line in f:
+            # key, #Accs, #GETs, #PUTs, #Bytes
+            items = line.split()
+            num_total += 1
+            if lo <= hash_fraction(items[0], seed) < hi:
+                fw.write(' '.join(items[:3]) + '\n')
+                num_items += 1
+            pbar.update(len(line))
+    print("Items selected: {} ({:g})".format(num_items, num_items / max(num_total, 1)))
+    print("Total items:", num_total)
+
+
+def split_file(filename, num_ranges):
+    """Byte ranges; workers move each boundary forward to the next line."""
+    num_bytes = os.path.getsize(filename)
+    step = max(1, -(-num_bytes // num_ranges))
+    return [(a, min(a + step, num_bytes)) for a in range(0, num_bytes, step)]
+
+
+def process_range(args):
+    file_in, file_out, start_byte, end_byte, key_getter, lo, hi, seed = args
+    kept, total = 0, 0
+    # Binary mode, so that tell()/seek() are plain byte offsets.
+    with open(file_in, 'rb') as f, open(file_out, 'wb') as fw, tqdm(total=end_byte - start_byte, position=None, desc=os.path.basename(file_in), **tqdm_kwargs) as pbar:
+        # A line belongs to the range it starts in.
+        if start_byte > 0:
+            f.seek(start_byte - 1)
+            if f.read(1) != b'\n':
+                f.readline()
+        pos = f.tell()
+        while pos < end_byte:
+            line = f.readline()
+            if not line:
+                break
+            pos += len(line)
+            pbar.update(len(line))
+            if line.startswith(b'#'):
+                continue
+            total += 1
+            key = key_getter(line.decode('utf-8').split())
+            if lo <= hash_fraction(key, seed) < hi:
+                fw.write(line)
+                kept += 1
+    return kept, total
+
+
 def process_file(args):
     i, file_in, file_out, allowed_blocks, key_getter = args
     num_bytes = os.path.getsize(file_in)
@@ -217,7 +288,9 @@ def main():
     parser.add_argument("-l", "--size", type=float)
     parser.add_argument("-e", "--end", type=float)
     parser.add_argument("--old-format", action='store_true')
-    parser.add_argument("--seed", default=1337)
+    parser.add_argument("--seed", default=1337, type=int)
+    parser.add_argument("--sampler", choices=["hash", "shuffle"], default="hash",
+                        help='hash: streaming, constant memory. shuffle: legacy, to reproduce older samples')
     parser.add_argument("--orig-rate", default=1, type=float, help='Set to no of hosts (in volume) in original trace')
     parser.add_argument("-t", "--trace-id", required=True)
     parser.add_argument("-g", "--trace-group", required=True)
@@ -279,10 +352,16 @@ def main():
             print(i, filename)
             assert i == int(filename.split(".")[-1]), (i, filename)
 
-    ssetup.load_keys(key_file)
-    print(f"3/Memory usage: {utils.memory_usage():.1f} GB")
-    allowed_blocks = ssetup.get_allowed_blocks(sampled_keys, legacy=False)
-    print(f"4/Memory usage: {utils.memory_usage():.1f} GB")
+    if args.sampler == 'hash':
+        lo, hi = hash_range(ssetup)
+        print(f"Hash range: [{lo:g}, {hi:g}), seed {args.seed}")
+        if os.path.exists(key_file):
+            write_hash_sampled_keys(key_file, sampled_keys, lo, hi, args.seed)
+    else:
+        ssetup.load_keys(key_file)
+        print(f"3/Memory usage: {utils.memory_usage():.1f} GB")
+        allowed_blocks = ssetup.get_allowed_blocks(sampled_keys, legacy=False)
+        print(f"4/Memory usage: {utils.memory_usage():.1f} GB")
     key_getter = ssetup.key_getter
     del ssetup
     import gc
@@ -300,30 +379,47 @@ def main():
     # TODO: Debug this. allowed_blocks = num_items - 1.
     # This check is now also done in reformat, by making sure it in sorted order.
     tmpdir = output_file_prefix + "_tmpdir"
-    cmd = f"sort -k3,3 -r -s -n {sampled_keys} -o {sampled_keys}"
-    try:
-        utils.check_cmd(cmd)
-    except Exception as e:
-        print(e)
-        cmd += f' -T {tmpdir}'
-        utils.cmd_with_tmpdir(cmd, tmpdir)
-
-    pargs = [(i, fn, output_file_prefix+f".{i}", allowed_blocks, key_getter)
-             for i, fn in enumerate(trace_files)]
-    if args.num_workers == 1:
-        # TODO: Deprecate?
-        for zargs in pargs:
-            process_file(zargs)
-    else:
+    if os.path.exists(sampled_keys):
+        cmd = f"sort -k3,3 -r -s -n {sampled_keys} -o {sampled_keys}"
+        try:
+            utils.check_cmd(cmd)
+        except Exception as e:
+            print(e)
+            cmd += f' -T {tmpdir}'
+            utils.cmd_with_tmpdir(cmd, tmpdir)
+
+    if args.sampler == 'hash':
+        # Split files into byte ranges so that big files are not bound to one core.
+        ranges_per_file = max(1, -(-args.num_workers // len(trace_files)))
+        pargs = [(fn, output_file_prefix+f".{i}.{j}", a, b, key_getter, lo, hi, args.seed)
+                 for i, fn in enumerate(trace_files)
+                 for j, (a, b) in enumerate(split_file(fn, ranges_per_file))]
         try:
-            # TODO: Sometimes it gets stuck here, but works on a retry
-            # , maxtasksperchild=1
             with multiprocessing.Pool(processes=args.num_workers) as pool:
-                pool.map(process_file, pargs)
+                counts = pool.map(process_range, pargs, chunksize=1)
         except (MemoryError, OSError, KeyboardInterrupt):
             lock.delete()
             raise
-    out_files = [x[2] for x in pargs]
+        kept, total = np.sum(counts, axis=0) if counts else (0, 0)
+        print(f"Accesses kept: {kept} / {total} ({kept / max(total, 1):g})")
+        out_files = [x[1] for x in pargs]
+    else:
+        pargs = [(i, fn, output_file_prefix+f".{i}", allowed_blocks, key_getter)
+                 for i, fn in enumerate(trace_files)]
+        if args.num_workers == 1:
+            # TODO: Deprecate?
+            for zargs in pargs:
+                process_file(zargs)
+        else:
+            try:
+                # TODO: Sometimes it gets stuck here, but works on a retry
+                # , maxtasksperchild=1
+                with multiprocessing.Pool(processes=args.num_workers) as pool:
+                    pool.map(process_file, pargs)
+            except (MemoryError, OSError, KeyboardInterrupt):
+                lock.delete()
+                raise
+        out_files = [x[2] for x in pargs]
 
     print("Merging files")
     # Sort by timestamp. -m assumes files are sorted.